@@ -1,55 +1,97 @@
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters
-from config import TELEGRAM_BOT_TOKEN
+from config import TELEGRAM_BOT_TOKEN, BOT_CONCURRENT_UPDATES, BOT_MODE, WARM_UP, ensure_dirs
 from utils.logger import logger
-
-# Импортируем хендлеры
-from handlers.start import start_command, help_command, reset_command, stats_command, mode_command, mode_callback
-from handlers.text import handle_text_message
-from handlers.voice import handle_voice
-from handlers.image import handle_photo
-from handlers.document import handle_document
+from utils.startup import startup
 
 def setup_handlers(app: Application):
-    """Регистрация всех обработчиков"""
+    """Регистрация всех обработчиков
+
+    Все обработчики проходят через планировщик: он упорядочивает апдейты
+    одного пользователя и ограничивает нагрузку на Gemini.
+    """
+    # Хендлеры импортируются здесь: приемник webhook не загружает
+    # клиент Gemini и базу знаний, это делают процессы-обработчики
+    from services.scheduler import scheduler
+    from handlers.start import start_command, help_command, reset_command, stats_command, kb_command, mode_command, mode_callback
+    from handlers.text import handle_text_message
+    from handlers.voice import handle_voice
+    from handlers.image import handle_photo
+    from handlers.document import handle_document
+
     # Команды
-    app.add_handler(CommandHandler("start", start_command))
-    app.add_handler(CommandHandler("help", help_command))
-    app.add_handler(CommandHandler("reset", reset_command))
-    app.add_handler(CommandHandler("stats", stats_command))
-    app.add_handler(CommandHandler("mode", mode_command))
+    app.add_handler(CommandHandler("start", scheduler.wrap(start_command)))
+    app.add_handler(CommandHandler("help", scheduler.wrap(help_command)))
+    app.add_handler(CommandHandler("reset", scheduler.wrap(reset_command)))
+    app.add_handler(CommandHandler("stats", scheduler.wrap(stats_command)))
+    app.add_handler(CommandHandler("kb", scheduler.wrap(kb_command)))
+    app.add_handler(CommandHandler("mode", scheduler.wrap(mode_command)))
     
     # Callback для кнопок режима
-    app.add_handler(CallbackQueryHandler(mode_callback, pattern="^mode_"))
+    app.add_handler(CallbackQueryHandler(scheduler.wrap(mode_callback), pattern="^mode_"))
     
     # Голосовые сообщения
-    app.add_handler(MessageHandler(filters.VOICE, handle_voice))
+    app.add_handler(MessageHandler(filters.VOICE, scheduler.wrap(handle_voice, modality="audio")))
     
     # Изображения
-    app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+    app.add_handler(MessageHandler(filters.PHOTO, scheduler.wrap(handle_photo, modality="vision")))
     
     # Документы
-    app.add_handler(MessageHandler(filters.Document.PDF | filters.Document.TXT, handle_document))
+    app.add_handler(MessageHandler(filters.Document.PDF | filters.Document.TXT, scheduler.wrap(handle_document, modality="document")))
     
     # Текстовые сообщения (должны быть последними)
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, scheduler.wrap(handle_text_message, modality="text")))
     
     logger.info("Все обработчики зарегистрированы")
 
-def create_bot() -> Application:
-    """Создание и настройка бота"""
+async def post_init(app: Application):
+    """После подключения к Telegram: прогрев тяжелых объектов в фоне"""
+    startup.mark("bot_initialized")
+    if not WARM_UP:
+        return
+
+    # Объекты создаются в фоновом потоке, пока запускается прием апдейтов;
+    # апдейт, которому объект нужен раньше, дождется его создания
+    from services.gemini_client import gemini_client
+    from rag.index import vector_index
+    from rag.loader import document_loader
+    from utils.lazy import warm_up
+
+    warm_up(gemini_client, vector_index, document_loader)
+
+def create_bot(updater: bool = True) -> Application:
+    """Создание и настройка бота
+
+    updater=False - для обработчиков webhook, апдейты в них кладутся извне.
+    """
     logger.info("Инициализация бота...")
+    ensure_dirs()
     
     # Создаем приложение
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    # Апдейты разных пользователей обрабатываются параллельно
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(BOT_CONCURRENT_UPDATES)
+        .post_init(post_init)
+    )
+    if not updater:
+        builder = builder.updater(None)
+    app = builder.build()
     
     # Регистрируем обработчики
     setup_handlers(app)
+    startup.mark("handlers_ready")
     
     logger.info("Бот готов к работе!")
     return app
 
 def start_bot():
-    """Запуск бота"""
+    """Запуск бота (BOT_MODE: polling или webhook)"""
+    if BOT_MODE == "webhook":
+        from services.webhook import run_webhook
+        run_webhook()
+        return
+
     app = create_bot()
     logger.info("Запуск polling...")
     app.run_polling(drop_pending_updates=True)
@@ -8,24 +8,224 @@ load_dotenv()
 # Telegram
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
+# Режим запуска: polling (один процесс) или webhook (HTTP-приемник + процессы-обработчики)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")              # Публичный https-адрес, пусто - webhook не регистрируется
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")        # Сверяется с X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Процессов-обработчиков: часть базы знаний (user_id % KB_SHARDS) всегда обслуживает один и тот же
+# процесс (номер части % WEBHOOK_WORKERS), больше KB_SHARDS процессов не запускается
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", str(os.cpu_count() or 1)))
+# Апдейтов в очереди одного обработчика, сверх - ответ 503 и Telegram повторит доставку
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_MAX_CONNECTIONS = 100
+# Номер процесса-обработчика и их число (выставляются при запуске обработчиков)
+WORKER_ID = int(os.getenv("WORKER_ID", "0"))
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", "1"))
+
 # Gemini API
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GEMINI_TEXT_MODEL = "gemini-2.0-flash-exp"
 GEMINI_VISION_MODEL = "gemini-2.0-flash-exp"
 GEMINI_AUDIO_MODEL = "gemini-2.0-flash-exp"
+GEMINI_TTS_MODEL = "models/gemini-2.5-flash-preview-tts"
+
+# Маршрутизация по моделям: простые запросы - быстрой модели, сложные - сильной
+MODEL_ROUTING = os.getenv("MODEL_ROUTING", "1") == "1"
+GEMINI_FAST_MODEL = os.getenv("GEMINI_FAST_MODEL", "gemini-2.0-flash-lite")
+GEMINI_STRONG_MODEL = os.getenv("GEMINI_STRONG_MODEL", "gemini-2.5-pro")
+# Цена за 1M токенов (вход, выход), USD - для учета стоимости
+MODEL_PRICES = {
+    GEMINI_FAST_MODEL: (0.075, 0.30),
+    GEMINI_TEXT_MODEL: (0.10, 0.40),
+    GEMINI_STRONG_MODEL: (1.25, 10.0),
+}
+ROUTER_SHORT_TOKENS = 40               # Короткий вопрос без кода - быстрой модели
+ROUTER_LONG_TOKENS = 500               # Длинный запрос - сильной модели
+ROUTER_CODE_LINES = 10                 # Столько строк кода - ревью, сильной модели
+ROUTER_STRUCTURE_ITEMS = 3             # Столько вопросов или пунктов списка - сильной модели
+ROUTER_FAILOVER_ATTEMPTS = 2           # Попыток на модель, если есть запасная
+ROUTER_RATE_LIMIT_COOLDOWN = 60.0      # После 429 модель уходит в конец списка на столько секунд
+ROUTER_SLOW_FACTOR = 3.0               # Запасная модель ставится первой, если основная во столько раз медленнее (p95)
+
+# Озвучивание ответов
+TTS_VOICE = os.getenv("TTS_VOICE", "Fenrir")  # Доступные: Puck, Charon, Kore, Fenrir, Aoede
+TTS_SEGMENT_CHARS = 400                       # Максимальная длина фрагмента для одного запроса TTS
+TTS_MAX_SEGMENTS = 12                         # Сколько фрагментов ответа озвучивать
+TTS_CACHE_MAX_FILES = 5000                    # Размер кэша озвученных фрагментов
+
+# Расшифровка голосовых сообщений
+VOICE_CHUNK_SECONDS = 60                      # Длинные сообщения режутся на куски такой длины
+TRANSCRIPT_CACHE_SIZE = 2000                  # Сколько расшифровок помнить (по file_unique_id)
+TRANSCRIPT_CACHE_TTL = 7 * 24 * 3600          # Время жизни расшифровки (секунды)
+
+# Предобработка изображений
+IMAGE_TARGET_SIDE = int(os.getenv("IMAGE_TARGET_SIDE", "1024"))  # Длинная сторона изображения для vision
+IMAGE_JPEG_QUALITY = 85
+IMAGE_ANALYSIS_CACHE_SIZE = 1000              # Сколько анализов изображений помнить
+IMAGE_ANALYSIS_TTL = 24 * 3600                # Время жизни анализа (секунды)
+
+# Конкурентность
+# Сколько запросов к Gemini может выполняться одновременно
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+# Дополнительные лимиты для дорогих модальностей
+GEMINI_MODALITY_LIMITS = {
+    "text": GEMINI_MAX_CONCURRENCY,
+    "vision": 3,
+    "audio": 3,
+    "tts": 2,
+    "document": 2,
+}
+# Сколько апдейтов Telegram принимается параллельно (дальше их упорядочивает планировщик)
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "256"))
+# Максимум тяжелых запросов в очереди, сверх него - ответ о перегрузке
+SCHEDULER_MAX_PENDING = int(os.getenv("SCHEDULER_MAX_PENDING", "200"))
+
+# Транспорт Gemini: пул соединений, повторы, дедлайны, хеджирование, circuit breaker
+GEMINI_HTTP_POOL_SIZE = GEMINI_MAX_CONCURRENCY * 2           # Соединений в общем пуле
+GEMINI_REQUEST_TIMEOUT = float(os.getenv("GEMINI_REQUEST_TIMEOUT", "60"))  # Одна попытка (секунды)
+# Дедлайн запроса целиком, со всеми повторами (секунды)
+GEMINI_DEADLINES = {
+    "text": 120,
+    "vision": 120,
+    "audio": 180,
+    "tts": 60,
+    "document": 300,
+}
+GEMINI_RETRY_ATTEMPTS = 4              # Попыток на запрос (429, 5xx, сетевые ошибки)
+GEMINI_RETRY_BASE_DELAY = 0.5          # Пауза перед первым повтором, дальше растет вдвое
+GEMINI_RETRY_MAX_DELAY = 8.0
+# Дублировать запрос, не ответивший за p95 задержки модели (тратит лишние токены)
+GEMINI_HEDGING = os.getenv("GEMINI_HEDGING", "0") == "1"
+GEMINI_HEDGE_MIN_DELAY = 2.0           # Не дублировать раньше, чем через столько секунд
+GEMINI_BREAKER_FAILURES = 5            # Ошибок подряд, после которых модель отключается
+GEMINI_BREAKER_RESET = 30.0            # Через сколько секунд пробовать модель снова
+
+# Gemini File API (анализ документов)
+FILE_API_TTL = 48 * 3600               # Сколько Gemini хранит загруженный файл (секунды)
+FILE_API_EXPIRY_MARGIN = 3600          # Файлы, которые скоро истекут, загружаются заново
+FILE_POLL_INITIAL_DELAY = 1.0          # Первая проверка статуса обработки (секунды)
+FILE_POLL_MAX_DELAY = 30.0             # Максимальный интервал между проверками
+FILE_PROCESSING_TIMEOUT = 600          # Сколько ждать обработки файла
+FILE_REGISTRY_MAX_FILES = 200          # Сверх этого старые загрузки удаляются из Gemini
+
+# Кэширование статических system prompt'ов на стороне Gemini
+PROMPT_CACHE_ENABLED = os.getenv("PROMPT_CACHE_ENABLED", "1") == "1"
+PROMPT_CACHE_TTL = 3600                # Время жизни кэша (секунды)
+PROMPT_CACHE_REFRESH_MARGIN = 300      # За сколько до истечения продлевать
+PROMPT_CACHE_RETRY_INTERVAL = 600      # Пауза перед новой попыткой после ошибки
+# Минимальный размер cached content (у моделей Gemini от 1024 до 4096 токенов):
+# более короткий префикс передается инлайн без попыток создать кэш
+PROMPT_CACHE_MIN_TOKENS = int(os.getenv("PROMPT_CACHE_MIN_TOKENS", "4096"))
+
+# Стриминг ответов
+# Минимальный интервал между редактированиями сообщения (секунды)
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+
+# Кэш ответов на повторяющиеся вопросы
+ANSWER_CACHE_TTL = 24 * 3600           # Время жизни ответа (секунды)
+ANSWER_CACHE_MAX_ENTRIES = 5000
+ANSWER_CACHE_SIMILARITY = 0.93         # Порог косинусной близости вопросов
+ANSWER_CACHE_MIN_CHARS = 10            # Короткие реплики ("еще", "почему?") не кэшируются
 
 # Пути
 BASE_DIR = Path(__file__).parent
 DATA_DIR = BASE_DIR / "data"
 DOCUMENTS_DIR = DATA_DIR / "documents"
+TTS_CACHE_DIR = DATA_DIR / "tts_cache"
+# Реестр загрузок в Gemini File API - кэш, у каждого процесса-обработчика свой
+FILE_REGISTRY_PATH = DATA_DIR / (f"gemini_files-{WORKER_ID}.json" if WORKER_COUNT > 1 else "gemini_files.json")
+# Общие пространства базы знаний (shared, курсы) - одно хранилище в DATA_DIR
 CHROMA_DB_DIR = DATA_DIR / "chroma_db"
+NUMPY_INDEX_DIR = DATA_DIR / "numpy_index"
+KEYWORD_INDEX_PATH = DATA_DIR / "keyword_index.sqlite3"
+KB_CATALOG_PATH = DATA_DIR / "kb_catalog.json"
+# Личные документы - в KB_SHARDS частях по user_id (KB_SHARDS_DIR/NN, внутри та же структура).
+# Хранилища не рассчитаны на запись из нескольких процессов, поэтому каждую часть
+# обслуживает один процесс. Число частей не зависит от числа обработчиков:
+# после изменения KB_SHARDS документы нужно перенести (scripts/migrate_kb_shards.py)
+KB_SHARDS = int(os.getenv("KB_SHARDS", "16"))
+KB_SHARDS_DIR = DATA_DIR / "kb_shards"
+# Кэши, общие для всех процессов (расшифровки, анализы изображений, ответы)
+SHARED_CACHE_PATH = DATA_DIR / "shared_cache.sqlite3"
+
+# Логирование: запись в отдельном потоке, файл - JSON-строки с ротацией по размеру
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")              # Консоль
+LOG_FILE_LEVEL = os.getenv("LOG_FILE_LEVEL", "DEBUG")   # Файл
+LOG_JSON = os.getenv("LOG_JSON", "1") == "1"            # 0 - файл в текстовом формате
+# У каждого процесса-обработчика webhook свой файл: ротация не рассчитана на несколько процессов
+LOG_FILE = DATA_DIR / (f"bot-{WORKER_ID}.log" if os.getenv("WORKER_ID") else "bot.log")
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+# DEBUG-записей в секунду с одного места вызова (и запас на всплеск), остальные отбрасываются
+LOG_DEBUG_RATE = 5
+LOG_DEBUG_BURST = 20
 
 # RAG настройки
+EMBEDDING_MODEL = "models/embedding-001"
+EMBEDDING_CACHE_PATH = DATA_DIR / "embedding_cache.sqlite3"
+EMBEDDING_CACHE_MEMORY_ITEMS = int(os.getenv("EMBEDDING_CACHE_MEMORY_ITEMS", "2048"))
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+# Движок векторного хранилища: chroma или numpy (memory-mapped матрица, для одного узла)
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
+NUMPY_INDEX_QUANTIZE = os.getenv("NUMPY_INDEX_QUANTIZE", "0") == "1"  # int8 вместо float32
+NUMPY_INDEX_MAX_SEGMENTS = 8           # Больше сегментов - фоновое слияние
+NUMPY_INDEX_MAX_DEAD_RATIO = 0.3       # Доля удаленных строк, после которой индекс сжимается
 RAG_CHUNK_SIZE = 1000
 RAG_CHUNK_OVERLAP = 200
 RAG_TOP_K = 3
-MAX_HISTORY_LENGTH = 20
+# Общие пространства базы знаний, доступные всем (через запятую, например: shared,python-basics)
+KB_SHARED_NAMESPACES = [ns.strip() for ns in os.getenv("KB_SHARED_NAMESPACES", "shared").split(",") if ns.strip()]
+# Гибридный поиск: векторы + BM25, слияние RRF, разнообразие MMR
+RAG_HYBRID = os.getenv("RAG_HYBRID", "1") == "1"
+RAG_CANDIDATES = 12                    # Кандидатов от каждого поиска до слияния
+RAG_RRF_K = 60                         # Константа Reciprocal Rank Fusion
+RAG_MMR_LAMBDA = 0.7                   # 1.0 - без учета разнообразия
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Индексация: размер батча эмбеддингов, параллельные батчи, повторы
+RAG_EMBED_BATCH_SIZE = int(os.getenv("RAG_EMBED_BATCH_SIZE", "64"))
+RAG_EMBED_CONCURRENCY = int(os.getenv("RAG_EMBED_CONCURRENCY", "4"))
+RAG_EMBED_MAX_RETRIES = int(os.getenv("RAG_EMBED_MAX_RETRIES", "3"))
+# Разбор документов: число процессов, разбирающих окна PDF
+RAG_LOADER_WORKERS = int(os.getenv("RAG_LOADER_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Потоковая индексация: окно разбора (одна задача пула) и размер очереди чанков
+RAG_STREAM_WINDOW_PAGES = 4
+RAG_STREAM_WINDOW_CHARS = 64 * 1024
+RAG_STREAM_QUEUE_SIZE = 256
+# История хранится с запасом, в запрос попадает то, что влезает в бюджет токенов
+MAX_HISTORY_LENGTH = 60
+
+# Бюджет токенов на историю диалога (включая system prompt) по моделям
+# (быстрой модели - меньше: короче и дешевле запрос, сильной - больше)
+CONTEXT_DEFAULT_BUDGET = int(os.getenv("CONTEXT_DEFAULT_BUDGET", "6000"))
+CONTEXT_FAST_BUDGET = int(os.getenv("CONTEXT_FAST_BUDGET", "3000"))
+CONTEXT_STRONG_BUDGET = int(os.getenv("CONTEXT_STRONG_BUDGET", "12000"))
+CONTEXT_TOKEN_BUDGETS = {
+    GEMINI_FAST_MODEL: CONTEXT_FAST_BUDGET,
+    GEMINI_STRONG_MODEL: CONTEXT_STRONG_BUDGET,
+    # Основная модель последней: ее бюджет главный, если модели совпадают
+    GEMINI_TEXT_MODEL: CONTEXT_DEFAULT_BUDGET,
+}
+# Сколько последних сообщений передается всегда, даже сверх бюджета
+CONTEXT_MIN_RECENT_MESSAGES = 2
+# Сколько выпавших из окна сообщений копится перед обновлением краткого содержания
+CONTEXT_SUMMARY_MIN_MESSAGES = 4
+
+# Сессии пользователей
+SESSION_DB_PATH = DATA_DIR / "sessions.sqlite3"
+# Сколько пользователей держать в памяти
+SESSION_HOT_SIZE = int(os.getenv("SESSION_HOT_SIZE", "5000"))
+# Как часто сбрасывать изменения на диск и через сколько выгружать неактивных (секунды)
+SESSION_FLUSH_INTERVAL = 5
+SESSION_IDLE_SECONDS = 30 * 60
+
+# Прогрев клиента Gemini и базы знаний в фоне после запуска (иначе - при первом обращении)
+WARM_UP = os.getenv("WARM_UP", "1") == "1"
 
-# Создаем папки если их нет
-DOCUMENTS_DIR.mkdir(parents=True, exist_ok=True)
-CHROMA_DB_DIR.mkdir(parents=True, exist_ok=True)
+def ensure_dirs():
+    """Создать рабочие папки (при запуске бота, а не при импорте config)"""
+    for path in (DOCUMENTS_DIR, CHROMA_DB_DIR, TTS_CACHE_DIR):
+        path.mkdir(parents=True, exist_ok=True)
@@ -2,16 +2,21 @@ from telegram import Update
 from telegram.ext import ContextTypes
 from utils.session import user_sessions
 from utils.logger import logger
-from rag.query import add_document_to_knowledge_base
+from rag.query import add_document_bytes_to_knowledge_base
+from rag.namespaces import user_namespace
+from services.gemini_client import gemini_client
+from services.transport import GeminiError
+from handlers.text import split_and_send_message
 from pathlib import Path
-import tempfile
+import io
+import time
 
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка документов (PDF, TXT)"""
     user_id = update.effective_user.id
     document = update.message.document
     
-    logger.info(f"Документ от {user_id}: {document.file_name}")
+    logger.debug(f"Документ от {user_id}: {document.file_name}")
     
     # Проверяем формат файла
     file_ext = Path(document.file_name).suffix.lower()
@@ -32,28 +37,61 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Обновляем статистику
     user_sessions.update_stats(user_id, 'documents')
     
+    # Документ с подписью - вопрос по документу, ответ через File API
+    if update.message.caption:
+        await answer_about_document(update, context, document)
+        return
+    
     # Отправляем статус
-    await update.message.reply_text("⏳ Загружаю документ в базу знаний...")
+    status_message = await update.message.reply_text("⏳ Загружаю документ в базу знаний...")
+    last_progress = 0.0
+    
+    async def report_progress(done: int, total: int = None):
+        """Обновляем статус не чаще раза в 2 секунды"""
+        nonlocal last_progress
+        now = time.monotonic()
+        if now - last_progress < 2:
+            return
+        last_progress = now
+        if total:
+            await status_message.edit_text(f"⏳ Индексация: {done}/{total} фрагментов ({done * 100 // total}%)")
+        else:
+            await status_message.edit_text(f"⏳ Индексация: обработано {done} фрагментов...")
     
     try:
-        # Скачиваем файл во временную папку
+        # Скачиваем файл в память, без временного файла на диске
         doc_file = await context.bot.get_file(document.file_id)
+        buffer = io.BytesIO()
+        await doc_file.download_to_memory(buffer)
         
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as tmp_file:
-            temp_path = tmp_file.name
-            await doc_file.download_to_drive(temp_path)
-        
-        # Добавляем в базу знаний
-        result = await add_document_to_knowledge_base(temp_path)
-        
-        # Удаляем временный файл
-        Path(temp_path).unlink()
+        # Добавляем в личную базу знаний пользователя: разбор и эмбеддинг идут параллельно.
+        # getbuffer() отдает содержимое без копии, пока буфер не закрыт
+        data = buffer.getbuffer()
+        try:
+            result = await add_document_bytes_to_knowledge_base(
+                data, source_name=document.file_name, progress=report_progress,
+                namespace=user_namespace(user_id)
+            )
+        finally:
+            # Ошибка освобождения буфера не должна заменить результат загрузки
+            try:
+                data.release()
+                buffer.close()
+            except BufferError as e:
+                logger.warning(f"Буфер документа {document.file_name} не освобожден: {e}")
         
-        if result['success']:
+        if result['success'] and result.get('unchanged'):
+            await update.message.reply_text(
+                f"✅ Документ {document.file_name} уже есть в базе знаний и не изменился.\n"
+                f"📊 Фрагментов: {result['chunks']}"
+            )
+        elif result['success']:
+            failed_text = f"⚠️ Не проиндексировано: {result['failed']}\n" if result.get('failed') else ""
             await update.message.reply_text(
                 f"✅ Документ успешно добавлен!\n\n"
                 f"📄 Файл: {document.file_name}\n"
-                f"📊 Фрагментов: {result['chunks']}\n\n"
+                f"📊 Фрагментов: {result['chunks']} (новых: {result['new']}, удалено: {result['removed']})\n"
+                f"{failed_text}\n"
                 f"Переключитесь в режим RAG командой `/mode rag` для поиска по документам."
             )
             logger.info(f"Документ {document.file_name} добавлен пользователем {user_id}")
@@ -65,3 +103,34 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error(f"Ошибка обработки документа: {e}")
         await update.message.reply_text(f"❌ Произошла ошибка: {str(e)}")
+
+async def answer_about_document(update: Update, context: ContextTypes.DEFAULT_TYPE, document):
+    """Ответ на вопрос из подписи по содержимому документа (без добавления в базу знаний)"""
+    user_id = update.effective_user.id
+    question = update.message.caption
+    
+    await update.message.chat.send_action("typing")
+    
+    try:
+        doc_file = await context.bot.get_file(document.file_id)
+        buffer = io.BytesIO()
+        await doc_file.download_to_memory(buffer)
+        
+        # Тот же файл повторно в Gemini не загружается (реестр по sha256);
+        # MIME-тип определяется по имени файла
+        response = await gemini_client.analyze_document_async(
+            buffer.getvalue(), question, display_name=document.file_name
+        )
+        
+        user_sessions.add_message(user_id, "user", f"[Документ {document.file_name}]: {question}")
+        user_sessions.add_message(user_id, "assistant", response)
+        
+        await split_and_send_message(update, response)
+        logger.info(f"Документ {document.file_name} проанализирован для {user_id}")
+        
+    except GeminiError as e:
+        logger.error(f"Ошибка Gemini при анализе документа: {e}")
+        await update.message.reply_text(e.user_message)
+    except Exception as e:
+        logger.error(f"Ошибка анализа документа: {e}")
+        await update.message.reply_text(f"❌ Ошибка при анализе документа: {str(e)}")
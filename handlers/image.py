@@ -3,6 +3,8 @@ from telegram.ext import ContextTypes
 from utils.session import user_sessions
 from utils.logger import logger
 from services.gemini_client import gemini_client
+from services.image_preprocessor import image_preprocessor
+from services.transport import GeminiError
 import io
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -10,7 +12,7 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     caption = update.message.caption or "Проанализируй это изображение"
     
-    logger.info(f"Изображение от {user_id}: {caption[:50]}...")
+    logger.debug(f"Изображение от {user_id}: {caption[:50]}...")
     
     # Обновляем статистику
     user_sessions.update_stats(user_id, 'images')
@@ -19,20 +21,33 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.chat.send_action("typing")
     
     try:
-        # Получаем самое большое фото
-        photo = update.message.photo[-1]
-        photo_file = await context.bot.get_file(photo.file_id)
-        
-        # Скачиваем изображение в память
-        photo_bytes_io = io.BytesIO()
-        await photo_file.download_to_memory(photo_bytes_io)
-        photo_bytes = photo_bytes_io.getvalue()
+        # Берем самый маленький размер, которого достаточно для анализа
+        photo = image_preprocessor.pick_size(update.message.photo)
         
         # Получаем историю
         history = user_sessions.get_history(user_id)
         
-        # Анализируем изображение
-        response = gemini_client.analyze_image(photo_bytes, caption, history)
+        # То же фото с той же подписью этот пользователь уже присылал - не скачиваем
+        response = await image_preprocessor.cached_analysis(user_id, caption, file_unique_id=photo.file_unique_id)
+        
+        if response is None:
+            photo_file = await context.bot.get_file(photo.file_id)
+            
+            # Скачиваем изображение в память
+            photo_bytes_io = io.BytesIO()
+            await photo_file.download_to_memory(photo_bytes_io)
+            
+            # Сжимаем и проверяем, не анализировался ли уже такой же файл
+            image = await image_preprocessor.prepare(photo_bytes_io.getvalue(), photo.file_unique_id)
+            response = await image_preprocessor.cached_analysis(user_id, caption, image=image)
+            
+            if response is None:
+                # Анализируем изображение
+                route = gemini_client.router.classify(caption, attachment="image")
+                response = await gemini_client.analyze_image_async(
+                    image.data, caption, history, image.mime_type, route=route
+                )
+                await image_preprocessor.store(user_id, image, caption, response)
         
         # Добавляем в историю
         user_sessions.add_message(user_id, "user", f"[Изображение]: {caption}")
@@ -41,8 +56,11 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Отправляем ответ
         await update.message.reply_text(response)
         
-        logger.info(f"Анализ изображения завершен для {user_id}")
+        logger.debug(f"Анализ изображения завершен для {user_id}")
         
+    except GeminiError as e:
+        logger.error(f"Ошибка Gemini при анализе изображения: {e}")
+        await update.message.reply_text(e.user_message)
     except Exception as e:
         logger.error(f"Ошибка обработки изображения: {e}")
         await update.message.reply_text(f"❌ Ошибка при анализе изображения: {str(e)}")
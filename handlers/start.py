@@ -25,6 +25,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /mode - Переключить режим (text/voice/rag)
 /reset - Очистить историю диалога
 /stats - Показать статистику
+/kb - Документы в базе знаний
 /help - Помощь
 
 🔹 **Режимы работы:**
@@ -60,6 +61,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 **Другие команды:**
 • `/reset` - очистить историю
 • `/stats` - статистика использования
+• `/kb` - список документов в базе знаний
+• `/kb delete N` - удалить свой документ номер N
 • `/start` - показать приветствие"""
     
     await update.message.reply_text(help_text)
@@ -79,7 +82,8 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     mode = user_sessions.get_mode(user_id)
     
     from rag.index import vector_index
-    kb_size = vector_index.get_collection_size()
+    from rag.namespaces import search_namespaces
+    kb_stats = vector_index.stats(search_namespaces(user_id))
     
     stats_text = f"""📊 **Статистика**
 
@@ -87,11 +91,60 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 🎤 Голосовых сообщений: {stats['voice']}
 🖼 Изображений: {stats['images']}
 📄 Документов загружено: {stats['documents']}
-📚 Документов в базе знаний: {kb_size}
+📚 Документов в базе знаний: {kb_stats['documents']} ({kb_stats['chunks']} фрагментов)
 🔧 Текущий режим: **{mode}**"""
     
     await update.message.reply_text(stats_text)
 
+async def kb_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /kb - документы базы знаний, /kb delete N - удалить свой документ"""
+    user_id = update.effective_user.id
+    
+    from rag.index import vector_index
+    from rag.namespaces import user_namespace, search_namespaces
+    namespace = user_namespace(user_id)
+    own_documents = vector_index.documents(namespace)
+    
+    if context.args and context.args[0] == "delete":
+        if len(context.args) < 2 or not context.args[1].isdigit():
+            await update.message.reply_text("Укажите номер документа: /kb delete N")
+            return
+        number = int(context.args[1])
+        if not 1 <= number <= len(own_documents):
+            await update.message.reply_text(f"❌ Нет документа с номером {number}. Список: /kb")
+            return
+        
+        from rag.query import delete_document_from_knowledge_base
+        doc_id, document = own_documents[number - 1]
+        removed = await delete_document_from_knowledge_base(namespace, doc_id)
+        logger.info(f"Пользователь {user_id} удалил документ {document['source']} ({removed} чанков)")
+        await update.message.reply_text(f"🗑 Документ {document['source']} удален из базы знаний")
+        return
+    
+    lines = ["📚 **База знаний**", ""]
+    if own_documents:
+        lines.append("Ваши документы:")
+        lines.extend(
+            f"{i}. {document['source']} - {document['chunks']} фрагментов"
+            for i, (_, document) in enumerate(own_documents, 1)
+        )
+    else:
+        lines.append("Ваших документов пока нет - отправьте PDF или TXT файл.")
+    
+    for shared in search_namespaces(user_id)[1:]:
+        shared_documents = vector_index.documents(shared)
+        if shared_documents:
+            lines.extend(["", f"Общие ({shared}):"])
+            lines.extend(
+                f"• {document['source']} - {document['chunks']} фрагментов"
+                for _, document in shared_documents
+            )
+    
+    if own_documents:
+        lines.extend(["", "Удалить документ: /kb delete N"])
+    
+    await update.message.reply_text("\n".join(lines))
+
 async def mode_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /mode - выбор режима с кнопками"""
     user_id = update.effective_user.id
@@ -0,0 +1,134 @@
+"""Потоковая отправка ответов в Telegram с редактированием сообщения"""
+import asyncio
+import time
+from telegram import Message, Update
+from telegram.error import BadRequest, RetryAfter
+from config import STREAM_EDIT_INTERVAL
+from utils.logger import logger
+
+MAX_MESSAGE_LENGTH = 4000
+
+def split_text(text: str, max_length: int = MAX_MESSAGE_LENGTH) -> list:
+    """Разбить текст на части по параграфам, не длиннее max_length"""
+    parts = []
+    current_part = ""
+
+    for paragraph in text.split('\n\n'):
+        # Слишком длинный параграф режем жестко
+        while len(paragraph) > max_length:
+            if current_part:
+                parts.append(current_part.strip())
+                current_part = ""
+            parts.append(paragraph[:max_length])
+            paragraph = paragraph[max_length:]
+
+        if len(current_part) + len(paragraph) + 2 <= max_length:
+            current_part += paragraph + "\n\n"
+        else:
+            if current_part:
+                parts.append(current_part.strip())
+            current_part = paragraph + "\n\n"
+
+    if current_part.strip():
+        parts.append(current_part.strip())
+
+    return parts
+
+class StreamingReply:
+    """Отправляет ответ по мере генерации
+
+    Первый фрагмент отправляется сразу, дальше сообщение редактируется
+    не чаще раза в STREAM_EDIT_INTERVAL секунд. Когда текст превышает
+    MAX_MESSAGE_LENGTH, готовые части фиксируются и вывод продолжается
+    в новом сообщении.
+    """
+
+    def __init__(self, update: Update, edit_interval: float = STREAM_EDIT_INTERVAL,
+                 max_length: int = MAX_MESSAGE_LENGTH):
+        self.update = update
+        self.edit_interval = edit_interval
+        self.max_length = max_length
+
+        self.text = ""                  # Весь полученный текст
+        self._start = 0                 # Начало текущего сообщения в self.text
+        self._message: Message = None   # Текущее сообщение в Telegram
+        self._shown = ""                # Что сейчас видно пользователю
+        self._last_edit = 0.0
+
+        self.started_at = time.monotonic()
+        self.first_token_latency: float = None
+
+    async def feed(self, chunk: str):
+        """Добавить фрагмент ответа"""
+        self.text += chunk
+        current = self.text[self._start:]
+
+        # Переносим переполнение в новые сообщения (split_text оставляет запас
+        # на разделитель). Текущее сообщение хранится как срез исходного текста:
+        # разделители параграфов на границе не теряются
+        if len(current) + 2 > self.max_length:
+            parts = split_text(current, self.max_length)
+            for part in parts[:-1]:
+                await self._show(part, force=True)
+                self._message = None
+                self._shown = ""
+            if len(parts) > 1:
+                # Последняя часть - конец текста (без пробелов по краям)
+                self._start = len(self.text.rstrip()) - len(parts[-1])
+                current = self.text[self._start:]
+
+        await self._show(current)
+
+    async def finish(self) -> str:
+        """Дописать последнее сообщение и вернуть весь текст"""
+        await self._show(self.text[self._start:], force=True)
+        total = time.monotonic() - self.started_at
+        ttft = self.first_token_latency
+        # Время до первого токена - отдельное поле той же INFO-записи, что и общее время
+        logger.info(
+            f"Стриминг завершен: первый токен {ttft or 0:.2f}с, "
+            f"всего {total:.2f}с, {len(self.text)} символов",
+            extra={
+                'latency_ms': round(total * 1000, 1),
+                'ttft_ms': round(ttft * 1000, 1) if ttft is not None else None,
+            }
+        )
+        return self.text
+
+    async def _show(self, text: str, force: bool = False):
+        """Отправить или отредактировать текущее сообщение с учетом троттлинга"""
+        text = text.strip()
+        if not text or text == self._shown:
+            return
+
+        if self._message is None:
+            self._message = await self.update.message.reply_text(text)
+            self._shown = text
+            self._last_edit = time.monotonic()
+            if self.first_token_latency is None:
+                self.first_token_latency = self._last_edit - self.started_at
+            return
+
+        now = time.monotonic()
+        if not force and now - self._last_edit < self.edit_interval:
+            return
+
+        try:
+            await self._message.edit_text(text)
+            self._shown = text
+        except RetryAfter as e:
+            # Превысили лимит редактирований - пропускаем, дошлем позже
+            logger.warning(f"Лимит редактирования сообщений, ждем {e.retry_after}с")
+            if force:
+                await self._wait(e.retry_after)
+                await self._message.edit_text(text)
+                self._shown = text
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+        self._last_edit = time.monotonic()
+
+    @staticmethod
+    async def _wait(retry_after):
+        seconds = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else retry_after
+        await asyncio.sleep(seconds)
@@ -2,63 +2,19 @@ import io
 from telegram import Update
 from telegram.ext import ContextTypes
 from utils.session import user_sessions
-from utils.logger import logger
+from utils.logger import logger, bind_log_context
 from services.gemini_client import gemini_client
 from rag.query import query_knowledge_base
+from rag.namespaces import search_namespaces
+from handlers.streaming import StreamingReply, split_text
+from services.context_builder import context_builder
+from services.answer_cache import answer_cache
+from services.voice_pipeline import voice_pipeline
+from services.transport import GeminiError
 
-async def split_and_send_message(update: Update, text: str, max_length: int = 4000):
-    """Разбивает длинное сообщение на части и отправляет"""
-    if len(text) <= max_length:
-        await update.message.reply_text(text)
-        return
-    
-    # Разбиваем по параграфам
-    parts = []
-    current_part = ""
-    
-    for paragraph in text.split('\n\n'):
-        if len(current_part) + len(paragraph) + 2 <= max_length:
-            current_part += paragraph + "\n\n"
-        else:
-            if current_part:
-                parts.append(current_part.strip())
-            current_part = paragraph + "\n\n"
-    
-    if current_part:
-        parts.append(current_part.strip())
-    
-    # Отправляем части
-    for i, part in enumerate(parts, 1):
-        if len(parts) > 1:
-            await update.message.reply_text(f"📄 Часть {i}/{len(parts)}:\n\n{part}")
-        else:
-            await update.message.reply_text(part)
+MENTOR_PROMPT_KEY = "mentor"
 
-async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка текстовых сообщений"""
-    user_id = update.effective_user.id
-    user_message = update.message.text
-    
-    logger.info(f"Текст от {user_id}: {user_message[:50]}...")
-    
-    # Получаем режим работы
-    mode = user_sessions.get_mode(user_id)
-    
-    # Добавляем сообщение в историю
-    user_sessions.add_message(user_id, "user", user_message)
-    history = user_sessions.get_history(user_id)
-    
-    # Отправляем статус "печатает..."
-    await update.message.chat.send_action("typing")
-    
-    try:
-        # Выбираем способ обработки в зависимости от режима
-        if mode == "rag":
-            # RAG режим - поиск в базе знаний
-            response = await query_knowledge_base(user_message, history[:-1])
-        else:
-            # Обычный текстовый режим
-            system_prompt = """Ты - опытный Python-наставник и код-ревьюер с 10+ летним опытом.
+MENTOR_SYSTEM_PROMPT = """Ты - опытный Python-наставник и код-ревьюер с 10+ летним опытом.
 
 🎯 ТВОЯ РОЛЬ:
 Помогай изучать Python через практику, понятные объяснения и best practices.
@@ -106,39 +62,117 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
 - Ссылайся на официальную документацию когда нужно
 - Показывай примеры из реальной разработки"""
 
+# Статический system prompt регистрируется один раз и кэшируется на стороне Gemini,
+# если он не короче минимума cached content (PROMPT_CACHE_MIN_TOKENS)
+# (при создании клиента, чтобы импорт хендлеров его не создавал)
+gemini_client.on_create(
+    lambda client: client.prompts.register(MENTOR_PROMPT_KEY, MENTOR_SYSTEM_PROMPT)
+)
+
+async def split_and_send_message(update: Update, text: str, max_length: int = 4000):
+    """Разбивает длинное сообщение на части и отправляет"""
+    if len(text) <= max_length:
+        await update.message.reply_text(text)
+        return
+    
+    # Разбиваем по параграфам
+    parts = split_text(text, max_length)
+    
+    # Отправляем части
+    for i, part in enumerate(parts, 1):
+        if len(parts) > 1:
+            await update.message.reply_text(f"📄 Часть {i}/{len(parts)}:\n\n{part}")
+        else:
+            await update.message.reply_text(part)
+
+async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка текстовых сообщений"""
+    user_id = update.effective_user.id
+    user_message = update.message.text
+    
+    logger.debug(f"Текст от {user_id}: {user_message[:50]}...")
+    
+    await answer_message(update, user_id, user_message)
+
+async def answer_message(update: Update, user_id: int, user_message: str):
+    """Ответ на сообщение пользователя в текущем режиме (текст, голос, RAG)
+
+    Используется и для текста, и для расшифрованных голосовых сообщений.
+    """
+    # Получаем режим работы
+    mode = user_sessions.get_mode(user_id)
+    bind_log_context(mode=mode)
+    
+    # Добавляем сообщение в историю
+    user_sessions.add_message(user_id, "user", user_message)
+    history = user_sessions.get_history(user_id)
+    
+    # Отправляем статус "печатает..."
+    await update.message.chat.send_action("typing")
+    
+    try:
+        # Выбираем способ обработки в зависимости от режима
+        if mode == "rag":
+            # RAG режим - поиск в базе знаний
+            # Историю ограничиваем бюджетом модели маршрута: большая часть запроса
+            # уходит на найденный контекст
+            route = gemini_client.router.classify(user_message, "rag")
+            rag_history = context_builder.fit(history[:-1], context_builder.budget_for(route.model) // 3)
+            # Ищем только в документах пользователя и общих курсах
+            response = await query_knowledge_base(user_message, rag_history, search_namespaces(user_id), route)
+        else:
+            # Обычный текстовый (или голосовой) режим.
+            # Частые вопросы ("что такое декоратор") отвечаем из кэша, но только
+            # в начале диалога: в кэше лишь ответы без предыдущего контекста,
+            # а уточнение ("а покажи пример") относится к текущему разговору
+            opening = len(history) == 1
+            response = await answer_cache.lookup(user_message, mode) if opening else None
             
-            response = gemini_client.generate_text(history, system_prompt=system_prompt)
+            if response is not None:
+                await split_and_send_message(update, response)
+            else:
+                # Простые вопросы - быстрой модели, сложные - сильной
+                route = gemini_client.router.classify(user_message, mode)
+                
+                # Последние сообщения в пределах бюджета + краткое содержание старых
+                messages = context_builder.build(user_id, route.model, MENTOR_SYSTEM_PROMPT)
+                
+                # Стримим ответ: пользователь видит текст по мере генерации
+                reply = StreamingReply(update)
+                async for chunk in gemini_client.stream_text_async(messages, prefix=MENTOR_PROMPT_KEY, route=route):
+                    await reply.feed(chunk)
+                response = await reply.finish()
+                
+                # Кэшируем только ответы, не зависящие от предыдущего диалога
+                if opening:
+                    await answer_cache.store(user_message, response, mode)
         
         # Добавляем ответ в историю
         user_sessions.add_message(user_id, "assistant", response)
         
         # Отправляем ответ (текст или голос в зависимости от режима)
         if mode == "voice":
-            # Отправляем текстовую версию (с разбивкой если длинная)
-            await split_and_send_message(update, response)
-            
-            # Генерируем и отправляем аудио
+            # Озвучиваем по фрагментам: первый фрагмент уходит, пока синтезируются остальные
             try:
                 await update.message.chat.send_action("record_voice")
-                audio_data = gemini_client.generate_audio(response)
-                
-                if audio_data and len(audio_data) > 1000:
-                    logger.info(f"Отправка аудио: {len(audio_data)} байт")
-                    await update.message.reply_voice(voice=audio_data)
-                else:
-                    logger.warning(f"Аудио слишком маленькое: {len(audio_data) if audio_data else 0} байт")
-                    await update.message.reply_text("⚠️ Не удалось озвучить (файл поврежден)")
+                sent = await voice_pipeline.speak(update, response)
+
+                if not sent:
+                    logger.warning(f"Не удалось озвучить ответ для {user_id}")
+                    await update.message.reply_text("⚠️ Не удалось озвучить ответ")
             except Exception as e:
-                logger.error(f"Ошибка отправки аудио: {e}")
-                import traceback
-                traceback.print_exc()
+                logger.exception(f"Ошибка отправки аудио: {e}")
                 await update.message.reply_text(f"⚠️ Ошибка озвучки: {str(e)}")
-        else:
-            # Обычный текстовый режим - разбиваем если нужно
+        elif mode == "rag":
+            # RAG режим - разбиваем если нужно (текстовый ответ уже отправлен стримингом)
             await split_and_send_message(update, response)
         
-        logger.info(f"Ответ отправлен пользователю {user_id}")
+        logger.debug(f"Ответ отправлен пользователю {user_id}")
         
+    except GeminiError as e:
+        # Текст ошибки не попадает ни в историю, ни в кэш, ни в озвучку
+        logger.error(f"Ошибка Gemini при ответе {user_id}: {e}")
+        await update.message.reply_text(e.user_message)
     except Exception as e:
         logger.error(f"Ошибка обработки текста: {e}")
         await update.message.reply_text(f"❌ Произошла ошибка: {str(e)}")
@@ -2,14 +2,17 @@ from telegram import Update
 from telegram.ext import ContextTypes
 from utils.session import user_sessions
 from utils.logger import logger
-from services.gemini_client import gemini_client
+from services.transcriber import transcriber
+from services.transport import GeminiError, deadline
+from handlers.text import answer_message
+from config import GEMINI_DEADLINES
 import io
 
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка голосовых сообщений"""
     user_id = update.effective_user.id
     
-    logger.info(f"Голосовое сообщение от {user_id}")
+    logger.debug(f"Голосовое сообщение от {user_id}")
     
     # Обновляем статистику
     user_sessions.update_stats(user_id, 'voice')
@@ -20,28 +23,33 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         # Получаем голосовое сообщение
         voice = update.message.voice
-        voice_file = await context.bot.get_file(voice.file_id)
         
-        # Скачиваем в память
-        voice_bytes_io = io.BytesIO()
-        await voice_file.download_to_memory(voice_bytes_io)
-        voice_bytes = voice_bytes_io.getvalue()
+        async def download() -> bytes:
+            # Скачиваем в память (только если расшифровки еще нет в кэше)
+            voice_file = await context.bot.get_file(voice.file_id)
+            voice_bytes_io = io.BytesIO()
+            await voice_file.download_to_memory(voice_bytes_io)
+            return voice_bytes_io.getvalue()
         
-        # Получаем историю
-        history = user_sessions.get_history(user_id)
+        # Расшифровываем (повторные и пересланные сообщения берутся из кэша);
+        # все куски длинного сообщения и их повторы укладываются в один дедлайн
+        with deadline(GEMINI_DEADLINES["audio"]):
+            transcript = await transcriber.transcribe(voice.file_unique_id, download, voice.duration or 0)
         
-        # Обрабатываем аудио (Gemini распознает и отвечает)
-        response = gemini_client.process_audio(voice_bytes, history)
+        if not transcript:
+            await update.message.reply_text("⚠️ Не удалось разобрать голосовое сообщение")
+            return
         
-        # Добавляем в историю
-        user_sessions.add_message(user_id, "user", "[Голосовое сообщение]")
-        user_sessions.add_message(user_id, "assistant", response)
+        logger.debug(f"Расшифровка от {user_id}: {transcript[:50]}...")
         
-        # Отправляем ответ
-        await update.message.reply_text(response)
+        # Дальше - как обычное текстовое сообщение; в историю попадает расшифровка
+        await answer_message(update, user_id, transcript)
         
-        logger.info(f"Голосовое обработано для {user_id}")
+        logger.debug(f"Голосовое обработано для {user_id}")
         
+    except GeminiError as e:
+        logger.error(f"Ошибка Gemini при расшифровке голоса: {e}")
+        await update.message.reply_text(e.user_message)
     except Exception as e:
         logger.error(f"Ошибка обработки голоса: {e}")
         await update.message.reply_text(f"❌ Ошибка при обработке голоса: {str(e)}")
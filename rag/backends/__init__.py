@@ -0,0 +1,18 @@
+"""Движки векторного хранилища"""
+from pathlib import Path
+from config import CHROMA_DB_DIR, NUMPY_INDEX_DIR
+from rag.backends.base import VectorBackend
+
+def create_backend(name: str, embeddings, path: Path = None) -> VectorBackend:
+    """Создать движок по имени (chroma или numpy)
+
+    path - папка хранилища базы знаний (по умолчанию общее хранилище в DATA_DIR).
+    Импорт ленивый: для numpy не загружается стек ChromaDB.
+    """
+    if name == "chroma":
+        from rag.backends.chroma import ChromaBackend
+        return ChromaBackend(embeddings, path / CHROMA_DB_DIR.name if path else CHROMA_DB_DIR)
+    if name == "numpy":
+        from rag.backends.numpy_index import NumpyBackend
+        return NumpyBackend(path / NUMPY_INDEX_DIR.name if path else NUMPY_INDEX_DIR)
+    raise ValueError(f"Неизвестный движок векторного хранилища: {name}")
@@ -0,0 +1,42 @@
+"""Интерфейс движка векторного хранилища"""
+
+class VectorBackend:
+    """Движок хранения и поиска векторов
+
+    Векторы приходят уже посчитанными (эмбеддинги и их кэш остаются в
+    VectorIndex). Результат поиска - список (Document, score), где score -
+    расстояние: чем меньше, тем ближе.
+
+    namespaces - список пространств (метаданные "namespace"), которыми
+    ограничиваются поиск и подсчет; None - все чанки.
+    """
+
+    name = "base"
+
+    def upsert(self, ids: list, texts: list, embeddings: list, metadatas: list):
+        """Добавить или заменить чанки"""
+        raise NotImplementedError
+
+    def get_by_doc(self, doc_id: str) -> dict:
+        """id -> метаданные всех чанков документа"""
+        raise NotImplementedError
+
+    def update_metadatas(self, ids: list, metadatas: list):
+        """Обновить метаданные без пересчета векторов"""
+        raise NotImplementedError
+
+    def delete(self, ids: list):
+        """Удалить чанки по id"""
+        raise NotImplementedError
+
+    def search(self, vector: list, k: int, namespaces: list = None) -> list:
+        """k ближайших чанков к вектору"""
+        raise NotImplementedError
+
+    def get_all(self) -> tuple:
+        """Все чанки: (ids, texts, metadatas)"""
+        raise NotImplementedError
+
+    def count(self, namespaces: list = None) -> int:
+        """Число чанков в хранилище"""
+        raise NotImplementedError
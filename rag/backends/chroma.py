@@ -0,0 +1,55 @@
+"""Векторное хранилище на ChromaDB"""
+from pathlib import Path
+from langchain_community.vectorstores import Chroma
+from config import CHROMA_DB_DIR
+from rag.backends.base import VectorBackend
+
+class ChromaBackend(VectorBackend):
+    """ChromaDB (SQLite + HNSW) через langchain"""
+
+    name = "chroma"
+
+    def __init__(self, embeddings, path: Path = CHROMA_DB_DIR):
+        self.vectorstore = Chroma(
+            persist_directory=str(path),
+            embedding_function=embeddings
+        )
+        self._collection = self.vectorstore._collection
+
+    def upsert(self, ids, texts, embeddings, metadatas):
+        self._collection.upsert(
+            ids=ids,
+            documents=texts,
+            embeddings=embeddings,
+            metadatas=metadatas
+        )
+
+    def get_by_doc(self, doc_id):
+        result = self._collection.get(where={"doc_id": doc_id}, include=["metadatas"])
+        return dict(zip(result["ids"], result["metadatas"]))
+
+    def update_metadatas(self, ids, metadatas):
+        self._collection.update(ids=ids, metadatas=metadatas)
+
+    def delete(self, ids):
+        self._collection.delete(ids=ids)
+
+    def search(self, vector, k, namespaces=None):
+        return self.vectorstore.similarity_search_by_vector_with_relevance_scores(
+            vector, k=k, filter=self._where(namespaces)
+        )
+
+    def get_all(self):
+        result = self._collection.get(include=["documents", "metadatas"])
+        return result["ids"], result["documents"], result["metadatas"]
+
+    def count(self, namespaces=None):
+        if namespaces is None:
+            return self._collection.count()
+        return len(self._collection.get(where=self._where(namespaces), include=[])["ids"])
+
+    @staticmethod
+    def _where(namespaces):
+        if namespaces is None:
+            return None
+        return {"namespace": {"$in": list(namespaces)}}
@@ -0,0 +1,343 @@
+"""Векторный индекс на NumPy: memory-mapped сегменты + JSON-метаданные"""
+import json
+import threading
+from collections import Counter, defaultdict
+from pathlib import Path
+import numpy as np
+from langchain_core.documents import Document
+from config import NUMPY_INDEX_DIR, NUMPY_INDEX_QUANTIZE, NUMPY_INDEX_MAX_SEGMENTS, NUMPY_INDEX_MAX_DEAD_RATIO
+from rag.backends.base import VectorBackend
+from rag.namespaces import SHARED_NAMESPACE
+from utils.logger import logger
+
+MANIFEST_NAME = "manifest.json"
+
+class Segment:
+    """Неизменяемый блок векторов
+
+    vectors - нормированные векторы (float32 или int8 с масштабом на строку),
+    открываются через mmap. Удаление только помечает строку в alive и в
+    JSON-файле с метаданными. namespaces - номера строк каждого пространства,
+    чтобы поиск читал только строки нужных пространств.
+    """
+    __slots__ = ('name', 'vectors', 'scales', 'records', 'alive', 'namespaces')
+
+    def __init__(self, name: str, vectors: np.ndarray, scales, records: list):
+        self.name = name
+        self.vectors = vectors
+        self.scales = scales
+        self.records = records
+        self.alive = np.array([not record.get("deleted") for record in records], dtype=bool)
+
+        rows_by_namespace = defaultdict(list)
+        for row, record in enumerate(records):
+            rows_by_namespace[namespace_of(record)].append(row)
+        self.namespaces = {
+            namespace: np.array(rows, dtype=np.int64) for namespace, rows in rows_by_namespace.items()
+        }
+
+    def rows_for(self, namespaces):
+        """Строки пространств (None - все строки)"""
+        if namespaces is None:
+            return None
+        parts = [self.namespaces[namespace] for namespace in namespaces if namespace in self.namespaces]
+        if not parts:
+            return np.empty(0, dtype=np.int64)
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def decode(self, rows: np.ndarray) -> np.ndarray:
+        """Векторы строк в float32"""
+        vectors = np.asarray(self.vectors[rows], dtype=np.float32)
+        if self.scales is not None:
+            vectors *= self.scales[rows, None]
+        return vectors
+
+    def scores(self, query: np.ndarray, rows: np.ndarray = None) -> np.ndarray:
+        """Косинусная близость строк (по умолчанию всех) к запросу"""
+        if rows is None:
+            scores = self.vectors @ query
+            return scores * self.scales if self.scales is not None else scores
+        scores = self.vectors[rows] @ query
+        return scores * self.scales[rows] if self.scales is not None else scores
+
+def namespace_of(record: dict) -> str:
+    """Пространство чанка (у старых чанков его нет - общее)"""
+    return record["metadata"].get("namespace", SHARED_NAMESPACE)
+
+class NumpyBackend(VectorBackend):
+    """Индекс в памяти процесса для одного узла
+
+    - каждая запись создает новый сегмент (append-only), файлы только
+      дописываются, векторы читаются через mmap;
+    - поиск - скалярное произведение по всем сегментам и argpartition;
+    - когда сегментов или удаленных строк становится много, сегменты
+      сливаются в один в фоновом потоке.
+    """
+
+    name = "numpy"
+
+    def __init__(self, path: Path = NUMPY_INDEX_DIR, quantize: bool = NUMPY_INDEX_QUANTIZE,
+                 max_segments: int = NUMPY_INDEX_MAX_SEGMENTS,
+                 max_dead_ratio: float = NUMPY_INDEX_MAX_DEAD_RATIO):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.quantize = quantize
+        self.max_segments = max_segments
+        self.max_dead_ratio = max_dead_ratio
+
+        self._lock = threading.RLock()
+        self._segments = []
+        # id -> (сегмент, строка)
+        self._ids = {}
+        # Число живых чанков по пространствам
+        self._namespace_counts = Counter()
+        self._next_segment = 1
+        # Меняется при каждой записи: фоновое слияние не затирает новые изменения
+        self._generation = 0
+        self._compacting = False
+
+        self._load()
+
+    # ---------- API ----------
+
+    def upsert(self, ids, texts, embeddings, metadatas):
+        if not ids:
+            return
+        vectors = self._normalize(np.asarray(embeddings, dtype=np.float32))
+        records = [
+            {"id": chunk_id, "text": text, "metadata": metadata or {}}
+            for chunk_id, text, metadata in zip(ids, texts, metadatas)
+        ]
+
+        with self._lock:
+            segment = self._write_segment(vectors, records)
+            replaced = [self._forget(chunk_id) for chunk_id in ids if chunk_id in self._ids]
+
+            self._segments.append(segment)
+            for row, chunk_id in enumerate(ids):
+                self._remember(chunk_id, segment, row)
+            # Сначала манифест с новым сегментом, затем пометки в старых:
+            # при сбое между ними дубли разрешаются при загрузке
+            self._save_manifest()
+            self._tombstone(replaced)
+            self._generation += 1
+
+        self._maybe_compact()
+
+    def get_by_doc(self, doc_id):
+        with self._lock:
+            return {
+                chunk_id: segment.records[row]["metadata"]
+                for chunk_id, (segment, row) in self._ids.items()
+                if segment.records[row]["metadata"].get("doc_id") == doc_id
+            }
+
+    def update_metadatas(self, ids, metadatas):
+        with self._lock:
+            touched = {}
+            for chunk_id, metadata in zip(ids, metadatas):
+                position = self._ids.get(chunk_id)
+                if position is None:
+                    continue
+                segment, row = position
+                segment.records[row]["metadata"] = metadata
+                touched[segment.name] = segment
+            for segment in touched.values():
+                self._save_records(segment)
+            self._generation += 1
+
+    def delete(self, ids):
+        with self._lock:
+            self._tombstone([self._forget(chunk_id) for chunk_id in ids if chunk_id in self._ids])
+            self._generation += 1
+        self._maybe_compact()
+
+    def search(self, vector, k, namespaces=None):
+        query = self._normalize(np.asarray(vector, dtype=np.float32)[None, :])[0]
+        with self._lock:
+            segments = list(self._segments)
+
+        candidates = []
+        for segment in segments:
+            # Только строки нужных пространств: стоимость зависит от их размера
+            rows = segment.rows_for(namespaces)
+            alive = segment.alive.copy() if rows is None else segment.alive[rows]
+            if not alive.any():
+                continue
+            scores = np.where(alive, segment.scores(query, rows), -np.inf)
+            top_n = min(k, len(scores))
+            for i in np.argpartition(-scores, top_n - 1)[:top_n]:
+                if np.isfinite(scores[i]):
+                    row = int(i) if rows is None else int(rows[i])
+                    candidates.append((float(scores[i]), segment, row))
+
+        candidates.sort(key=lambda item: item[0], reverse=True)
+        return [
+            (Document(page_content=segment.records[row]["text"], metadata=segment.records[row]["metadata"]),
+             1.0 - score)
+            for score, segment, row in candidates[:k]
+        ]
+
+    def get_all(self):
+        with self._lock:
+            positions = list(self._ids.items())
+        return (
+            [chunk_id for chunk_id, _ in positions],
+            [segment.records[row]["text"] for _, (segment, row) in positions],
+            [segment.records[row]["metadata"] for _, (segment, row) in positions],
+        )
+
+    def count(self, namespaces=None):
+        if namespaces is None:
+            return len(self._ids)
+        return sum(self._namespace_counts[namespace] for namespace in namespaces)
+
+    def compact(self):
+        """Слить все сегменты в один и выбросить удаленные строки"""
+        with self._lock:
+            generation = self._generation
+            old_segments = list(self._segments)
+            alive = [segment.alive.copy() for segment in old_segments]
+
+        # Тяжелая часть - без блокировки, поиск и запись продолжают работать
+        live_rows = [np.flatnonzero(mask) for mask in alive]
+        records = [
+            {key: value for key, value in segment.records[row].items() if key != "deleted"}
+            for segment, rows in zip(old_segments, live_rows) for row in rows
+        ]
+        vectors = (
+            np.vstack([segment.decode(rows) for segment, rows in zip(old_segments, live_rows) if len(rows)])
+            if records else None
+        )
+
+        with self._lock:
+            if generation != self._generation:
+                # Пока сливали, индекс изменился - попробуем при следующей записи
+                return False
+            new_segments = [self._write_segment(vectors, records)] if records else []
+            self._segments = list(new_segments)
+            self._ids = {}
+            self._namespace_counts = Counter()
+            for segment in new_segments:
+                for row, record in enumerate(segment.records):
+                    self._remember(record["id"], segment, row)
+            self._save_manifest()
+            self._generation += 1
+
+        for segment in old_segments:
+            self._remove_files(segment.name)
+        logger.info(f"Векторный индекс сжат: {len(old_segments)} сегментов -> {len(new_segments)}, {len(records)} чанков")
+        return True
+
+    # ---------- Хранение ----------
+
+    def _load(self):
+        manifest_path = self.path / MANIFEST_NAME
+        if not manifest_path.exists():
+            return
+
+        manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+        self._next_segment = manifest.get("next_segment", 1)
+        for name in manifest.get("segments", []):
+            segment = self._open_segment(name)
+            self._segments.append(segment)
+            for row, record in enumerate(segment.records):
+                if not segment.alive[row]:
+                    continue
+                if record["id"] in self._ids:
+                    # Более поздний сегмент важнее
+                    previous, previous_row = self._forget(record["id"])
+                    previous.alive[previous_row] = False
+                self._remember(record["id"], segment, row)
+
+        logger.info(f"Векторный индекс загружен: {len(self._segments)} сегментов, {len(self._ids)} чанков")
+
+    def _open_segment(self, name: str) -> Segment:
+        vectors = np.load(self.path / f"{name}.npy", mmap_mode="r")
+        scales_path = self.path / f"{name}.scale.npy"
+        scales = np.load(scales_path) if scales_path.exists() else None
+        records = json.loads((self.path / f"{name}.json").read_text(encoding="utf-8"))
+        return Segment(name, vectors, scales, records)
+
+    def _write_segment(self, vectors: np.ndarray, records: list) -> Segment:
+        name = f"seg-{self._next_segment:06d}"
+        self._next_segment += 1
+
+        scales = None
+        if self.quantize:
+            scales = (np.abs(vectors).max(axis=1) / 127.0).astype(np.float32)
+            scales[scales == 0] = 1.0
+            np.save(self.path / f"{name}.scale.npy", scales)
+            np.save(self.path / f"{name}.npy", np.round(vectors / scales[:, None]).astype(np.int8))
+        else:
+            np.save(self.path / f"{name}.npy", vectors.astype(np.float32))
+
+        segment = Segment(name, np.load(self.path / f"{name}.npy", mmap_mode="r"), scales, records)
+        self._save_records(segment)
+        return segment
+
+    def _save_records(self, segment: Segment):
+        self._write_json(self.path / f"{segment.name}.json", segment.records)
+
+    def _save_manifest(self):
+        self._write_json(self.path / MANIFEST_NAME, {
+            "segments": [segment.name for segment in self._segments],
+            "next_segment": self._next_segment,
+        })
+
+    def _remember(self, chunk_id: str, segment: Segment, row: int):
+        self._ids[chunk_id] = (segment, row)
+        self._namespace_counts[namespace_of(segment.records[row])] += 1
+
+    def _forget(self, chunk_id: str) -> tuple:
+        segment, row = self._ids.pop(chunk_id)
+        self._namespace_counts[namespace_of(segment.records[row])] -= 1
+        return segment, row
+
+    def _tombstone(self, positions: list):
+        touched = {}
+        for segment, row in positions:
+            segment.alive[row] = False
+            segment.records[row]["deleted"] = True
+            touched[segment.name] = segment
+        for segment in touched.values():
+            self._save_records(segment)
+
+    def _maybe_compact(self):
+        with self._lock:
+            if self._compacting:
+                return
+            total = sum(len(segment.records) for segment in self._segments)
+            dead = sum(int((~segment.alive).sum()) for segment in self._segments)
+            if len(self._segments) <= self.max_segments and (not total or dead / total <= self.max_dead_ratio):
+                return
+            self._compacting = True
+
+        threading.Thread(target=self._compact_in_background, name="vector-compaction", daemon=True).start()
+
+    def _compact_in_background(self):
+        try:
+            self.compact()
+        except Exception as e:
+            logger.error(f"Ошибка сжатия векторного индекса: {e}")
+        finally:
+            self._compacting = False
+
+    def _remove_files(self, name: str):
+        for suffix in (".npy", ".scale.npy", ".json"):
+            try:
+                (self.path / f"{name}{suffix}").unlink(missing_ok=True)
+            except OSError as e:
+                logger.warning(f"Не удалось удалить {name}{suffix}: {e}")
+
+    @staticmethod
+    def _write_json(path: Path, data):
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+        tmp_path.replace(path)
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
@@ -0,0 +1,148 @@
+"""Каталог базы знаний: документы и число чанков без обращения к хранилищу"""
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from config import KB_CATALOG_PATH, EMBEDDING_MODEL
+from rag.namespaces import SHARED_NAMESPACE
+from utils.logger import logger
+
+class KnowledgeBaseCatalog:
+    """Сводка по базе знаний в памяти, сохраняемая рядом с индексом
+
+    Обновляется при индексации и удалении документов, поэтому проверка
+    "база пуста?" и статистика ничего не стоят во время запроса.
+    Структура: пространство -> документ -> {source, chunks, updated_at}.
+    """
+
+    def __init__(self, path: Path = KB_CATALOG_PATH):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.loaded = False
+        self.embedding_model = EMBEDDING_MODEL
+        self.backend = None
+        self.updated_at = 0.0
+        self._namespaces = {}
+        self._load()
+
+    def is_current(self, backend: str) -> bool:
+        """Каталог загружен с диска и описывает текущий движок и модель эмбеддингов"""
+        return self.loaded and self.backend == backend and self.embedding_model == EMBEDDING_MODEL
+
+    def set_document(self, namespace: str, doc_id: str, source: str, chunks: int):
+        """Записать документ после индексации"""
+        with self._lock:
+            documents = self._namespaces.setdefault(namespace, {})
+            if chunks > 0:
+                documents[doc_id] = {'source': source, 'chunks': chunks, 'updated_at': time.time()}
+            else:
+                documents.pop(doc_id, None)
+            self._touch()
+
+    def add_chunks(self, metadatas: list):
+        """Учесть новые чанки по их метаданным"""
+        with self._lock:
+            now = time.time()
+            for metadata in metadatas:
+                namespace, doc_id, source = self._describe(metadata)
+                document = self._namespaces.setdefault(namespace, {}).setdefault(
+                    doc_id, {'source': source, 'chunks': 0, 'updated_at': now}
+                )
+                document['chunks'] += 1
+                document['updated_at'] = now
+            self._touch()
+
+    def remove_document(self, namespace: str, doc_id: str):
+        """Удалить документ из каталога"""
+        with self._lock:
+            self._namespaces.get(namespace, {}).pop(doc_id, None)
+            self._touch()
+
+    def namespaces(self) -> list:
+        """Пространства, в которых есть документы"""
+        with self._lock:
+            return [name for name, documents in self._namespaces.items() if documents]
+
+    def count(self, namespaces: list = None) -> int:
+        """Число чанков в пространствах (None - во всех)"""
+        with self._lock:
+            return self._count(list(self._namespaces) if namespaces is None else namespaces)
+
+    def documents(self, namespace: str) -> list:
+        """Документы пространства: список (doc_id, описание), новые первыми"""
+        with self._lock:
+            documents = list(self._namespaces.get(namespace, {}).items())
+        return sorted(documents, key=lambda item: item[1]['updated_at'], reverse=True)
+
+    def stats(self, namespaces: list = None) -> dict:
+        with self._lock:
+            names = list(self._namespaces) if namespaces is None else namespaces
+            return {
+                'chunks': self._count(names),
+                'documents': sum(len(self._namespaces.get(name, {})) for name in names),
+                'updated_at': self.updated_at,
+                'embedding_model': self.embedding_model,
+            }
+
+    def rebuild(self, metadatas: list, backend: str):
+        """Построить каталог заново по метаданным всех чанков хранилища"""
+        with self._lock:
+            self._namespaces = {}
+            self.backend = backend
+            self.embedding_model = EMBEDDING_MODEL
+        self.add_chunks(metadatas)
+        self.loaded = True
+        logger.info(f"Каталог базы знаний построен: {self.stats()}")
+
+    def _count(self, names) -> int:
+        return sum(
+            document['chunks']
+            for name in names
+            for document in self._namespaces.get(name, {}).values()
+        )
+
+    @staticmethod
+    def _describe(metadata: dict) -> tuple:
+        metadata = metadata or {}
+        source = metadata.get('source', 'Unknown')
+        return metadata.get('namespace', SHARED_NAMESPACE), metadata.get('doc_id') or source, source
+
+    def _touch(self):
+        self.updated_at = time.time()
+        self._save()
+
+    def _load(self):
+        try:
+            data = json.loads(self.path.read_text(encoding='utf-8'))
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать каталог базы знаний, он будет построен заново: {e}")
+            return
+
+        self.embedding_model = data.get('embedding_model')
+        self.backend = data.get('backend')
+        self.updated_at = data.get('updated_at', 0.0)
+        self._namespaces = data.get('namespaces', {})
+        self.loaded = True
+
+        if self.embedding_model != EMBEDDING_MODEL:
+            logger.warning(
+                f"База знаний проиндексирована моделью {self.embedding_model}, "
+                f"а сейчас используется {EMBEDDING_MODEL}: документы нужно загрузить заново"
+            )
+
+    def _save(self):
+        try:
+            # Общий каталог могут перестраивать несколько процессов сразу
+            tmp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+            tmp_path.write_text(json.dumps({
+                'embedding_model': self.embedding_model,
+                'backend': self.backend,
+                'updated_at': self.updated_at,
+                'namespaces': self._namespaces,
+            }, ensure_ascii=False), encoding='utf-8')
+            tmp_path.replace(self.path)
+        except Exception as e:
+            logger.error(f"Не удалось сохранить каталог базы знаний: {e}")
@@ -0,0 +1,189 @@
+"""Кэш эмбеддингов: LRU в памяти + SQLite на диске"""
+import hashlib
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import List, Optional
+from langchain_core.embeddings import Embeddings
+from utils.logger import logger
+
+def normalize_text(text: str) -> str:
+    """Нормализация текста для ключа кэша"""
+    text = unicodedata.normalize("NFC", text)
+    return " ".join(text.split())
+
+class EmbeddingCache:
+    """Постоянный кэш эмбеддингов
+
+    Ключ - sha256 от (модель, тип эмбеддинга, нормализованный текст).
+    Горячие записи держатся в LRU в памяти, все остальные - в SQLite.
+    При превышении max_entries удаляются давно не использованные записи.
+    """
+
+    def __init__(self, path, memory_size: int = 2048, max_entries: int = 200_000):
+        self.memory_size = memory_size
+        self.max_entries = max_entries
+        self._memory: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY,"
+            " vector BLOB NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_embeddings_access ON embeddings(last_access)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model: str, kind: str, text: str) -> str:
+        payload = f"{model}\x00{kind}\x00{normalize_text(text)}".encode("utf-8")
+        return hashlib.sha256(payload).hexdigest()
+
+    def get_many(self, keys: List[str]) -> List[Optional[List[float]]]:
+        """Получить векторы по ключам (None для отсутствующих)"""
+        results: List[Optional[List[float]]] = [None] * len(keys)
+        disk_lookup = {}
+
+        with self._lock:
+            for i, key in enumerate(keys):
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    results[i] = vector
+                else:
+                    disk_lookup.setdefault(key, []).append(i)
+
+            if disk_lookup:
+                found = self._load(list(disk_lookup))
+                for key, vector in found.items():
+                    for i in disk_lookup[key]:
+                        results[i] = vector
+                    self._remember(key, vector)
+
+            hits = sum(1 for vector in results if vector is not None)
+            self.hits += hits
+            self.misses += len(keys) - hits
+
+        return results
+
+    def put_many(self, keys: List[str], vectors: List[List[float]]):
+        """Сохранить векторы в кэш"""
+        now = time.time()
+        rows = [(key, array("f", vector).tobytes(), now) for key, vector in zip(keys, vectors)]
+
+        with self._lock:
+            for key, vector in zip(keys, vectors):
+                self._remember(key, list(vector))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_access) VALUES (?, ?, ?)",
+                rows
+            )
+            self._conn.commit()
+            self._evict()
+
+    def stats(self) -> dict:
+        """Счетчики попаданий"""
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'memory_items': len(self._memory),
+        }
+
+    def _remember(self, key: str, vector: List[float]):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _load(self, keys: List[str]) -> dict:
+        found = {}
+        # SQLite ограничивает число параметров в запросе
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            rows = self._conn.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                batch
+            ).fetchall()
+            for key, blob in rows:
+                vector = array("f")
+                vector.frombytes(blob)
+                found[key] = vector.tolist()
+
+        if found:
+            now = time.time()
+            self._conn.executemany(
+                "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                [(now, key) for key in found]
+            )
+            self._conn.commit()
+        return found
+
+    def _evict(self):
+        """Удалить самые старые записи при превышении лимита"""
+        count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if count <= self.max_entries:
+            return
+
+        # Удаляем с запасом, чтобы не чистить на каждой записи
+        to_delete = count - int(self.max_entries * 0.9)
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE key IN ("
+            " SELECT key FROM embeddings ORDER BY last_access ASC LIMIT ?)",
+            (to_delete,)
+        )
+        self._conn.commit()
+        logger.info(f"Кэш эмбеддингов: удалено {to_delete} старых записей")
+
+class CachedEmbeddings(Embeddings):
+    """Обертка над Embeddings, которая сначала смотрит в кэш"""
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, model: str):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = model
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self.cache.make_key(self.model, "document", text) for text in texts]
+        vectors = self.cache.get_many(keys)
+
+        # Одинаковые тексты внутри батча считаем один раз
+        missing = {}
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                missing.setdefault(keys[i], []).append(i)
+
+        if missing:
+            missing_keys = list(missing)
+            computed = self.embeddings.embed_documents([texts[missing[key][0]] for key in missing_keys])
+            self.cache.put_many(missing_keys, computed)
+            for key, vector in zip(missing_keys, computed):
+                for i in missing[key]:
+                    vectors[i] = list(vector)
+
+        logger.debug(
+            f"Эмбеддинги документов: {len(texts)} текстов, "
+            f"{len(missing)} вычислено"
+        )
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self.cache.make_key(self.model, "query", text)
+        vector = self.cache.get_many([key])[0]
+        if vector is None:
+            vector = list(self.embeddings.embed_query(text))
+            self.cache.put_many([key], [vector])
+        return vector
@@ -0,0 +1,60 @@
+"""Отпечатки документов и чанков для инкрементальной индексации"""
+import hashlib
+from collections import Counter
+from rag.namespaces import SHARED_NAMESPACE
+
+def file_fingerprint(file_path: str) -> str:
+    """sha256 содержимого файла"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def document_id(source_name: str, namespace: str = SHARED_NAMESPACE) -> str:
+    """Стабильный идентификатор документа по его имени и пространству
+
+    Для общего пространства id совпадает с прежним (только по имени),
+    поэтому ранее загруженные документы распознаются при повторной загрузке.
+    """
+    key = source_name if namespace == SHARED_NAMESPACE else f"{namespace}\x00{source_name}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+
+def chunk_fingerprint(text: str) -> str:
+    """Отпечаток содержимого чанка"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:32]
+
+def bytes_fingerprint(data) -> str:
+    """sha256 содержимого буфера (bytes, bytearray или memoryview)"""
+    return hashlib.sha256(data).hexdigest()
+
+class ChunkTagger:
+    """Проставляет чанкам метаданные с отпечатками по мере их появления
+
+    id чанка зависит только от документа и содержимого чанка, поэтому
+    неизмененные чанки при повторной загрузке получают те же id.
+    """
+
+    def __init__(self, source_name: str, doc_fingerprint: str, namespace: str = SHARED_NAMESPACE):
+        self.source_name = source_name
+        self.namespace = namespace
+        self.doc_id = document_id(source_name, namespace)
+        self.doc_fingerprint = doc_fingerprint
+        self._seen = Counter()
+
+    def tag(self, chunk) -> str:
+        fingerprint = chunk_fingerprint(chunk.page_content)
+        # Одинаковые чанки внутри документа различаем по номеру вхождения
+        occurrence = self._seen[fingerprint]
+        self._seen[fingerprint] += 1
+
+        chunk_id = f"{self.doc_id}:{fingerprint}:{occurrence}"
+        chunk.metadata.update({
+            'source': self.source_name,
+            'doc_id': self.doc_id,
+            'doc_fingerprint': self.doc_fingerprint,
+            'chunk_fingerprint': fingerprint,
+            'chunk_id': chunk_id,
+            'namespace': self.namespace,
+        })
+        return chunk_id
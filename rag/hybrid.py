@@ -0,0 +1,50 @@
+"""Слияние результатов поиска (RRF) и выбор разнообразных чанков (MMR)"""
+from config import RAG_RRF_K
+from rag.keyword_index import tokenize
+
+def chunk_key(doc) -> str:
+    """Ключ чанка для слияния результатов разных поисков"""
+    return doc.metadata.get("chunk_id") or doc.page_content
+
+def reciprocal_rank_fusion(result_lists: list, k: int = RAG_RRF_K) -> list:
+    """Reciprocal Rank Fusion: score = сумма 1 / (k + место) по всем спискам
+
+    Не зависит от шкал исходных score (расстояние у векторов, BM25 у слов).
+    Возвращает список (Document, score) по убыванию score.
+    """
+    fused = {}
+    for results in result_lists:
+        for rank, (doc, _) in enumerate(results, 1):
+            key = chunk_key(doc)
+            entry = fused.setdefault(key, [doc, 0.0])
+            entry[1] += 1.0 / (k + rank)
+    return sorted((tuple(entry) for entry in fused.values()), key=lambda item: item[1], reverse=True)
+
+def maximal_marginal_relevance(candidates: list, top_k: int, lambda_: float) -> list:
+    """Выбрать top_k чанков, балансируя релевантность и разнообразие
+
+    Похожесть чанков - доля общих токенов (Jaccard), векторы не нужны.
+    lambda_ = 1 - только релевантность.
+    """
+    if lambda_ >= 1 or len(candidates) <= top_k:
+        return candidates[:top_k]
+
+    best_score = candidates[0][1] or 1.0
+    tokens = [set(tokenize(doc.page_content)) for doc, _ in candidates]
+    selected = []
+    remaining = list(range(len(candidates)))
+
+    while remaining and len(selected) < top_k:
+        def mmr_score(i):
+            relevance = candidates[i][1] / best_score
+            redundancy = max(
+                (len(tokens[i] & tokens[j]) / (len(tokens[i] | tokens[j]) or 1) for j in selected),
+                default=0.0
+            )
+            return lambda_ * relevance - (1 - lambda_) * redundancy
+
+        best = max(remaining, key=mmr_score)
+        selected.append(best)
+        remaining.remove(best)
+
+    return [candidates[i] for i in selected]
@@ -1,56 +1,402 @@
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
-from langchain_community.vectorstores import Chroma
-from config import GEMINI_API_KEY, CHROMA_DB_DIR
+import threading
+import uuid
+from pathlib import Path
+from config import (
+    GEMINI_API_KEY, EMBEDDING_MODEL, EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MEMORY_ITEMS,
+    EMBEDDING_CACHE_MAX_ENTRIES, VECTOR_BACKEND, DATA_DIR, KEYWORD_INDEX_PATH, KB_CATALOG_PATH,
+    KB_SHARDS, KB_SHARDS_DIR, WORKER_COUNT, RAG_EMBED_BATCH_SIZE
+)
+from rag.backends import create_backend
+from rag.catalog import KnowledgeBaseCatalog
+from rag.keyword_index import KeywordIndex
+from rag.namespaces import SHARED_NAMESPACE, namespace_shard
+from utils.lazy import LazyProvider
 from utils.logger import logger
 
 class VectorIndex:
-    """Векторное хранилище для RAG"""
+    """Одно хранилище базы знаний в папке path
+
+    Эмбеддинги (с кэшем) считает общий для всех хранилищ embeddings, а
+    хранение и поиск выполняет движок из rag/backends (VECTOR_BACKEND:
+    chroma или numpy). Рядом поддерживается индекс BM25 для поиска по
+    точным словам.
     
-    def __init__(self):
-        try:
-            # Инициализируем embeddings через Gemini
-            self.embeddings = GoogleGenerativeAIEmbeddings(
-                model="models/embedding-001",
-                google_api_key=GEMINI_API_KEY
-            )
-            
-            # Инициализируем ChromaDB
-            self.vectorstore = Chroma(
-                persist_directory=str(CHROMA_DB_DIR),
-                embedding_function=self.embeddings
-            )
-            
-            logger.info("Векторное хранилище инициализировано")
-            
-        except Exception as e:
-            logger.error(f"Ошибка инициализации векторного хранилища: {e}")
-            raise
+    Чанки разделены по пространствам (метаданные "namespace"): поиск и
+    подсчет ограничиваются пространствами, переданными в namespaces.
+    
+    Число чанков и список документов берутся из каталога в памяти
+    (rag/catalog.py), а не из хранилища.
+    """
+    
+    def __init__(self, path: Path, embeddings, backend: str = VECTOR_BACKEND):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.embeddings = embeddings
+        
+        # Движок хранения и поиска
+        self.backend = create_backend(backend, embeddings, self.path)
+        
+        # Индекс BM25 обновляется вместе с векторным хранилищем
+        self.keywords = KeywordIndex(self.path / KEYWORD_INDEX_PATH.name)
+        
+        # Каталог документов; хранилище читается целиком, только если
+        # каталога нет или он построен для другого движка
+        self.catalog = KnowledgeBaseCatalog(self.path / KB_CATALOG_PATH.name)
+        if not self.catalog.is_current(self.backend.name) or (
+            self.catalog.count() > 0 and self.keywords.count() == 0
+        ):
+            self._migrate()
+        
+        # Версия содержимого: меняется при каждом добавлении/удалении чанков
+        self.version = 0
+        
+        logger.info(f"Хранилище базы знаний {self.path} открыто ({self.backend.name})")
+    
+    def _migrate(self):
+        """Привести старые данные к текущей схеме и построить каталог"""
+        ids, texts, metadatas = self.backend.get_all()
+        
+        # Документы, загруженные до разделения на пространства, становятся общими
+        legacy = [i for i, meta in enumerate(metadatas) if not (meta or {}).get("namespace")]
+        if legacy:
+            for i in legacy:
+                metadatas[i] = {**(metadatas[i] or {}), "namespace": SHARED_NAMESPACE}
+            self.backend.update_metadatas([ids[i] for i in legacy], [metadatas[i] for i in legacy])
+            logger.info(f"Чанков перенесено в общее пространство: {len(legacy)}")
+        
+        # Документы, загруженные до появления BM25
+        if ids and (self.keywords.count() == 0 or legacy):
+            self.keywords.rebuild(ids, texts, metadatas)
+        
+        self.catalog.rebuild(metadatas, self.backend.name)
     
     def add_documents(self, documents):
         """Добавить документы в хранилище"""
         try:
-            self.vectorstore.add_documents(documents)
+            ids = [doc.metadata.get("chunk_id") or str(uuid.uuid4()) for doc in documents]
+            texts = [doc.page_content for doc in documents]
+            metadatas = [doc.metadata for doc in documents]
+            self.backend.upsert(ids, texts, self.embeddings.embed_documents(texts), metadatas)
+            self.keywords.add(ids, texts, metadatas)
+            self.catalog.add_chunks(metadatas)
+            self.version += 1
             logger.info(f"Добавлено {len(documents)} документов в векторное хранилище")
+            logger.info(f"Кэш эмбеддингов: {self.embeddings.cache.stats()}")
         except Exception as e:
             logger.error(f"Ошибка добавления документов: {e}")
             raise
     
-    def similarity_search(self, query: str, k: int = 3):
+    def add_embeddings(self, ids, texts, embeddings, metadatas):
+        """Записать готовые эмбеддинги в хранилище одним запросом
+
+        Батч сразу учитывается в каталоге: если загрузка документа прервется,
+        уже записанные чанки будут видны в статистике и удалятся вместе
+        с документом.
+        """
+        try:
+            self.backend.upsert(ids, texts, embeddings, metadatas)
+            try:
+                self.keywords.add(ids, texts, metadatas)
+            except Exception:
+                # Батч не должен остаться в векторах без BM25 и каталога
+                self.backend.delete(ids)
+                raise
+            self.catalog.add_chunks(metadatas)
+            self.version += 1
+            logger.debug(f"Записано {len(ids)} чанков в векторное хранилище")
+        except Exception as e:
+            logger.error(f"Ошибка записи эмбеддингов: {e}")
+            raise
+    
+    def get_document_chunks(self, doc_id: str) -> dict:
+        """Получить id и метаданные всех чанков документа"""
+        return self.backend.get_by_doc(doc_id)
+    
+    def update_metadatas(self, ids, metadatas):
+        """Обновить метаданные чанков без пересчета эмбеддингов"""
+        if ids:
+            self.backend.update_metadatas(ids, metadatas)
+            self.keywords.update_metadatas(ids, metadatas)
+    
+    def delete_chunks(self, ids):
+        """Удалить чанки по id"""
+        if ids:
+            self.backend.delete(ids)
+            self.keywords.delete(ids)
+            self.version += 1
+            logger.info(f"Удалено {len(ids)} чанков из векторного хранилища")
+    
+    def record_document(self, namespace: str, doc_id: str, source: str, chunks: int):
+        """Записать в каталог документ после (пере)индексации"""
+        self.catalog.set_document(namespace, doc_id, source, chunks)
+    
+    def delete_document(self, namespace: str, doc_id: str) -> int:
+        """Удалить документ целиком, вернуть число удаленных чанков"""
+        ids = list(self.get_document_chunks(doc_id))
+        self.delete_chunks(ids)
+        self.catalog.remove_document(namespace, doc_id)
+        return len(ids)
+    
+    def similarity_search(self, query: str, k: int = 3, namespaces: list = None):
         """Поиск похожих документов"""
         try:
-            results = self.vectorstore.similarity_search_with_score(query, k=k)
+            # Эмбеддинг запроса берется из кэша, если такой вопрос уже был
+            vector = self.embeddings.embed_query(query)
+        except Exception as e:
+            logger.error(f"Ошибка поиска: {e}")
+            return []
+        return self.vector_search(vector, k, namespaces)
+    
+    def vector_search(self, vector: list, k: int = 3, namespaces: list = None):
+        """Поиск похожих документов по готовому эмбеддингу запроса"""
+        try:
+            results = self.backend.search(vector, k, namespaces)
             logger.debug(f"Найдено {len(results)} релевантных документов")
             return results
         except Exception as e:
             logger.error(f"Ошибка поиска: {e}")
             return []
     
-    def get_collection_size(self) -> int:
-        """Получить количество документов в хранилище"""
+    def keyword_search(self, query: str, k: int = 3, namespaces: list = None):
+        """Поиск по словам (BM25): находит точные имена функций и тексты ошибок"""
+        try:
+            results = self.keywords.search(query, k, namespaces)
+            logger.debug(f"BM25: найдено {len(results)} документов")
+            return results
+        except Exception as e:
+            logger.error(f"Ошибка поиска BM25: {e}")
+            return []
+    
+    def get_collection_size(self, namespaces: list = None) -> int:
+        """Количество чанков в хранилище (в пространствах namespaces или всего) по каталогу"""
+        return self.catalog.count(namespaces)
+
+class ShardedVectorIndex:
+    """База знаний: общее хранилище и части с личными документами
+
+    Общие пространства (shared, курсы) лежат в одном хранилище в DATA_DIR,
+    личные документы пользователя - в части user_id % KB_SHARDS
+    (KB_SHARDS_DIR/NN). Число частей не зависит от числа процессов: в режиме
+    webhook каждую часть обслуживает один обработчик, и при изменении
+    WEBHOOK_WORKERS части просто достаются другим процессам. Части
+    открываются при первом обращении.
+
+    Операции с чанками получают пространство: по нему выбирается хранилище.
+    Поиск по нескольким хранилищам объединяет их результаты по score.
+    """
+
+    def __init__(self, backend: str = VECTOR_BACKEND, shards: int = KB_SHARDS, shards_dir: Path = KB_SHARDS_DIR):
         try:
-            return self.vectorstore._collection.count()
-        except:
-            return 0
+            # LangChain импортируется только при создании хранилища
+            from langchain_google_genai import GoogleGenerativeAIEmbeddings
+            from rag.embedding_cache import EmbeddingCache, CachedEmbeddings
+
+            # Инициализируем embeddings через Gemini
+            base_embeddings = GoogleGenerativeAIEmbeddings(
+                model=EMBEDDING_MODEL,
+                google_api_key=GEMINI_API_KEY
+            )
+
+            # Повторные тексты (чанки и запросы) берутся из кэша
+            self.embedding_cache = EmbeddingCache(
+                EMBEDDING_CACHE_PATH,
+                memory_size=EMBEDDING_CACHE_MEMORY_ITEMS,
+                max_entries=EMBEDDING_CACHE_MAX_ENTRIES
+            )
+            self.embeddings = CachedEmbeddings(base_embeddings, self.embedding_cache, EMBEDDING_MODEL)
+
+            self.backend_name = backend
+            self.shards = shards
+            self.shards_dir = Path(shards_dir)
+            self._lock = threading.Lock()
+            self._shards = {}
+
+            self.shared = VectorIndex(DATA_DIR, self.embeddings, backend)
+            self._check_personal_documents()
+
+            logger.info(f"Векторное хранилище инициализировано ({backend}, частей с личными документами: {shards})")
+
+        except Exception as e:
+            logger.error(f"Ошибка инициализации векторного хранилища: {e}")
+            raise
+
+    # ---------- Хранилища ----------
+
+    def shard(self, number: int) -> VectorIndex:
+        """Часть с личными документами (открывается при первом обращении)"""
+        store = self._shards.get(number)
+        if store is not None:
+            return store
+
+        with self._lock:
+            store = self._shards.get(number)
+            if store is None:
+                store = VectorIndex(self.shards_dir / f"{number:02d}", self.embeddings, self.backend_name)
+                self._shards[number] = store
+            return store
+
+    def store_for(self, namespace: str) -> VectorIndex:
+        """Хранилище пространства"""
+        number = namespace_shard(namespace, self.shards)
+        return self.shared if number is None else self.shard(number)
+
+    def _stores(self, namespaces: list = None) -> list:
+        """Хранилища с их пространствами: [(хранилище, namespaces)]
+
+        None - все пространства: общее хранилище и уже созданные части.
+        """
+        if namespaces is None:
+            stores = [(self.shared, None)]
+            for number in range(self.shards):
+                if (self.shards_dir / f"{number:02d}").exists():
+                    stores.append((self.shard(number), None))
+            return stores
+
+        groups = {}
+        for namespace in namespaces:
+            groups.setdefault(self.store_for(namespace), []).append(namespace)
+        return list(groups.items())
+
+    @property
+    def version(self) -> int:
+        """Версия содержимого: меняется при каждом добавлении/удалении чанков"""
+        return self.shared.version + sum(store.version for store in list(self._shards.values()))
+
+    # ---------- Запись ----------
+
+    def add_documents(self, documents):
+        """Добавить документы в хранилища их пространств"""
+        groups = {}
+        for doc in documents:
+            groups.setdefault(self.store_for(doc.metadata.get("namespace", SHARED_NAMESPACE)), []).append(doc)
+        for store, group in groups.items():
+            store.add_documents(group)
+
+    def add_embeddings(self, ids, texts, embeddings, metadatas):
+        """Записать готовые эмбеддинги в хранилища их пространств"""
+        groups = {}
+        for i, metadata in enumerate(metadatas):
+            groups.setdefault(self.store_for(metadata.get("namespace", SHARED_NAMESPACE)), []).append(i)
+        for store, rows in groups.items():
+            store.add_embeddings(
+                [ids[i] for i in rows], [texts[i] for i in rows],
+                [embeddings[i] for i in rows], [metadatas[i] for i in rows]
+            )
+
+    def get_document_chunks(self, namespace: str, doc_id: str) -> dict:
+        """Получить id и метаданные всех чанков документа"""
+        return self.store_for(namespace).get_document_chunks(doc_id)
+
+    def update_metadatas(self, namespace: str, ids, metadatas):
+        """Обновить метаданные чанков без пересчета эмбеддингов"""
+        self.store_for(namespace).update_metadatas(ids, metadatas)
+
+    def delete_chunks(self, namespace: str, ids):
+        """Удалить чанки по id"""
+        self.store_for(namespace).delete_chunks(ids)
+
+    def record_document(self, namespace: str, doc_id: str, source: str, chunks: int):
+        """Записать в каталог документ после (пере)индексации"""
+        self.store_for(namespace).record_document(namespace, doc_id, source, chunks)
+
+    def delete_document(self, namespace: str, doc_id: str) -> int:
+        """Удалить документ целиком, вернуть число удаленных чанков"""
+        return self.store_for(namespace).delete_document(namespace, doc_id)
+
+    # ---------- Поиск и каталог ----------
+
+    def similarity_search(self, query: str, k: int = 3, namespaces: list = None):
+        """Поиск похожих документов (score - расстояние, меньше - ближе)"""
+        stores = self._stores(namespaces)
+        if len(stores) == 1:
+            store, names = stores[0]
+            return store.similarity_search(query, k, names)
+
+        try:
+            vector = self.embeddings.embed_query(query)
+        except Exception as e:
+            logger.error(f"Ошибка поиска: {e}")
+            return []
+        results = [result for store, names in stores for result in store.vector_search(vector, k, names)]
+        return sorted(results, key=lambda item: item[1])[:k]
+
+    def keyword_search(self, query: str, k: int = 3, namespaces: list = None):
+        """Поиск по словам (BM25, больше score - лучше)"""
+        results = [result for store, names in self._stores(namespaces) for result in store.keyword_search(query, k, names)]
+        return sorted(results, key=lambda item: item[1], reverse=True)[:k]
+
+    def get_collection_size(self, namespaces: list = None) -> int:
+        """Количество чанков в пространствах namespaces (или всего) по каталогам"""
+        return sum(store.get_collection_size(names) for store, names in self._stores(namespaces))
+
+    def documents(self, namespace: str) -> list:
+        """Документы пространства: список (doc_id, описание), новые первыми"""
+        return self.store_for(namespace).catalog.documents(namespace)
+
+    def stats(self, namespaces: list = None) -> dict:
+        stores = [store.catalog.stats(names) for store, names in self._stores(namespaces)]
+        return {
+            'chunks': sum(stats['chunks'] for stats in stores),
+            'documents': sum(stats['documents'] for stats in stores),
+            'updated_at': max(stats['updated_at'] for stats in stores),
+            'embedding_model': EMBEDDING_MODEL,
+        }
+
+    # ---------- Перенос личных документов ----------
+
+    def _check_personal_documents(self):
+        """Личные документы, загруженные до разделения на части, переносятся в свои части"""
+        personal = [name for name in self.shared.catalog.namespaces() if namespace_shard(name, self.shards) is not None]
+        if not personal:
+            return
+        if WORKER_COUNT > 1:
+            # Общее хранилище открыто всеми обработчиками - переносить можно только при остановленном боте
+            logger.warning(
+                f"В общем хранилище личные документы {len(personal)} пользователей: они не видны, "
+                f"пока не перенесены (python scripts/migrate_kb_shards.py при остановленном боте)"
+            )
+            return
+        try:
+            self.move_personal_documents(self.shared)
+        except Exception as e:
+            # Повторится при следующем запуске; до тех пор документы не видны
+            logger.error(f"Не удалось перенести личные документы в части базы знаний: {e}")
+
+    def move_personal_documents(self, source: VectorIndex) -> int:
+        """Перенести чанки из source в хранилища их пространств, вернуть число перенесенных
+
+        Векторы берутся из кэша эмбеддингов (или считаются заново). Документ
+        удаляется из source только после записи в новое хранилище, поэтому
+        прерванный перенос можно повторить.
+        """
+        ids, texts, metadatas = source.backend.get_all()
+        documents = {}
+        for i, metadata in enumerate(metadatas):
+            metadata = metadata or {}
+            namespace = metadata.get("namespace", SHARED_NAMESPACE)
+            if self.store_for(namespace) is source:
+                continue
+            doc_id = metadata.get("doc_id") or metadata.get("source", "Unknown")
+            documents.setdefault((namespace, doc_id), []).append(i)
+
+        moved = 0
+        for (namespace, doc_id), rows in documents.items():
+            target = self.store_for(namespace)
+            for start in range(0, len(rows), RAG_EMBED_BATCH_SIZE):
+                batch = rows[start:start + RAG_EMBED_BATCH_SIZE]
+                batch_texts = [texts[i] for i in batch]
+                target.add_embeddings(
+                    [ids[i] for i in batch], batch_texts,
+                    self.embeddings.embed_documents(batch_texts), [metadatas[i] for i in batch]
+                )
+            source_name = (metadatas[rows[0]] or {}).get("source", "Unknown")
+            target.record_document(namespace, doc_id, source_name, len(rows))
+            source.delete_chunks([ids[i] for i in rows])
+            source.catalog.remove_document(namespace, doc_id)
+            moved += len(rows)
+
+        logger.info(f"Личные документы перенесены из {source.path}: {len(documents)} документов, {moved} чанков")
+        return moved
 
-# Глобальный экземпляр
-vector_index = VectorIndex()
+# Глобальный экземпляр (создается при первом обращении)
+vector_index = LazyProvider(ShardedVectorIndex, "vector_index")
@@ -0,0 +1,138 @@
+"""Пайплайн загрузки чанков в векторное хранилище"""
+import asyncio
+import time
+import uuid
+from dataclasses import dataclass
+from typing import AsyncIterable, Awaitable, Callable, List, Optional
+from config import RAG_EMBED_BATCH_SIZE, RAG_EMBED_CONCURRENCY, RAG_EMBED_MAX_RETRIES
+from utils.logger import logger
+
+ProgressCallback = Callable[[int, Optional[int]], Awaitable[None]]
+
+@dataclass
+class IngestionStats:
+    """Результат загрузки"""
+    total: int = 0
+    indexed: int = 0
+    failed: int = 0
+    batches: int = 0
+    retries: int = 0
+    seconds: float = 0.0
+
+    @property
+    def chunks_per_second(self) -> float:
+        return self.indexed / self.seconds if self.seconds else 0.0
+
+class IngestionPipeline:
+    """Эмбеддинг чанков батчами с ограниченной параллельностью
+
+    Каждый батч эмбеддится отдельно и сразу записывается в хранилище,
+    упавшие батчи повторяются с экспоненциальной задержкой, остальные
+    при этом не пересчитываются.
+    """
+
+    def __init__(self, index, batch_size: int = RAG_EMBED_BATCH_SIZE,
+                 concurrency: int = RAG_EMBED_CONCURRENCY,
+                 max_retries: int = RAG_EMBED_MAX_RETRIES):
+        self.index = index
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+
+    async def run(self, chunks: List, progress: Optional[ProgressCallback] = None) -> IngestionStats:
+        """Проиндексировать список чанков"""
+        async def iterate():
+            for chunk in chunks:
+                yield chunk
+
+        return await self.run_stream(iterate(), progress=progress, total=len(chunks))
+
+    async def run_stream(self, chunks: AsyncIterable, progress: Optional[ProgressCallback] = None,
+                         total: Optional[int] = None) -> IngestionStats:
+        """Проиндексировать чанки по мере их поступления
+
+        Батч отправляется на эмбеддинг, как только набран, а чтение следующих
+        чанков приостанавливается, пока заняты все слоты - так в памяти
+        одновременно находится не больше concurrency батчей.
+        total - общее число чанков, если известно заранее (иначе в progress передается None).
+        """
+        stats = IngestionStats(total=total or 0)
+        started = time.monotonic()
+
+        slots = asyncio.Semaphore(self.concurrency)
+        write_lock = asyncio.Lock()
+        tasks = []
+
+        async def process(batch):
+            try:
+                vectors = await self._embed_with_retry(batch, stats)
+            finally:
+                slots.release()
+            if vectors is None:
+                stats.failed += len(batch)
+                return
+
+            # Запись в хранилище - по одному батчу за раз
+            async with write_lock:
+                await asyncio.to_thread(
+                    self.index.add_embeddings,
+                    ids=[doc.metadata.get('chunk_id') or str(uuid.uuid4()) for doc in batch],
+                    texts=[doc.page_content for doc in batch],
+                    embeddings=vectors,
+                    metadatas=[doc.metadata for doc in batch],
+                )
+                stats.indexed += len(batch)
+
+            if progress:
+                try:
+                    await progress(stats.indexed + stats.failed, total)
+                except Exception as e:
+                    logger.warning(f"Ошибка отправки прогресса: {e}")
+
+        async def submit(batch):
+            await slots.acquire()
+            stats.batches += 1
+            tasks.append(asyncio.create_task(process(batch)))
+
+        try:
+            batch = []
+            async for chunk in chunks:
+                if total is None:
+                    stats.total += 1
+                batch.append(chunk)
+                if len(batch) >= self.batch_size:
+                    await submit(batch)
+                    batch = []
+            if batch:
+                await submit(batch)
+        finally:
+            # Дожидаемся уже запущенных батчей даже при ошибке чтения
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+        stats.seconds = time.monotonic() - started
+        logger.info(
+            f"Индексация: {stats.indexed}/{stats.total} чанков за {stats.seconds:.1f}с "
+            f"({stats.chunks_per_second:.1f} чанков/с, батчей {stats.batches}, "
+            f"повторов {stats.retries}, ошибок {stats.failed})"
+        )
+        return stats
+
+    async def _embed_with_retry(self, batch: List, stats: IngestionStats):
+        """Эмбеддинг одного батча с повторами"""
+        texts = [doc.page_content for doc in batch]
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await asyncio.to_thread(self.index.embeddings.embed_documents, texts)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error(f"Батч из {len(batch)} чанков не проиндексирован: {e}")
+                    return None
+                stats.retries += 1
+                delay = 2 ** attempt
+                logger.warning(f"Ошибка эмбеддинга батча, повтор через {delay}с: {e}")
+                await asyncio.sleep(delay)
@@ -0,0 +1,202 @@
+"""Инвертированный индекс BM25 для точного поиска по словам и идентификаторам"""
+import heapq
+import json
+import math
+import re
+import sqlite3
+import threading
+from collections import Counter, defaultdict
+from config import BM25_K1, BM25_B
+from rag.namespaces import SHARED_NAMESPACE
+from utils.logger import logger
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+# Части идентификаторов: snake_case и CamelCase
+_SUBWORD_RE = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+
+def tokenize(text: str) -> list:
+    """Токены для BM25
+
+    Идентификаторы сохраняются целиком (read_csv, KeyError) и дополнительно
+    разбиваются на части, чтобы находились и по "csv", и по "error".
+    """
+    tokens = []
+    for word in _WORD_RE.findall(text):
+        token = word.lower().replace("ё", "е")
+        if len(token) > 1:
+            tokens.append(token)
+        if word.isascii() and ("_" in word.strip("_") or not (word.islower() or word.isupper())):
+            parts = _SUBWORD_RE.findall(word)
+            if len(parts) > 1:
+                tokens.extend(part.lower() for part in parts if len(part) > 1)
+    return tokens
+
+class KeywordIndex:
+    """BM25 поверх SQLite
+
+    Обновляется инкрементально вместе с векторным хранилищем: добавление
+    чанка пишет его постинги, удаление - удаляет. Число чанков и суммарная
+    длина для avgdl держатся в памяти.
+    """
+
+    def __init__(self, path, k1: float = BM25_K1, b: float = BM25_B):
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            " id TEXT PRIMARY KEY,"
+            " length INTEGER NOT NULL,"
+            " text TEXT NOT NULL,"
+            " metadata TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS postings ("
+            " term TEXT NOT NULL,"
+            " chunk_id TEXT NOT NULL,"
+            " tf INTEGER NOT NULL,"
+            " PRIMARY KEY (term, chunk_id)) WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_postings_chunk ON postings(chunk_id)")
+        # Пространство чанка (добавлено позже)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(chunks)")}
+        if "namespace" not in columns:
+            self._conn.execute(
+                f"ALTER TABLE chunks ADD COLUMN namespace TEXT NOT NULL DEFAULT '{SHARED_NAMESPACE}'"
+            )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_chunks_namespace ON chunks(namespace)")
+        self._conn.commit()
+
+        self._count, self._total_length = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(length), 0) FROM chunks"
+        ).fetchone()
+
+    def add(self, ids: list, texts: list, metadatas: list):
+        """Добавить или заменить чанки"""
+        if not ids:
+            return
+        with self._lock:
+            self._delete(ids)
+            chunk_rows = []
+            posting_rows = []
+            for chunk_id, text, metadata in zip(ids, texts, metadatas):
+                terms = Counter(tokenize(text))
+                length = sum(terms.values())
+                metadata = metadata or {}
+                chunk_rows.append((
+                    chunk_id, length, text, json.dumps(metadata, ensure_ascii=False),
+                    metadata.get("namespace", SHARED_NAMESPACE)
+                ))
+                posting_rows.extend((term, chunk_id, tf) for term, tf in terms.items())
+                self._count += 1
+                self._total_length += length
+
+            self._conn.executemany(
+                "INSERT INTO chunks (id, length, text, metadata, namespace) VALUES (?, ?, ?, ?, ?)", chunk_rows
+            )
+            self._conn.executemany(
+                "INSERT INTO postings (term, chunk_id, tf) VALUES (?, ?, ?)", posting_rows
+            )
+            self._conn.commit()
+
+    def update_metadatas(self, ids: list, metadatas: list):
+        """Обновить метаданные чанков"""
+        if not ids:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE chunks SET metadata = ? WHERE id = ?",
+                [(json.dumps(metadata or {}, ensure_ascii=False), chunk_id) for chunk_id, metadata in zip(ids, metadatas)]
+            )
+            self._conn.commit()
+
+    def delete(self, ids: list):
+        """Удалить чанки"""
+        if not ids:
+            return
+        with self._lock:
+            self._delete(ids)
+            self._conn.commit()
+
+    def search(self, query: str, k: int, namespaces: list = None) -> list:
+        """k лучших чанков по BM25: список (Document, score), чем больше score, тем лучше
+
+        namespaces - ограничить поиск пространствами (None - все чанки).
+        """
+        from langchain_core.documents import Document
+
+        terms = set(tokenize(query))
+        if not terms or not self._count or namespaces == []:
+            return []
+
+        sql = (
+            "SELECT p.chunk_id, p.tf, c.length FROM postings p"
+            " JOIN chunks c ON c.id = p.chunk_id WHERE p.term = ?"
+        )
+        if namespaces is not None:
+            sql += f" AND c.namespace IN ({','.join('?' * len(namespaces))})"
+
+        scores = defaultdict(float)
+        with self._lock:
+            avgdl = self._total_length / self._count
+            for term in terms:
+                rows = self._conn.execute(sql, (term, *(namespaces or ()))).fetchall()
+                if not rows:
+                    continue
+                idf = math.log(1 + (self._count - len(rows) + 0.5) / (len(rows) + 0.5))
+                for chunk_id, tf, length in rows:
+                    norm = self.k1 * (1 - self.b + self.b * length / avgdl)
+                    scores[chunk_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+
+            top = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+            if not top:
+                return []
+            placeholders = ",".join("?" * len(top))
+            rows = self._conn.execute(
+                f"SELECT id, text, metadata FROM chunks WHERE id IN ({placeholders})",
+                [chunk_id for chunk_id, _ in top]
+            ).fetchall()
+
+        chunks = {chunk_id: (text, metadata) for chunk_id, text, metadata in rows}
+        return [
+            (Document(page_content=chunks[chunk_id][0], metadata=json.loads(chunks[chunk_id][1])), score)
+            for chunk_id, score in top if chunk_id in chunks
+        ]
+
+    def count(self, namespaces: list = None) -> int:
+        if namespaces is None:
+            return self._count
+        if not namespaces:
+            return 0
+        with self._lock:
+            return self._conn.execute(
+                f"SELECT COUNT(*) FROM chunks WHERE namespace IN ({','.join('?' * len(namespaces))})",
+                list(namespaces)
+            ).fetchone()[0]
+
+    def rebuild(self, ids: list, texts: list, metadatas: list):
+        """Построить индекс заново (например, по содержимому векторного хранилища)"""
+        with self._lock:
+            self._conn.execute("DELETE FROM postings")
+            self._conn.execute("DELETE FROM chunks")
+            self._conn.commit()
+            self._count = self._total_length = 0
+        for start in range(0, len(ids), 500):
+            self.add(ids[start:start + 500], texts[start:start + 500], metadatas[start:start + 500])
+        logger.info(f"Индекс BM25 построен: {self._count} чанков")
+
+    def _delete(self, ids: list):
+        # SQLite ограничивает число параметров в запросе
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            removed_count, removed_length = self._conn.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(length), 0) FROM chunks WHERE id IN ({placeholders})", batch
+            ).fetchone()
+            self._conn.execute(f"DELETE FROM postings WHERE chunk_id IN ({placeholders})", batch)
+            self._conn.execute(f"DELETE FROM chunks WHERE id IN ({placeholders})", batch)
+            self._count -= removed_count
+            self._total_length -= removed_length
@@ -1,24 +1,93 @@
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import PyPDFLoader, TextLoader
+import asyncio
+import codecs
+import io
+import os
+import tempfile
+import threading
+from collections import deque
+from contextlib import aclosing
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from config import RAG_CHUNK_SIZE, RAG_CHUNK_OVERLAP
+from config import (
+    RAG_CHUNK_SIZE, RAG_CHUNK_OVERLAP, RAG_LOADER_WORKERS,
+    RAG_STREAM_WINDOW_PAGES, RAG_STREAM_WINDOW_CHARS, RAG_STREAM_QUEUE_SIZE
+)
+from utils.lazy import LazyProvider
 from utils.logger import logger
 
+# LangChain импортируется внутри функций: модуль подключается при запуске бота
+
+def _make_splitter():
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    return RecursiveCharacterTextSplitter(
+        chunk_size=RAG_CHUNK_SIZE,
+        chunk_overlap=RAG_CHUNK_OVERLAP,
+        length_function=len,
+    )
+
+# Последний открытый PDF в процессе пула: окна одного документа
+# разбираются без повторного чтения файла
+_cached_pdf = None
+
+def _open_pdf(file_path: str):
+    """Открыть PDF (выполняется в отдельном процессе)"""
+    global _cached_pdf
+    from pypdf import PdfReader
+
+    stat = os.stat(file_path)
+    key = (file_path, stat.st_mtime_ns, stat.st_size)
+    if _cached_pdf is None or _cached_pdf[0] != key:
+        _cached_pdf = (key, PdfReader(file_path))
+    return _cached_pdf[1]
+
+def _pdf_page_count(file_path: str) -> int:
+    """Число страниц PDF (выполняется в отдельном процессе)"""
+    return len(_open_pdf(file_path).pages)
+
+def _load_pdf_range(file_path: str, start: int, end: int, source_name: str) -> list:
+    """Разобрать и разбить на чанки страницы [start, end) PDF (выполняется в отдельном процессе)"""
+    from langchain_core.documents import Document
+
+    reader = _open_pdf(file_path)
+    pages = [
+        Document(
+            page_content=reader.pages[i].extract_text() or "",
+            metadata={'source': source_name, 'page': i}
+        )
+        for i in range(start, end)
+    ]
+    return _make_splitter().split_documents(pages)
+
+def _chunk_start(window: str, chunk: str) -> int:
+    """Позиция последнего чанка в исходном тексте окна"""
+    end = len(window.rstrip())
+    if window.endswith(chunk, 0, end):
+        return end - len(chunk)
+    start = window.rfind(chunk)
+    return start if start >= 0 else end - len(chunk)
+
+def _write_temp_file(data, suffix: str) -> str:
+    """Записать буфер во временный файл для процессов пула"""
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+        f.write(data)
+    return f.name
+
 class DocumentLoader:
     """Загрузчик документов для RAG"""
-    
+
     def __init__(self):
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=RAG_CHUNK_SIZE,
-            chunk_overlap=RAG_CHUNK_OVERLAP,
-            length_function=len,
-        )
-    
+        self.text_splitter = _make_splitter()
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
     def load_document(self, file_path: str):
         """Загрузить и разбить документ на чанки"""
+        from langchain_community.document_loaders import PyPDFLoader, TextLoader
+
         try:
             file_path = Path(file_path)
-            
+
             # Выбираем loader в зависимости от расширения
             if file_path.suffix.lower() == '.pdf':
                 loader = PyPDFLoader(str(file_path))
@@ -26,20 +95,198 @@ class DocumentLoader:
                 loader = TextLoader(str(file_path), encoding='utf-8')
             else:
                 raise ValueError(f"Неподдерживаемый формат файла: {file_path.suffix}")
-            
+
             # Загружаем документ
             documents = loader.load()
-            
+
             # Разбиваем на чанки
             chunks = self.text_splitter.split_documents(documents)
-            
+
             logger.info(f"Загружен документ {file_path.name}: {len(chunks)} чанков")
-            
+
             return chunks
-            
+
         except Exception as e:
             logger.error(f"Ошибка загрузки документа {file_path}: {e}")
             raise
 
-# Глобальный экземпляр
-document_loader = DocumentLoader()
+    async def aiter_file_chunks(self, file_path: str, source_name: str = None):
+        """Потоково разбить на чанки документ с диска"""
+        path = Path(file_path)
+        source_name = source_name or path.name
+        suffix = path.suffix.lower()
+        if suffix == '.pdf':
+            async with aclosing(self._aiter_pdf_chunks(str(path), source_name)) as chunks:
+                async for chunk in chunks:
+                    yield chunk
+        elif suffix in ['.txt', '.md']:
+            data = await asyncio.to_thread(path.read_bytes)
+            async with aclosing(self._aiter_in_thread(self._iter_text_chunks, data, source_name)) as chunks:
+                async for chunk in chunks:
+                    yield chunk
+        else:
+            raise ValueError(f"Неподдерживаемый формат файла: {path.suffix}")
+
+    async def aiter_chunks(self, data, suffix: str, source_name: str):
+        """Потоково разбить документ из буфера (bytes или memoryview) на чанки
+
+        PDF разбирается окнами по RAG_STREAM_WINDOW_PAGES страниц в пуле
+        процессов (буфер один раз записывается во временный файл, который
+        читают процессы пула), текст - блоками по RAG_STREAM_WINDOW_CHARS
+        байт в отдельном потоке. Чанки отдаются в порядке страниц.
+        """
+        suffix = suffix.lower()
+        if suffix == '.pdf':
+            path = await asyncio.to_thread(_write_temp_file, data, suffix)
+            try:
+                async with aclosing(self._aiter_pdf_chunks(path, source_name)) as chunks:
+                    async for chunk in chunks:
+                        yield chunk
+            finally:
+                await asyncio.to_thread(os.remove, path)
+        elif suffix in ['.txt', '.md']:
+            # aclosing: при досрочной остановке поток разбора завершается
+            # (и отпускает буфер) до выхода из генератора
+            async with aclosing(self._aiter_in_thread(self._iter_text_chunks, data, source_name)) as chunks:
+                async for chunk in chunks:
+                    yield chunk
+        else:
+            raise ValueError(f"Неподдерживаемый формат файла: {suffix}")
+
+    async def _aiter_pdf_chunks(self, file_path: str, source_name: str):
+        """Разбор окон PDF в пуле процессов
+
+        Одновременно в работе не больше 2 * RAG_LOADER_WORKERS окон: следующее
+        окно отправляется, когда потребитель забрал чанки предыдущего, так что
+        при медленном эмбеддинге разбор приостанавливается.
+        """
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        page_count = await loop.run_in_executor(executor, _pdf_page_count, file_path)
+        windows = iter([
+            (start, min(start + RAG_STREAM_WINDOW_PAGES, page_count))
+            for start in range(0, page_count, RAG_STREAM_WINDOW_PAGES)
+        ])
+
+        def submit():
+            window = next(windows, None)
+            if window is not None:
+                pending.append(loop.run_in_executor(executor, _load_pdf_range, file_path, *window, source_name))
+
+        pending = deque()
+        chunk_count = 0
+        try:
+            for _ in range(2 * RAG_LOADER_WORKERS):
+                submit()
+            while pending:
+                chunks = await pending.popleft()
+                submit()
+                for chunk in chunks:
+                    chunk_count += 1
+                    yield chunk
+        finally:
+            for future in pending:
+                future.cancel()
+
+        logger.info(f"Потоково разобран документ {source_name}: {page_count} страниц, {chunk_count} чанков")
+
+    async def _aiter_in_thread(self, parse, *args):
+        """Выполнить генератор parse(*args) в отдельном потоке
+
+        Чанки передаются через ограниченную очередь: если эмбеддинг
+        не успевает, разбор приостанавливается.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=RAG_STREAM_QUEUE_SIZE)
+        done = object()
+        cancelled = threading.Event()
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def produce():
+            chunks = parse(*args)
+            try:
+                for chunk in chunks:
+                    if cancelled.is_set():
+                        return
+                    put(chunk)
+                put(done)
+            except Exception as e:
+                put(e)
+            finally:
+                # Генератор освобождает свои ресурсы (срезы буфера) в этом потоке
+                chunks.close()
+
+        producer = loop.run_in_executor(None, produce)
+        try:
+            while True:
+                item = await queue.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            cancelled.set()
+            # Освобождаем место в очереди, чтобы поток мог завершиться
+            while not producer.done():
+                while not queue.empty():
+                    queue.get_nowait()
+                await asyncio.sleep(0.01)
+
+    def _iter_text_chunks(self, data, source_name: str):
+        """Разбить текст на чанки блоками по RAG_STREAM_WINDOW_CHARS байт
+
+        Последний чанк блока разбивается заново вместе со следующим блоком.
+        Чанки покрывают тот же текст, что и при разбиении целиком, но границы
+        рядом со стыками блоков могут отличаться на несколько символов.
+        """
+        from langchain_core.documents import Document
+
+        # Буфер читается срезами memoryview, без копии всего содержимого.
+        # Срезы освобождаются сразу, view - в finally: пока они живы,
+        # BytesIO, из которого получен буфер, нельзя закрыть
+        view = memoryview(data)
+        decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder('utf-8')(), translate=True)
+        carry = ""
+        chunk_count = 0
+
+        try:
+            for offset in range(0, len(view), RAG_STREAM_WINDOW_CHARS):
+                with view[offset:offset + RAG_STREAM_WINDOW_CHARS] as window:
+                    block = decoder.decode(window)
+                window = carry + block
+                texts = self.text_splitter.split_text(window)
+                # Последний чанк может продолжиться в следующем блоке. Переносим
+                # исходный текст с его начала: у чанка обрезаны пробелы по краям,
+                # и без них последнее слово склеилось бы с первым словом блока
+                carry = window[_chunk_start(window, texts.pop()):] if texts else window
+                for text in texts:
+                    chunk_count += 1
+                    yield Document(page_content=text, metadata={'source': source_name})
+
+            carry += decoder.decode(b"", True)
+        except UnicodeDecodeError:
+            raise ValueError(
+                f"Файл {source_name} не в кодировке UTF-8: сохраните его в UTF-8 и загрузите снова"
+            ) from None
+        finally:
+            view.release()
+
+        for text in self.text_splitter.split_text(carry):
+            chunk_count += 1
+            yield Document(page_content=text, metadata={'source': source_name})
+
+        logger.info(f"Потоково разобран документ {source_name}: {chunk_count} чанков")
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        """Общий пул процессов (создается при первом использовании)"""
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=RAG_LOADER_WORKERS)
+                logger.info(f"Пул процессов для загрузки документов: {RAG_LOADER_WORKERS} воркеров")
+            return self._executor
+
+# Глобальный экземпляр (создается при первом обращении)
+document_loader = LazyProvider(DocumentLoader, "document_loader")
@@ -0,0 +1,24 @@
+"""Пространства имен базы знаний: личные документы пользователя и общие пространства"""
+from config import KB_SHARED_NAMESPACES, KB_SHARDS
+
+# Общее пространство: сюда относятся документы, загруженные до разделения
+SHARED_NAMESPACE = "shared"
+
+def user_namespace(user_id: int) -> str:
+    """Личное пространство пользователя"""
+    return f"user:{user_id}"
+
+def user_shard(user_id: int, shards: int = KB_SHARDS) -> int:
+    """Часть базы знаний с личными документами пользователя"""
+    return user_id % shards
+
+def namespace_shard(namespace: str, shards: int = KB_SHARDS):
+    """Часть базы знаний для пространства (None - общее хранилище)"""
+    prefix, _, user_id = namespace.partition(":")
+    if prefix == "user" and user_id.lstrip("-").isdigit():
+        return user_shard(int(user_id), shards)
+    return None
+
+def search_namespaces(user_id: int) -> list:
+    """Где искать для пользователя: его документы и общие пространства"""
+    return [user_namespace(user_id), *KB_SHARED_NAMESPACES]
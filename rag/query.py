@@ -1,6 +1,13 @@
+import asyncio
+from contextlib import aclosing
+from pathlib import Path
 from rag.index import vector_index
 from services.gemini_client import gemini_client
-from config import RAG_TOP_K
+from services.answer_cache import answer_cache
+from services.transport import GeminiError
+from rag.hybrid import reciprocal_rank_fusion, maximal_marginal_relevance
+from rag.namespaces import SHARED_NAMESPACE
+from config import RAG_TOP_K, RAG_HYBRID, RAG_CANDIDATES, RAG_MMR_LAMBDA
 from utils.logger import logger
 
 def prepare_context(search_results) -> str:
@@ -14,17 +21,50 @@ def prepare_context(search_results) -> str:
     
     return "\n".join(context_parts)
 
-async def query_knowledge_base(query: str, history: list) -> str:
-    """Запрос к базе знаний с RAG"""
+async def retrieve(query: str, k: int = RAG_TOP_K, namespaces: list = None) -> list:
+    """Гибридный поиск: векторы и BM25 параллельно, слияние RRF, затем MMR
+
+    Эмбеддинг запроса и поиск выполняются вне event loop.
+    namespaces - пространства, в которых искать (None - везде).
+    """
+    if not RAG_HYBRID:
+        return await asyncio.to_thread(vector_index.similarity_search, query, k, namespaces)
+
+    vector_results, keyword_results = await asyncio.gather(
+        asyncio.to_thread(vector_index.similarity_search, query, RAG_CANDIDATES, namespaces),
+        asyncio.to_thread(vector_index.keyword_search, query, RAG_CANDIDATES, namespaces),
+    )
+    fused = reciprocal_rank_fusion([vector_results, keyword_results])
+    logger.debug(
+        f"Гибридный поиск: {len(vector_results)} по векторам, {len(keyword_results)} по словам, "
+        f"{len(fused)} после слияния"
+    )
+    return maximal_marginal_relevance(fused, k, RAG_MMR_LAMBDA)
+
+async def query_knowledge_base(query: str, history: list, namespaces: list = None, route=None) -> str:
+    """Запрос к базе знаний с RAG
+
+    namespaces - пространства пользователя (его документы и общие курсы).
+    route - маршрут модели, если уже выбран (по нему обрезана история).
+    """
     try:
-        # Проверяем есть ли документы в базе
-        collection_size = vector_index.get_collection_size()
-        
-        if collection_size == 0:
+        # Проверяем есть ли документы в базе (по каталогу в памяти).
+        # В потоке: первое обращение создает индекс и читает хранилище с диска
+        if await asyncio.to_thread(vector_index.get_collection_size, namespaces) == 0:
             return "❌ База знаний пуста. Загрузите документы командой /upload или отправив PDF/TXT файл."
         
+        # Повторный вопрос к той же версии базы знаний отвечаем из кэша
+        # Ответы кэшируются отдельно для каждого набора пространств
+        kb_version = vector_index.version
+        cache_scope = f"rag:{','.join(sorted(namespaces))}" if namespaces is not None else "rag"
+        # Как и при сохранении, только для вопроса без предыдущего диалога
+        if not history:
+            cached = await answer_cache.lookup(query, cache_scope, kb_version)
+            if cached is not None:
+                return cached
+        
         # Ищем релевантные документы
-        search_results = vector_index.similarity_search(query, k=RAG_TOP_K)
+        search_results = await retrieve(query, namespaces=namespaces)
         
         if not search_results:
             return "❌ Не найдено релевантных документов по вашему запросу."
@@ -48,34 +88,161 @@ async def query_knowledge_base(query: str, history: list) -> str:
         # Добавляем текущий запрос в историю
         messages = history + [{"role": "user", "content": query}]
         
-        # Генерируем ответ
-        response = gemini_client.generate_text(messages, system_prompt=system_prompt)
+        # Генерируем ответ (модель выбирается по сложности вопроса)
+        route = route or gemini_client.router.classify(query, "rag")
+        response = await gemini_client.generate_text_async(messages, system_prompt=system_prompt, route=route)
         
         logger.info(f"RAG запрос обработан, найдено {len(search_results)} документов")
         
+        # Кэшируем только ответы, не зависящие от предыдущего диалога
+        if not history:
+            await answer_cache.store(query, response, cache_scope, kb_version)
+        
         return response
         
+    except GeminiError:
+        # Ошибку модели показывает обработчик, в историю она не попадает
+        raise
     except Exception as e:
         logger.error(f"Ошибка RAG запроса: {e}")
         return f"❌ Ошибка при обработке запроса: {str(e)}"
 
-async def add_document_to_knowledge_base(file_path: str) -> dict:
-    """Добавить документ в базу знаний"""
+async def add_document_to_knowledge_base(file_path: str, source_name: str = None, progress=None,
+                                         namespace: str = SHARED_NAMESPACE) -> dict:
+    """Добавить документ с диска в базу знаний
+
+    source_name - имя документа (по нему определяется повторная загрузка).
+    namespace - пространство документа (по умолчанию общее).
+    progress - необязательная корутина progress(done, total) для отчета о ходе индексации.
+    """
+    from rag.loader import document_loader
+    from rag.fingerprint import file_fingerprint
+    
+    source_name = source_name or Path(file_path).name
+    
+    def load_chunks():
+        # PDF разбирается окнами в пуле процессов
+        return document_loader.aiter_file_chunks(file_path, source_name)
+    
     try:
-        from rag.loader import document_loader
+        doc_fingerprint = await asyncio.to_thread(file_fingerprint, file_path)
+    except Exception as e:
+        logger.error(f"Ошибка чтения документа {file_path}: {e}")
+        return {'success': False, 'error': str(e)}
+    
+    return await _ingest_document(load_chunks, source_name, doc_fingerprint, progress, namespace)
+
+async def add_document_bytes_to_knowledge_base(data, source_name: str, progress=None,
+                                               namespace: str = SHARED_NAMESPACE) -> dict:
+    """Добавить документ из памяти в базу знаний без временного файла
+
+    data - bytes или memoryview (например, BytesIO.getbuffer()), буфер не
+    копируется и должен оставаться открытым до завершения загрузки.
+    Чанки разбираются потоково и сразу уходят на эмбеддинг, пока
+    остальная часть документа еще разбирается.
+    """
+    from rag.loader import document_loader
+    from rag.fingerprint import bytes_fingerprint
+    
+    suffix = Path(source_name).suffix
+    
+    def load_chunks():
+        return document_loader.aiter_chunks(data, suffix, source_name)
+    
+    doc_fingerprint = await asyncio.to_thread(bytes_fingerprint, data)
+    return await _ingest_document(load_chunks, source_name, doc_fingerprint, progress, namespace)
+
+async def _ingest_document(load_chunks, source_name: str, doc_fingerprint: str, progress=None,
+                           namespace: str = SHARED_NAMESPACE) -> dict:
+    """Инкрементальная индексация документа
+    
+    load_chunks - функция, возвращающая асинхронный итератор чанков.
+    Неизмененный документ не переиндексируется, для измененного эмбеддятся
+    только новые чанки, а исчезнувшие удаляются.
+    """
+    try:
+        from rag.ingest import IngestionPipeline
+        from rag.fingerprint import document_id, ChunkTagger
+        
+        doc_id = document_id(source_name, namespace)
+        
+        # Что уже есть в хранилище для этого документа
+        existing = await asyncio.to_thread(vector_index.get_document_chunks, namespace, doc_id)
+        
+        if existing and all(meta.get('doc_fingerprint') == doc_fingerprint for meta in existing.values()):
+            logger.info(f"Документ {source_name} не изменился, индексация пропущена")
+            await asyncio.to_thread(vector_index.record_document, namespace, doc_id, source_name, len(existing))
+            return {
+                'success': True,
+                'file': source_name,
+                'chunks': len(existing),
+                'unchanged': True
+            }
         
-        # Загружаем и разбиваем документ
-        chunks = document_loader.load_document(file_path)
+        tagger = ChunkTagger(source_name, doc_fingerprint, namespace)
+        seen_ids = set()
+        kept_ids = []
         
-        # Добавляем в векторное хранилище
-        vector_index.add_documents(chunks)
+        async def new_chunks():
+            # На эмбеддинг уходят только чанки, которых еще нет в хранилище
+            async with aclosing(load_chunks()) as chunks:
+                async for chunk in chunks:
+                    chunk_id = tagger.tag(chunk)
+                    seen_ids.add(chunk_id)
+                    if chunk_id in existing:
+                        kept_ids.append(chunk_id)
+                    else:
+                        yield chunk
         
-        logger.info(f"Документ {file_path} добавлен в базу знаний")
+        try:
+            # Разбор закрывается до выхода отсюда и при ошибке: буфер документа
+            # к этому моменту уже никем не используется
+            async with aclosing(new_chunks()) as chunks:
+                stats = await IngestionPipeline(vector_index).run_stream(chunks, progress=progress)
+        except Exception:
+            # Записанные батчи уже учтены в каталоге; сбрасываем отпечаток,
+            # чтобы повторная загрузка не сочла документ неизмененным
+            await asyncio.to_thread(_mark_incomplete, namespace, doc_id)
+            raise
+        removed_ids = list(set(existing) - seen_ids)
+        
+        if stats.total and stats.indexed == 0:
+            return {
+                'success': False,
+                'error': 'Не удалось получить эмбеддинги ни для одного фрагмента'
+            }
+        
+        # Старые чанки помечаем новым отпечатком документа, исчезнувшие удаляем
+        await asyncio.to_thread(
+            vector_index.update_metadatas,
+            namespace,
+            kept_ids,
+            [{**existing[chunk_id], 'doc_fingerprint': doc_fingerprint} for chunk_id in kept_ids]
+        )
+        await asyncio.to_thread(vector_index.delete_chunks, namespace, removed_ids)
+        
+        if stats.failed:
+            # Документ проиндексирован не полностью - сбрасываем отпечаток,
+            # чтобы повторная загрузка доиндексировала недостающие чанки
+            await asyncio.to_thread(_mark_incomplete, namespace, doc_id)
+        
+        await asyncio.to_thread(
+            vector_index.record_document, namespace, doc_id, source_name, len(kept_ids) + stats.indexed
+        )
+        
+        logger.info(
+            f"Документ {source_name} добавлен в базу знаний ({namespace}): новых {stats.indexed}, "
+            f"без изменений {len(kept_ids)}, удалено {len(removed_ids)}"
+        )
         
         return {
             'success': True,
-            'file': file_path,
-            'chunks': len(chunks)
+            'file': source_name,
+            'chunks': len(kept_ids) + stats.indexed,
+            'new': stats.indexed,
+            'removed': len(removed_ids),
+            'failed': stats.failed,
+            'chunks_per_second': stats.chunks_per_second
         }
         
     except Exception as e:
@@ -84,3 +251,16 @@ async def add_document_to_knowledge_base(file_path: str) -> dict:
             'success': False,
             'error': str(e)
         }
+
+def _mark_incomplete(namespace: str, doc_id: str):
+    """Сбросить отпечаток документа у всех его чанков в хранилище"""
+    stored = vector_index.get_document_chunks(namespace, doc_id)
+    vector_index.update_metadatas(
+        namespace, list(stored), [{**meta, 'doc_fingerprint': ''} for meta in stored.values()]
+    )
+
+async def delete_document_from_knowledge_base(namespace: str, doc_id: str) -> int:
+    """Удалить документ из базы знаний, вернуть число удаленных чанков"""
+    removed = await asyncio.to_thread(vector_index.delete_document, namespace, doc_id)
+    logger.info(f"Документ {doc_id} удален из базы знаний ({namespace}): {removed} чанков")
+    return removed
@@ -0,0 +1,114 @@
+"""Сравнение движков векторного хранилища (chroma и numpy)
+
+Каждый движок запускается в отдельном процессе, чтобы честно измерить RSS.
+Векторы случайные, API Gemini не используется.
+
+    python scripts/benchmark_vector_index.py --chunks 5000 --dim 768
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+BATCH_SIZE = 64
+
+def rss_mb() -> float:
+    """Текущий RSS процесса (Linux), иначе пиковый"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def make_backend(name: str, path: Path, quantize: bool):
+    if name == "chroma":
+        from rag.backends.chroma import ChromaBackend
+        return ChromaBackend(None, path)
+    from rag.backends.numpy_index import NumpyBackend
+    return NumpyBackend(path, quantize=quantize)
+
+def run_worker(args) -> dict:
+    import numpy as np
+
+    rng = np.random.default_rng(42)
+    vectors = rng.normal(size=(args.chunks, args.dim)).astype(np.float32)
+    queries = rng.normal(size=(args.queries, args.dim)).astype(np.float32)
+    texts = [f"chunk {i} " + "x" * 800 for i in range(args.chunks)]
+    # Тестовые данные не считаются в RSS движка
+    rss_start = rss_mb()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        started = time.perf_counter()
+        backend = make_backend(args.worker, Path(tmp), args.quantize)
+        import_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for start in range(0, args.chunks, BATCH_SIZE):
+            end = min(start + BATCH_SIZE, args.chunks)
+            backend.upsert(
+                [f"c{i}" for i in range(start, end)],
+                texts[start:end],
+                vectors[start:end].tolist(),
+                [{"doc_id": f"d{i % 10}", "source": "bench"} for i in range(start, end)]
+            )
+        insert_seconds = time.perf_counter() - started
+        if hasattr(backend, "compact"):
+            backend.compact()
+
+        latencies = []
+        for query in queries:
+            started = time.perf_counter()
+            backend.search(query.tolist(), args.k)
+            latencies.append(time.perf_counter() - started)
+        latencies.sort()
+
+        return {
+            "backend": args.worker + ("-int8" if args.quantize and args.worker == "numpy" else ""),
+            "init_s": round(import_seconds, 3),
+            "insert_s": round(insert_seconds, 2),
+            "p50_ms": round(latencies[len(latencies) // 2] * 1000, 2),
+            "p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1000, 2),
+            "rss_mb": round(rss_mb() - rss_start, 1),
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chunks", type=int, default=5000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=3)
+    parser.add_argument("--backends", default="chroma,numpy,numpy-int8")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--quantize", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args)))
+        return
+
+    print(f"{args.chunks} чанков, размерность {args.dim}, {args.queries} запросов, k={args.k}")
+    print(f"{'движок':<12}{'init, с':>10}{'запись, с':>12}{'p50, мс':>10}{'p95, мс':>10}{'RSS, МБ':>10}")
+    for name in args.backends.split(","):
+        command = [
+            sys.executable, __file__, "--worker", name.split("-")[0],
+            "--chunks", str(args.chunks), "--dim", str(args.dim),
+            "--queries", str(args.queries), "-k", str(args.k),
+        ]
+        if name.endswith("-int8"):
+            command.append("--quantize")
+        output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(
+            f"{result['backend']:<12}{result['init_s']:>10}{result['insert_s']:>12}"
+            f"{result['p50_ms']:>10}{result['p95_ms']:>10}{result['rss_mb']:>10}"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Проверка выбора уровня модели (services/model_router.py)
+
+Прогоняет через ModelRouter.classify набор вопросов с ожидаемым уровнем
+и печатает расхождения. Код выхода 1, если хотя бы один вопрос попал не
+на свой уровень. Токены и API не нужны.
+
+    python scripts/check_model_router.py
+"""
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# (текст, режим, вложение, ожидаемый уровень)
+CASES = [
+    # Слова вопроса и темы сами по себе не повышают уровень
+    ("почему список изменяемый, а кортеж нет?", "text", None, "default"),
+    ("почему не работает asyncio.run?", "text", None, "default"),
+    ("сравни list и tuple", "text", None, "default"),
+    ("почему медленный алгоритм сортировки пузырьком?", "rag", None, "default"),
+    ("что такое генератор?", "text", None, "fast"),
+    ("привет", "text", None, "fast"),
+    ("почему так?", "voice", None, "fast"),
+    # Явная просьба о подробном разборе
+    ("объясни подробно, как работает GIL", "text", None, "strong"),
+    ("сделай ревью функции, пожалуйста", "text", None, "strong"),
+    # Структура: несколько вопросов или пунктов
+    ("что такое GIL? зачем он нужен? как его обойти?", "text", None, "strong"),
+    ("Расскажи про:\n1. декораторы\n2. генераторы\n3. контекстные менеджеры", "text", None, "strong"),
+    # Код, длина, вложения
+    ("```\n" + "x = 1\n" * 3 + "```", "text", None, "strong"),
+    ("слово " * 800, "text", None, "strong"),
+    ("что в этом файле?", "text", "document", "strong"),
+    ("о чем диалог", "summary", None, "fast"),
+]
+
+def main():
+    # Конфигурация читается при импорте: ключи не используются
+    os.environ.setdefault("GEMINI_API_KEY", "check-router")
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "0:check-router")
+    os.environ["MODEL_ROUTING"] = "1"
+
+    from services.model_router import ModelRouter
+
+    router = ModelRouter(transport=None)
+    failed = 0
+    for text, mode, attachment, expected in CASES:
+        route = router.classify(text, mode, attachment)
+        if route.tier != expected:
+            failed += 1
+            print(f"✗ {text[:50]!r} ({mode}): {route.tier} ({route.reason}), ожидался {expected}")
+
+    print(f"Проверено {len(CASES)} вопросов, расхождений: {failed}")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
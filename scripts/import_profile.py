@@ -0,0 +1,80 @@
+"""Профиль импортов при запуске бота (python -X importtime)
+
+Запускает в отдельном процессе то же, что и бот до подключения к
+Telegram (import bot + create_bot), и печатает самые дорогие модули по
+суммарному времени импорта. Проверка запуска: код выхода 1, если импорт
+дольше бюджета или при запуске подгружаются тяжелые библиотеки, которые
+должны создаваться лениво (клиент Gemini, LangChain, Chroma).
+
+    python scripts/import_profile.py --top 20 --budget-ms 1500
+"""
+import argparse
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Эти пакеты нужны только после первого запроса или прогрева
+DEFERRED_PACKAGES = ("google.genai", "langchain", "langchain_core", "langchain_google_genai", "chromadb")
+
+STARTUP_CODE = "import bot; bot.create_bot()"
+
+def profile() -> list:
+    """Список (модуль, собственное время мкс, суммарное время мкс, глубина)"""
+    env = dict(os.environ)
+    # Токены не используются: к Telegram и Gemini запуск не подключается
+    env.setdefault("TELEGRAM_BOT_TOKEN", "0:import-profile")
+    env.setdefault("GEMINI_API_KEY", "import-profile")
+    env["WARM_UP"] = "0"
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", STARTUP_CODE],
+        cwd=ROOT, env=env, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        sys.exit(f"Запуск завершился ошибкой:\n{result.stderr[-2000:]}")
+
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return modules
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--budget-ms", type=float, default=1500)
+    args = parser.parse_args()
+
+    modules = profile()
+    # Верхний уровень - модули, импортированные напрямую (без вложенных)
+    total_ms = sum(cumulative for _, _, cumulative, depth in modules if depth == 0) / 1000
+
+    print(f"{'модуль':<50} {'свое, мс':>9} {'всего, мс':>10}")
+    for name, self_us, cumulative_us, _ in sorted(modules, key=lambda m: m[2], reverse=True)[:args.top]:
+        print(f"{name:<50} {self_us / 1000:>9.1f} {cumulative_us / 1000:>10.1f}")
+    print(f"\nМодулей: {len(modules)}, импорт всего: {total_ms:.0f} мс (бюджет {args.budget_ms:.0f} мс)")
+
+    problems = []
+    deferred = sorted({
+        package for name, *_ in modules for package in DEFERRED_PACKAGES
+        if name == package or name.startswith(package + ".")
+    })
+    if deferred:
+        problems.append(f"при запуске импортированы отложенные пакеты: {', '.join(deferred)}")
+    if total_ms > args.budget_ms:
+        problems.append(f"импорт дольше бюджета: {total_ms:.0f} мс > {args.budget_ms:.0f} мс")
+
+    for problem in problems:
+        print(f"❌ {problem}")
+    if problems:
+        sys.exit(1)
+    print("✅ Проверка запуска пройдена")
+
+if __name__ == "__main__":
+    main()
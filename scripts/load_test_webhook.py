@@ -0,0 +1,171 @@
+"""Нагрузочный тест режима webhook: масштабирование по числу обработчиков
+
+Поднимает настоящий приемник (services.webhook) с фиктивными
+обработчиками: вместо бота каждый апдейт занимает CPU на --work-ms
+миллисекунд (разбор апдейта, хендлеры, сериализация) и блокирует
+процесс на --block-ms (синхронный ввод-вывод). CPU-нагрузка
+масштабируется только при числе ядер не меньше числа обработчиков,
+блокирующая - и на одном ядре. Фиктивный
+Telegram шлет апдейты от --users пользователей так же, как настоящий:
+апдейты одного пользователя по очереди, разных - параллельно.
+Проверяется порядок апдейтов каждого пользователя. Токены и API не нужны.
+
+    python scripts/load_test_webhook.py --workers 1 2 4 --updates 4000 --work-ms 5
+    python scripts/load_test_webhook.py --workers 1 2 4 --work-ms 0.5 --block-ms 10
+"""
+import argparse
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import queue
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+SECRET = "load-test"
+
+def fake_worker(shard: int, workers: int, updates, results, work_ms: float, block_ms: float):
+    """Обработчик без бота: только CPU-нагрузка и отметка о выполнении"""
+    results.put(("ready", shard, None))
+    while True:
+        body = updates.get()
+        if body is None:
+            break
+        update = json.loads(body)
+        message = update["message"]
+        # Работа хендлера: держим CPU work_ms миллисекунд
+        deadline = time.perf_counter() + work_ms / 1000
+        digest = body
+        while time.perf_counter() < deadline:
+            digest = hashlib.sha256(digest).digest()
+        if block_ms:
+            time.sleep(block_ms / 1000)
+        results.put(("done", message["from"]["id"], int(message["text"])))
+
+def make_update(update_id: int, user_id: int, seq: int) -> bytes:
+    return json.dumps({
+        "update_id": update_id,
+        "message": {
+            "message_id": seq,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Load"},
+            "text": str(seq),
+        },
+    }).encode()
+
+async def send_updates(url: str, users: int, per_user: int, connections: int) -> int:
+    """Фиктивный Telegram: апдейты пользователя по очереди, 503 - повтор позже"""
+    import aiohttp
+
+    retries = 0
+    limit = asyncio.Semaphore(connections)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET, "Content-Type": "application/json"}
+
+    async def send_user(session, user_id: int):
+        nonlocal retries
+        for seq in range(per_user):
+            body = make_update(user_id * per_user + seq, user_id, seq)
+            while True:
+                async with limit:
+                    async with session.post(url, data=body, headers=headers) as response:
+                        status = response.status
+                if status == 200:
+                    break
+                if status != 503:
+                    raise RuntimeError(f"Приемник ответил {status}")
+                retries += 1
+                await asyncio.sleep(0.05)
+
+    connector = aiohttp.TCPConnector(limit=connections)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*(send_user(session, user_id) for user_id in range(1, users + 1)))
+    return retries
+
+async def run_case(workers: int, args) -> dict:
+    from aiohttp import web
+    from services.webhook import WebhookIngress
+    from config import WEBHOOK_PATH
+
+    import multiprocessing
+    results = multiprocessing.get_context("spawn").Queue()
+    target = functools.partial(fake_worker, results=results, work_ms=args.work_ms, block_ms=args.block_ms)
+    ingress = WebhookIngress(workers=workers, queue_size=args.queue_size, target=target, secret=SECRET)
+
+    runner = web.AppRunner(ingress.make_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", args.port)
+    await site.start()
+
+    try:
+        # Ждем запуска всех обработчиков, чтобы не мерить старт процессов
+        for _ in range(workers):
+            await asyncio.to_thread(results.get, True, 60)
+
+        per_user = args.updates // args.users
+        total = per_user * args.users
+        url = f"http://127.0.0.1:{args.port}{WEBHOOK_PATH}"
+
+        started = time.perf_counter()
+        sender = asyncio.ensure_future(send_updates(url, args.users, per_user, args.connections))
+
+        last_seq = {}
+        out_of_order = 0
+        done = 0
+        while done < total:
+            try:
+                _, user_id, seq = await asyncio.to_thread(results.get, True, 1)
+            except queue.Empty:
+                if sender.done() and sender.exception():
+                    raise sender.exception()
+                continue
+            if seq <= last_seq.get(user_id, -1):
+                out_of_order += 1
+            last_seq[user_id] = seq
+            done += 1
+        elapsed = time.perf_counter() - started
+        retries = await sender
+    finally:
+        await runner.cleanup()
+
+    return {
+        'workers': workers,
+        'updates': total,
+        'seconds': elapsed,
+        'rate': total / elapsed,
+        'retries': retries,
+        'out_of_order': out_of_order,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--updates", type=int, default=4000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--work-ms", type=float, default=5.0)
+    parser.add_argument("--block-ms", type=float, default=0.0)
+    parser.add_argument("--connections", type=int, default=100)
+    parser.add_argument("--queue-size", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=18080)
+    args = parser.parse_args()
+
+    print(f"CPU: {os.cpu_count()}, апдейтов: {args.updates}, пользователей: {args.users}, "
+          f"на апдейт: CPU {args.work_ms} мс, ожидание {args.block_ms} мс")
+    print(f"{'обработчиков':>12} {'апд/с':>10} {'ускорение':>10} {'эффективн.':>10} {'повторов':>9} {'не по порядку':>14}")
+
+    base = None
+    for workers in args.workers:
+        result = asyncio.run(run_case(workers, args))
+        base = base or result['rate'] / workers
+        speedup = result['rate'] / base
+        print(
+            f"{workers:>12} {result['rate']:>10.0f} {speedup:>9.2f}x {speedup / workers:>10.0%} "
+            f"{result['retries']:>9} {result['out_of_order']:>14}"
+        )
+
+if __name__ == "__main__":
+    main()
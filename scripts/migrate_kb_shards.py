@@ -0,0 +1,51 @@
+"""Перенос личных документов базы знаний в части KB_SHARDS
+
+Запускается при остановленном боте (хранилища не рассчитаны на запись
+из нескольких процессов):
+
+- после обновления: личные документы из общего хранилища (data/chroma_db)
+  и из папок data/shard-<N>/ прежнего разделения по обработчикам;
+- после изменения KB_SHARDS: документы, оказавшиеся не в своей части.
+
+Векторы берутся из кэша эмбеддингов, недостающие считаются заново
+(нужен GEMINI_API_KEY). Прерванный перенос можно запустить повторно.
+
+    python scripts/migrate_kb_shards.py
+"""
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dry-run", action="store_true", help="только показать, откуда будут перенесены документы")
+    args = parser.parse_args()
+
+    from config import DATA_DIR, KB_SHARDS, KB_SHARDS_DIR, ensure_dirs
+    from rag.index import ShardedVectorIndex, VectorIndex
+
+    ensure_dirs()
+    # Прежние папки data/shard-<N>/ и части, номер которых больше нового KB_SHARDS
+    legacy = sorted(DATA_DIR.glob("shard-*"))
+    shard_dirs = sorted(path for path in KB_SHARDS_DIR.glob("*") if path.is_dir() and path.name.isdigit())
+    if args.dry_run:
+        print(f"Частей: {KB_SHARDS}, источники: общее хранилище, {[str(path) for path in legacy + shard_dirs]}")
+        return
+
+    # Личные документы из общего хранилища переносятся при создании индекса
+    index = ShardedVectorIndex()
+    moved = 0
+    for path in shard_dirs:
+        number = int(path.name)
+        source = index.shard(number) if number < KB_SHARDS else VectorIndex(path, index.embeddings)
+        moved += index.move_personal_documents(source)
+    for path in legacy:
+        moved += index.move_personal_documents(VectorIndex(path, index.embeddings))
+
+    print(f"Перенесено чанков из частей и папок shard-*: {moved}")
+    print(f"Общее хранилище: {index.shared.catalog.stats()}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""Кэш ответов на повторяющиеся вопросы"""
+import asyncio
+import re
+import time
+from collections import OrderedDict
+from typing import Optional
+import numpy as np
+from config import (
+    ANSWER_CACHE_TTL, ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_SIMILARITY, ANSWER_CACHE_MIN_CHARS
+)
+from utils.logger import logger
+from utils.shared_cache import SharedCache
+
+_PUNCTUATION_RE = re.compile(r"[^\w\s]", re.UNICODE)
+
+def normalize_question(text: str) -> str:
+    """Нормализация вопроса для точного совпадения"""
+    text = text.lower().replace("ё", "е")
+    text = _PUNCTUATION_RE.sub(" ", text)
+    return " ".join(text.split())
+
+class CachedAnswer:
+    __slots__ = ('answer', 'vector', 'created_at', 'hits')
+
+    def __init__(self, answer: str, vector: np.ndarray):
+        self.answer = answer
+        self.vector = vector
+        self.created_at = time.monotonic()
+        self.hits = 0
+
+class AnswerCache:
+    """Кэш ответов: точное совпадение, затем семантическая близость
+
+    Записи разделены по области (режим + версия базы знаний), поэтому
+    после загрузки документов RAG-ответы не переиспользуются. Старые
+    записи вытесняются по TTL и LRU.
+
+    Точные ответы режимов из shared_modes дополнительно пишутся в общий
+    кэш процессов (shared): их видят все обработчики режима webhook.
+    RAG-ответы привязаны к версии базы знаний конкретного процесса и
+    в общий кэш не попадают.
+    """
+
+    def __init__(self, embed_query=None, ttl: float = ANSWER_CACHE_TTL,
+                 max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+                 threshold: float = ANSWER_CACHE_SIMILARITY,
+                 shared: SharedCache = None, shared_modes: tuple = ("text",)):
+        self._embed_query = embed_query
+        self._shared = shared
+        self.shared_modes = shared_modes
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.threshold = threshold
+
+        # (scope, нормализованный вопрос) -> CachedAnswer
+        self._entries: "OrderedDict[tuple, CachedAnswer]" = OrderedDict()
+        # scope -> (ключи, матрица нормированных векторов) для поиска по близости
+        self._matrices = {}
+
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def is_cacheable(question: str) -> bool:
+        return len(normalize_question(question)) >= ANSWER_CACHE_MIN_CHARS
+
+    async def lookup(self, question: str, mode: str, kb_version: int = 0) -> Optional[str]:
+        """Найти ответ на вопрос"""
+        if not self.is_cacheable(question):
+            return None
+
+        scope = (mode, kb_version)
+        key = (scope, normalize_question(question))
+
+        entry = self._get(key)
+        if entry is not None:
+            self.exact_hits += 1
+            entry.hits += 1
+            logger.info(f"Кэш ответов: точное совпадение ({self._hit_rate_text()})")
+            return entry.answer
+
+        answer = await self._shared_get(key)
+        if answer is not None:
+            # Ответ другого процесса запоминаем локально без вектора
+            self._entries[key] = CachedAnswer(answer, None)
+            self._matrices.pop(scope, None)
+            self.exact_hits += 1
+            logger.info(f"Кэш ответов: совпадение в общем кэше ({self._hit_rate_text()})")
+            return answer
+
+        if self._embed_query is not None and self._has_scope(scope):
+            try:
+                vector = await self._vector(question)
+            except Exception as e:
+                # Без эмбеддинга вопрос просто идет к модели
+                logger.warning(f"Кэш ответов: не удалось получить эмбеддинг вопроса: {e}")
+                self.misses += 1
+                return None
+            match = self._nearest(scope, vector)
+            if match is not None:
+                entry = self._get(match)
+                if entry is not None:
+                    self.semantic_hits += 1
+                    entry.hits += 1
+                    logger.info(f"Кэш ответов: похожий вопрос ({self._hit_rate_text()})")
+                    return entry.answer
+
+        self.misses += 1
+        return None
+
+    async def store(self, question: str, answer: str, mode: str, kb_version: int = 0):
+        """Сохранить ответ"""
+        if not self.is_cacheable(question) or not answer:
+            return
+
+        scope = (mode, kb_version)
+        key = (scope, normalize_question(question))
+        vector = None
+        if self._embed_query is not None:
+            try:
+                vector = await self._vector(question)
+            except Exception as e:
+                logger.warning(f"Кэш ответов: не удалось получить эмбеддинг вопроса: {e}")
+
+        self._entries[key] = CachedAnswer(answer, vector)
+        self._entries.move_to_end(key)
+        self._matrices.pop(scope, None)
+        if self._shares(key):
+            # Общий кэш - SQLite: запись в потоке, как и остальной блокирующий ввод-вывод
+            await asyncio.to_thread(self._shared.set, self._shared_key(key), answer)
+
+        while len(self._entries) > self.max_entries:
+            old_key, _ = self._entries.popitem(last=False)
+            self._matrices.pop(old_key[0], None)
+
+    def stats(self) -> dict:
+        total = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'exact_hits': self.exact_hits,
+            'semantic_hits': self.semantic_hits,
+            'misses': self.misses,
+            'hit_rate': (self.exact_hits + self.semantic_hits) / total if total else 0.0,
+        }
+
+    def _hit_rate_text(self) -> str:
+        return f"hit rate {self.stats()['hit_rate']:.0%}"
+
+    def _get(self, key) -> Optional[CachedAnswer]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.created_at > self.ttl:
+            del self._entries[key]
+            self._matrices.pop(key[0], None)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _shares(self, key) -> bool:
+        return self._shared is not None and key[0][0] in self.shared_modes
+
+    @staticmethod
+    def _shared_key(key) -> str:
+        (mode, kb_version), question = key
+        return f"{mode}:{kb_version}\n{question}"
+
+    async def _shared_get(self, key) -> Optional[str]:
+        if not self._shares(key):
+            return None
+        return await asyncio.to_thread(self._shared.get, self._shared_key(key))
+
+    def _has_scope(self, scope) -> bool:
+        return any(key[0] == scope for key in self._entries)
+
+    async def _vector(self, question: str) -> np.ndarray:
+        # embed_query выполняется в потоке целиком: первое обращение к нему
+        # может создавать векторный индекс (чтение хранилища с диска)
+        vector = np.asarray(await asyncio.to_thread(self._embed_query, question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _nearest(self, scope, vector: np.ndarray):
+        """Ключ самого похожего вопроса в области, если он выше порога"""
+        cached = self._matrices.get(scope)
+        if cached is None:
+            keys = [key for key, entry in self._entries.items()
+                    if key[0] == scope and entry.vector is not None]
+            if not keys:
+                return None
+            matrix = np.vstack([self._entries[key].vector for key in keys])
+            cached = self._matrices[scope] = (keys, matrix)
+
+        keys, matrix = cached
+        scores = matrix @ vector
+        best = int(np.argmax(scores))
+        if scores[best] >= self.threshold:
+            return keys[best]
+        return None
+
+def _embed_query(text: str):
+    from rag.index import vector_index
+    return vector_index.embeddings.embed_query(text)
+
+# Глобальный экземпляр
+answer_cache = AnswerCache(
+    embed_query=_embed_query,
+    shared=SharedCache("answers", ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL),
+    shared_modes=("text", "voice")
+)
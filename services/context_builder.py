@@ -0,0 +1,118 @@
+"""Сборка контекста диалога в пределах бюджета токенов"""
+import asyncio
+import math
+import re
+from config import (
+    CONTEXT_TOKEN_BUDGETS, CONTEXT_DEFAULT_BUDGET, CONTEXT_MIN_RECENT_MESSAGES, CONTEXT_SUMMARY_MIN_MESSAGES
+)
+from utils.logger import logger
+from utils.session import user_sessions
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+SUMMARY_PROMPT = """Составь краткое содержание диалога между учеником и Python-наставником.
+Сохрани темы, вопросы ученика, ключевые выводы и фрагменты кода, на которые могут сослаться дальше.
+Не больше 10 пунктов.
+
+{previous}ДИАЛОГ:
+{dialog}"""
+
+def estimate_tokens(text: str) -> int:
+    """Приблизительное число токенов (без обращения к API)
+
+    Слово считается как один токен на каждые 4 символа, знак препинания - как один токен.
+    """
+    return sum(max(1, math.ceil(len(token) / 4)) for token in _TOKEN_RE.findall(text))
+
+class ContextBuilder:
+    """Собирает историю для запроса к модели
+
+    Последние сообщения идут дословно, пока укладываются в бюджет модели.
+    Все, что не поместилось, заменяется кратким содержанием, которое
+    пересчитывается в фоне, когда из окна выпадают новые сообщения.
+    """
+
+    def __init__(self):
+        self._summarizing = set()
+        self._tasks = set()
+
+    @staticmethod
+    def budget_for(model: str) -> int:
+        return CONTEXT_TOKEN_BUDGETS.get(model, CONTEXT_DEFAULT_BUDGET)
+
+    @staticmethod
+    def fit(messages: list, budget: int) -> list:
+        """Взять с конца столько сообщений, сколько помещается в бюджет"""
+        selected = []
+        used = 0
+        for msg in reversed(messages):
+            tokens = estimate_tokens(msg["content"])
+            if used + tokens > budget and len(selected) >= CONTEXT_MIN_RECENT_MESSAGES:
+                break
+            selected.append(msg)
+            used += tokens
+        selected.reverse()
+        return selected
+
+    def build(self, user_id: int, model: str, system_prompt: str = "") -> list:
+        """Сообщения для запроса: краткое содержание + последние сообщения"""
+        history, first_seq = user_sessions.get_history_window(user_id)
+        summary, summary_upto = user_sessions.get_summary(user_id)
+
+        budget = self.budget_for(model) - estimate_tokens(system_prompt or "") - estimate_tokens(summary)
+        recent = self.fit(history, budget)
+        cutoff = first_seq + len(history) - len(recent)
+
+        # Выпавшие из окна сообщения, которых еще нет в кратком содержании.
+        # Пересчитываем не на каждом сообщении, а когда их накопится достаточно
+        uncovered = history[max(0, summary_upto - first_seq):len(history) - len(recent)]
+        if len(uncovered) >= CONTEXT_SUMMARY_MIN_MESSAGES:
+            self._schedule_summary(user_id, summary, uncovered, cutoff)
+
+        messages = []
+        if summary:
+            messages.append({"role": "user", "content": f"[Краткое содержание предыдущей части диалога]\n{summary}"})
+            messages.append({"role": "assistant", "content": "Понял, учитываю предыдущий контекст."})
+        messages.extend(recent)
+
+        logger.debug(
+            f"Контекст для {user_id}: {len(recent)}/{len(history)} сообщений, "
+            f"~{sum(estimate_tokens(m['content']) for m in messages)} токенов"
+        )
+        return messages
+
+    def _schedule_summary(self, user_id: int, summary: str, messages: list, upto: int):
+        """Запустить фоновое обновление краткого содержания"""
+        if user_id in self._summarizing:
+            return
+        self._summarizing.add(user_id)
+        task = asyncio.create_task(self._summarize(user_id, summary, messages, upto))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _summarize(self, user_id: int, summary: str, messages: list, upto: int):
+        from services.gemini_client import gemini_client
+
+        try:
+            dialog = "\n".join(
+                f"{'Ученик' if msg['role'] == 'user' else 'Наставник'}: {msg['content']}"
+                for msg in messages
+            )
+            previous = f"ПРЕДЫДУЩЕЕ КРАТКОЕ СОДЕРЖАНИЕ:\n{summary}\n\n" if summary else ""
+            prompt = SUMMARY_PROMPT.format(previous=previous, dialog=dialog)
+
+            # Служебный запрос - быстрой модели
+            new_summary = await gemini_client.generate_text_async(
+                [{"role": "user", "content": prompt}],
+                route=gemini_client.router.classify(prompt, "summary")
+            )
+
+            user_sessions.set_summary(user_id, new_summary.strip(), upto)
+            logger.info(f"Обновлено краткое содержание диалога {user_id} ({len(messages)} сообщений)")
+        except Exception as e:
+            logger.error(f"Ошибка сжатия истории {user_id}: {e}")
+        finally:
+            self._summarizing.discard(user_id)
+
+# Глобальный экземпляр
+context_builder = ContextBuilder()
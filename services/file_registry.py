@@ -0,0 +1,290 @@
+"""Реестр файлов, загруженных в Gemini File API"""
+import asyncio
+import hashlib
+import io
+import json
+import mimetypes
+import time
+from pathlib import Path
+from typing import Union
+from config import (
+    FILE_API_TTL, FILE_API_EXPIRY_MARGIN, FILE_POLL_INITIAL_DELAY, FILE_POLL_MAX_DELAY,
+    FILE_PROCESSING_TIMEOUT, FILE_REGISTRY_MAX_FILES, FILE_REGISTRY_PATH
+)
+from services.transport import GeminiRequestError, GeminiTimeoutError
+from utils.logger import logger
+
+class FileProcessingError(GeminiRequestError):
+    """Gemini не смог обработать загруженный файл"""
+
+    user_message = "❌ Gemini не смог обработать файл."
+
+class FileTypeError(GeminiRequestError):
+    """Не удалось определить MIME-тип загружаемого файла"""
+
+    user_message = "❌ Не удалось определить тип файла. Поддерживаются PDF, TXT и MD."
+
+# Ключ транспорта для загрузок: свой circuit breaker и статистика задержек
+FILE_API_MODEL_KEY = "files"
+
+# Содержимое в памяти: bytes, bytearray или memoryview (например, BytesIO.getbuffer())
+BytesLike = (bytes, bytearray, memoryview)
+
+# Типы, которые File API принимает для документов (mimetypes дает для .md text/markdown)
+DOCUMENT_MIME_TYPES = {
+    '.pdf': 'application/pdf',
+    '.txt': 'text/plain',
+    '.md': 'text/md',
+}
+
+def guess_mime_type(source, display_name: str = None) -> str:
+    """MIME-тип по имени файла, для байтов - по display_name или сигнатуре"""
+    name = None if isinstance(source, BytesLike) else str(source)
+    name = name or display_name
+    if name:
+        suffix = Path(name).suffix.lower()
+        mime_type = DOCUMENT_MIME_TYPES.get(suffix) or mimetypes.guess_type(name)[0]
+        if mime_type:
+            return mime_type
+    if isinstance(source, BytesLike) and bytes(source[:5]) == b'%PDF-':
+        return 'application/pdf'
+    raise FileTypeError(f"Не удалось определить тип файла {name or '(байты)'}: укажите mime_type")
+
+def content_digest(source: Union[str, Path, bytes, bytearray, memoryview]) -> str:
+    """sha256 содержимого файла или байтов"""
+    if isinstance(source, BytesLike):
+        return hashlib.sha256(source).hexdigest()
+    digest = hashlib.sha256()
+    with open(source, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class FileRecord:
+    """Загруженный файл"""
+    __slots__ = ('digest', 'name', 'uri', 'mime_type', 'uploaded_at', 'expires_at')
+
+    def __init__(self, digest: str, name: str, uri: str, mime_type: str,
+                 uploaded_at: float, expires_at: float):
+        self.digest = digest
+        self.name = name
+        self.uri = uri
+        self.mime_type = mime_type
+        self.uploaded_at = uploaded_at
+        self.expires_at = expires_at
+
+    def part(self):
+        from google.genai import types
+        return types.Part.from_uri(file_uri=self.uri, mime_type=self.mime_type)
+
+    def is_fresh(self) -> bool:
+        return time.time() < self.expires_at - FILE_API_EXPIRY_MARGIN
+
+    def to_dict(self) -> dict:
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+class _Waiter:
+    """Файл, ожидающий окончания обработки"""
+    __slots__ = ('future', 'deadline', 'delay', 'next_check')
+
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+        self.deadline = time.monotonic() + FILE_PROCESSING_TIMEOUT
+        self.delay = FILE_POLL_INITIAL_DELAY
+        self.next_check = time.monotonic() + self.delay
+
+class FileRegistry:
+    """Загрузка файлов в Gemini без повторов
+
+    - один и тот же контент (по sha256) загружается один раз, пока ссылка
+      не истекла; параллельные запросы ждут общую загрузку;
+    - статус обработки проверяет один фоновый поллер с экспоненциальной
+      паузой, запросы ждут future и не блокируют event loop;
+    - реестр хранится на диске, истекшие записи удаляются, а сверх
+      лимита старые файлы удаляются и из Gemini.
+    """
+
+    def __init__(self, client, transport, path: Path = FILE_REGISTRY_PATH,
+                 max_files: int = FILE_REGISTRY_MAX_FILES):
+        self.client = client
+        # Загрузка идет через транспорт: повторы, дедлайн и circuit breaker
+        self.transport = transport
+        self.path = Path(path)
+        self.max_files = max_files
+
+        self._records = self._load()
+        self._uploads = {}
+        self._waiting = {}
+        self._poller = None
+        self._wakeup = None
+
+        self.uploaded = 0
+        self.reused = 0
+
+    async def acquire(self, source: Union[str, Path, bytes, bytearray, memoryview], mime_type: str = None,
+                      display_name: str = None):
+        """Ссылка на файл в Gemini (загружает, только если такого файла еще нет)
+
+        mime_type можно не указывать: он определяется по имени файла
+        (для байтов - по display_name) или сигнатуре PDF, иначе FileTypeError.
+        """
+        mime_type = mime_type or guess_mime_type(source, display_name)
+        digest = await asyncio.to_thread(content_digest, source)
+
+        record = self._records.get(digest)
+        if record is not None and record.is_fresh():
+            self.reused += 1
+            logger.info(f"Файл {record.name} переиспользован (загружено {self.uploaded}, повторов {self.reused})")
+            return record.part()
+
+        task = self._uploads.get(digest)
+        if task is None:
+            task = asyncio.ensure_future(self._upload(digest, source, mime_type, display_name))
+            self._uploads[digest] = task
+            task.add_done_callback(lambda _: self._uploads.pop(digest, None))
+        else:
+            self.reused += 1
+
+        record = await asyncio.shield(task)
+        return record.part()
+
+    async def cleanup(self):
+        """Удалить истекшие записи и лишние загрузки"""
+        now = time.time()
+        expired = [digest for digest, record in self._records.items() if record.expires_at <= now]
+        for digest in expired:
+            del self._records[digest]
+
+        stale = sorted(self._records.values(), key=lambda r: r.uploaded_at)
+        stale = stale[:max(0, len(stale) - self.max_files)]
+        for record in stale:
+            del self._records[record.digest]
+            try:
+                await self.client.aio.files.delete(name=record.name)
+            except Exception as e:
+                logger.warning(f"Не удалось удалить файл {record.name}: {e}")
+
+        if expired or stale:
+            logger.info(f"Реестр файлов: удалено {len(expired)} истекших, {len(stale)} лишних")
+            self._save()
+
+    def stats(self) -> dict:
+        return {
+            'files': len(self._records),
+            'processing': len(self._waiting),
+            'uploaded': self.uploaded,
+            'reused': self.reused,
+        }
+
+    async def _upload(self, digest: str, source, mime_type: str, display_name: str) -> FileRecord:
+        from google.genai import types
+
+        config = types.UploadFileConfig(mime_type=mime_type, display_name=display_name)
+
+        def upload():
+            # Новый BytesIO на каждую попытку: повтор читает файл с начала
+            file = io.BytesIO(source) if isinstance(source, BytesLike) else source
+            return self.client.files.upload(file=file, config=config)
+
+        started = time.perf_counter()
+        # Загрузка выполняется в отдельном потоке
+        file_ref = await self.transport.call(
+            FILE_API_MODEL_KEY, lambda: asyncio.to_thread(upload), modality="document"
+        )
+        self.uploaded += 1
+
+        if file_ref.state != types.FileState.ACTIVE:
+            file_ref = await self._wait_active(file_ref.name)
+
+        expires_at = (
+            file_ref.expiration_time.timestamp() if file_ref.expiration_time
+            else time.time() + FILE_API_TTL
+        )
+        record = FileRecord(digest, file_ref.name, file_ref.uri, file_ref.mime_type, time.time(), expires_at)
+        self._records[digest] = record
+        self._save()
+        logger.info(f"Файл {file_ref.name} загружен и обработан за {time.perf_counter() - started:.1f} с")
+
+        await self.cleanup()
+        return record
+
+    def _wait_active(self, name: str) -> asyncio.Future:
+        """Future, которое поллер завершит, когда файл станет ACTIVE"""
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[name] = _Waiter(future)
+
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        self._wakeup.set()
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.create_task(self._poll_loop())
+        return future
+
+    async def _poll_loop(self):
+        """Фоновая проверка статуса всех обрабатываемых файлов"""
+        while self._waiting:
+            now = time.monotonic()
+            due = [(name, waiter) for name, waiter in self._waiting.items() if waiter.next_check <= now]
+            if due:
+                results = await asyncio.gather(
+                    *(self.client.aio.files.get(name=name) for name, _ in due),
+                    return_exceptions=True
+                )
+                for (name, waiter), result in zip(due, results):
+                    self._check(name, waiter, result)
+
+            if not self._waiting:
+                break
+            timeout = max(0.0, min(w.next_check for w in self._waiting.values()) - time.monotonic())
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _check(self, name: str, waiter: _Waiter, result):
+        from google.genai import types
+
+        if waiter.future.done():
+            del self._waiting[name]
+            return
+
+        if isinstance(result, Exception):
+            logger.warning(f"Ошибка проверки статуса файла {name}: {result}")
+        elif result.state == types.FileState.ACTIVE:
+            waiter.future.set_result(result)
+            del self._waiting[name]
+            return
+        elif result.state == types.FileState.FAILED:
+            waiter.future.set_exception(FileProcessingError(f"Ошибка обработки файла {name}"))
+            del self._waiting[name]
+            return
+
+        if time.monotonic() >= waiter.deadline:
+            waiter.future.set_exception(GeminiTimeoutError(f"Файл {name} не обработан за {FILE_PROCESSING_TIMEOUT} с"))
+            del self._waiting[name]
+            return
+
+        waiter.delay = min(waiter.delay * 2, FILE_POLL_MAX_DELAY)
+        waiter.next_check = time.monotonic() + waiter.delay
+
+    def _load(self) -> dict:
+        try:
+            data = json.loads(self.path.read_text(encoding='utf-8'))
+            return {item['digest']: FileRecord(**item) for item in data}
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать реестр файлов: {e}")
+            return {}
+
+    def _save(self):
+        try:
+            tmp_path = self.path.with_suffix(".tmp")
+            tmp_path.write_text(
+                json.dumps([record.to_dict() for record in self._records.values()], ensure_ascii=False),
+                encoding='utf-8'
+            )
+            tmp_path.replace(self.path)
+        except Exception as e:
+            logger.error(f"Не удалось сохранить реестр файлов: {e}")
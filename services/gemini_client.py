@@ -1,217 +1,484 @@
+"""Сервисы для работы с API"""
+import asyncio
 import base64
 import wave
 import io
-from google import genai
-from google.genai import types
-from config import GEMINI_API_KEY, GEMINI_TEXT_MODEL, GEMINI_VISION_MODEL, GEMINI_AUDIO_MODEL
+from config import (
+    GEMINI_API_KEY, GEMINI_TEXT_MODEL, GEMINI_VISION_MODEL, GEMINI_AUDIO_MODEL,
+    GEMINI_TTS_MODEL, TTS_VOICE, FILE_POLL_INITIAL_DELAY, FILE_POLL_MAX_DELAY, GEMINI_REQUEST_TIMEOUT
+)
+from services.transport import GeminiTransport, GeminiRequestError
+from services.model_router import ModelRouter, Route
+from services.prompt_cache import PromptCache, system_prompt_contents
+from services.file_registry import FileRegistry, FileProcessingError
+from utils.lazy import LazyProvider
 from utils.logger import logger
 
+TRANSCRIBE_PROMPT = (
+    "Расшифруй это голосовое сообщение дословно на языке оригинала. "
+    "Верни только текст расшифровки, без комментариев. Код и термины пиши как есть."
+)
+
 class GeminiClient:
-    """Клиент для работы с Gemini API"""
-    
+    """Клиент для работы с Gemini API
+
+    Для каждого метода есть синхронная версия и асинхронная (`*_async`),
+    которая использует `client.aio` и не блокирует event loop бота.
+    Запросы идут через GeminiTransport (повторы, дедлайны, circuit breaker,
+    слоты планировщика); ошибки бросаются как GeminiError, а не
+    возвращаются текстом ответа.
+
+    google.genai импортируется внутри методов: модуль импортируется при
+    запуске бота, а сам клиент создается при первом запросе или прогреве.
+    """
+
     def __init__(self):
-        self.client = genai.Client(api_key=GEMINI_API_KEY)
+        from google import genai
+
+        self.client = genai.Client(
+            api_key=GEMINI_API_KEY,
+            http_options={'timeout': int(GEMINI_REQUEST_TIMEOUT * 1000)}
+        )
+        self.transport = GeminiTransport(self.client)
+        # Выбор модели под запрос и переключение при перегрузке
+        self.router = ModelRouter(self.transport)
+        # Статические system prompt'ы, кэшируемые на стороне Gemini
+        self.prompts = PromptCache(self.client)
+        # Файлы, загруженные в File API (без повторных загрузок)
+        self.files = FileRegistry(self.client, self.transport)
         logger.info("Gemini клиент инициализирован")
-    
-    def generate_text(self, messages: list, system_prompt: str = None) -> str:
-        """Генерация текстового ответа"""
-        try:
-            contents = []
-            
-            # Добавляем system prompt если есть
-            if system_prompt:
-                contents.append({
-                    "role": "user",
-                    "parts": [{"text": system_prompt}]
-                })
-                contents.append({
-                    "role": "model",
-                    "parts": [{"text": "Понял, буду следовать инструкциям."}]
-                })
-            
-            # Добавляем историю
-            for msg in messages:
-                role = "user" if msg["role"] == "user" else "model"
-                contents.append({
-                    "role": role,
-                    "parts": [{"text": msg["content"]}]
-                })
-            
-            response = self.client.models.generate_content(
-                model=GEMINI_TEXT_MODEL,
-                contents=contents
-            )
-            
-            return response.text
-            
-        except Exception as e:
-            logger.error(f"Ошибка генерации текста: {e}")
-            return f"Ошибка: {str(e)}"
-    
-    def analyze_image(self, image_bytes: bytes, caption: str, history: list) -> str:
-        """Анализ изображения"""
-        try:
-            image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-            
-            contents = []
-            
-            # Добавляем историю
-            for msg in history[-5:]:  # Последние 5 сообщений
-                role = "user" if msg["role"] == "user" else "model"
-                contents.append({
-                    "role": role,
-                    "parts": [{"text": msg["content"]}]
-                })
-            
-            # Добавляем текущее изображение
-            parts = [{"text": caption}] if caption else [{"text": "Проанализируй это изображение"}]
-            parts.append({
-                "inline_data": {
-                    "mime_type": "image/jpeg",
-                    "data": image_base64
-                }
-            })
-            
+
+    # ---------- Формирование запросов ----------
+
+    @staticmethod
+    def _history_to_contents(messages: list) -> list:
+        """Преобразовать историю сообщений в contents для Gemini"""
+        contents = []
+        for msg in messages:
+            role = "user" if msg["role"] == "user" else "model"
             contents.append({
-                "role": "user",
-                "parts": parts
+                "role": role,
+                "parts": [{"text": msg["content"]}]
             })
-            
-            response = self.client.models.generate_content(
-                model=GEMINI_VISION_MODEL,
-                contents=contents
+        return contents
+
+    def _text_contents(self, messages: list, system_prompt: str = None) -> list:
+        """Собрать contents для текстового запроса"""
+        contents = []
+
+        # Добавляем system prompt если есть
+        if system_prompt:
+            contents.extend(system_prompt_contents(system_prompt))
+
+        # Добавляем историю
+        contents.extend(self._history_to_contents(messages))
+        return contents
+
+    def _text_request(self, messages: list, system_prompt: str = None, prefix: str = None,
+                      model: str = GEMINI_TEXT_MODEL):
+        """contents и config текстового запроса
+
+        prefix - имя зарегистрированного в self.prompts префикса. Если он
+        закэширован на сервере для этой модели, передается только ссылка на
+        кэш, иначе заранее собранный префикс подставляется инлайн.
+        """
+        if not prefix:
+            return self._text_contents(messages, system_prompt), None, None
+
+        registered, cache_name = self.prompts.resolve(prefix, model)
+        history = self._history_to_contents(messages)
+        if cache_name:
+            from google.genai import types
+            return history, types.GenerateContentConfig(cached_content=cache_name), cache_name
+        return registered.contents + history, None, None
+
+    def _image_contents(self, image_bytes: bytes, caption: str, history: list,
+                        mime_type: str = "image/jpeg") -> list:
+        """Собрать contents для анализа изображения"""
+        from google.genai import types
+
+        # Последние 5 сообщений истории
+        contents = self._history_to_contents(history[-5:])
+
+        # Добавляем текущее изображение (байты передаются без промежуточной base64-копии)
+        parts = [{"text": caption}] if caption else [{"text": "Проанализируй это изображение"}]
+        parts.append(types.Part.from_bytes(data=image_bytes, mime_type=mime_type))
+
+        contents.append({
+            "role": "user",
+            "parts": parts
+        })
+        return contents
+
+    def _audio_contents(self, audio_bytes: bytes, history: list) -> list:
+        """Собрать contents для обработки голосового сообщения"""
+        audio_base64 = base64.b64encode(audio_bytes).decode('utf-8')
+
+        contents = self._history_to_contents(history[-5:])
+
+        # Добавляем аудио
+        contents.append({
+            "role": "user",
+            "parts": [{
+                "inline_data": {
+                    "mime_type": "audio/ogg",
+                    "data": audio_base64
+                }
+            }]
+        })
+        return contents
+
+    @staticmethod
+    def _prepare_tts_text(text: str) -> str:
+        """Подготовить текст для TTS"""
+        # Ограничиваем длину текста для TTS (макс 500 символов)
+        if len(text) > 500:
+            text = text[:500] + "..."
+        return text
+
+    @staticmethod
+    def _tts_config(voice: str = TTS_VOICE):
+        """Конфигурация запроса к TTS модели"""
+        from google.genai import types
+
+        return types.GenerateContentConfig(
+            response_modalities=["AUDIO"],
+            speech_config=types.SpeechConfig(
+                voice_config=types.VoiceConfig(
+                    prebuilt_voice_config=types.PrebuiltVoiceConfig(
+                        voice_name=voice
+                    )
+                )
             )
-            
-            return response.text
-            
-        except Exception as e:
-            logger.error(f"Ошибка анализа изображения: {e}")
-            return f"Ошибка: {str(e)}"
-    
+        )
+
+    @staticmethod
+    def _tts_prompt(text: str) -> str:
+        return f"Прочитай этот текст естественно на русском языке: {text}"
+
+    @staticmethod
+    def _extract_pcm(response) -> bytes:
+        """Извлечь PCM (16 бит, моно, 24kHz) из ответа TTS"""
+        audio_data = None
+        if response.candidates and response.candidates[0].content.parts:
+            for part in response.candidates[0].content.parts:
+                if part.inline_data:
+                    audio_data = part.inline_data.data
+                    break
+
+        if not audio_data:
+            logger.warning("Не найдено audio_data в ответе")
+            return None
+
+        # Декодируем байты
+        audio_bytes = base64.b64decode(audio_data) if isinstance(audio_data, str) else audio_data
+
+        logger.info(f"Получено PCM данных: {len(audio_bytes)} bytes")
+        return audio_bytes
+
+    @classmethod
+    def _extract_wav(cls, response) -> bytes:
+        """Извлечь PCM из ответа TTS и упаковать в WAV"""
+        audio_bytes = cls._extract_pcm(response)
+        if not audio_bytes:
+            return None
+
+        # Создаем правильную структуру WAV файла
+        wav_buffer = io.BytesIO()
+        with wave.open(wav_buffer, 'wb') as wav_file:
+            wav_file.setnchannels(1)      # 1 канал (моно)
+            wav_file.setsampwidth(2)      # 2 байта (16 бит)
+            wav_file.setframerate(24000)  # Частота 24kHz
+            wav_file.writeframes(audio_bytes)
+
+        wav_bytes = wav_buffer.getvalue()
+        logger.info(f"WAV файл создан: {len(wav_bytes)} bytes")
+        return wav_bytes
+
+    # ---------- Синхронный API ----------
+    # Ошибки API бросаются как GeminiError (см. services/transport)
+
+    def generate_text(self, messages: list, system_prompt: str = None) -> str:
+        """Генерация текстового ответа"""
+        response = self.transport.call_sync(GEMINI_TEXT_MODEL, lambda: self.client.models.generate_content(
+            model=GEMINI_TEXT_MODEL,
+            contents=self._text_contents(messages, system_prompt)
+        ))
+        return response.text
+
+    def analyze_image(self, image_bytes: bytes, caption: str, history: list,
+                      mime_type: str = "image/jpeg") -> str:
+        """Анализ изображения"""
+        response = self.transport.call_sync(GEMINI_VISION_MODEL, lambda: self.client.models.generate_content(
+            model=GEMINI_VISION_MODEL,
+            contents=self._image_contents(image_bytes, caption, history, mime_type)
+        ))
+        return response.text
+
     def process_audio(self, audio_bytes: bytes, history: list) -> str:
         """Обработка голосового сообщения"""
-        try:
-            audio_base64 = base64.b64encode(audio_bytes).decode('utf-8')
-            
-            contents = []
-            
-            # Добавляем историю
-            for msg in history[-5:]:
-                role = "user" if msg["role"] == "user" else "model"
-                contents.append({
-                    "role": role,
-                    "parts": [{"text": msg["content"]}]
-                })
-            
-            # Добавляем аудио
-            contents.append({
-                "role": "user",
-                "parts": [{
-                    "inline_data": {
-                        "mime_type": "audio/ogg",
-                        "data": audio_base64
-                    }
-                }]
-            })
-            
-            response = self.client.models.generate_content(
-                model=GEMINI_AUDIO_MODEL,
-                contents=contents
-            )
-            
-            return response.text
-            
-        except Exception as e:
-            logger.error(f"Ошибка обработки аудио: {e}")
-            return f"Ошибка: {str(e)}"
-    
+        response = self.transport.call_sync(GEMINI_AUDIO_MODEL, lambda: self.client.models.generate_content(
+            model=GEMINI_AUDIO_MODEL,
+            contents=self._audio_contents(audio_bytes, history)
+        ))
+        return response.text
+
     def analyze_document(self, file_path: str, query: str = None) -> str:
         """Анализ документа через File API"""
-        try:
-            # Загружаем файл в Gemini
-            file_ref = self.client.files.upload(file=file_path)
-            
-            # Ждем обработки
-            import time
-            while file_ref.state.name == "PROCESSING":
-                time.sleep(1)
-                file_ref = self.client.files.get(name=file_ref.name)
-            
-            if file_ref.state.name == "FAILED":
-                return "Ошибка обработки файла"
-            
-            # Анализируем
-            prompt = query if query else "Проанализируй этот документ и дай краткое описание содержимого"
-            
-            response = self.client.models.generate_content(
-                model=GEMINI_TEXT_MODEL,
-                contents=[file_ref, prompt]
-            )
-            
-            return response.text
-            
-        except Exception as e:
-            logger.error(f"Ошибка анализа документа: {e}")
-            return f"Ошибка: {str(e)}"
-    
+        # Загружаем файл в Gemini
+        file_ref = self.transport.call_sync(GEMINI_TEXT_MODEL, lambda: self.client.files.upload(file=file_path))
+
+        # Ждем обработки (с растущей паузой между проверками)
+        import time
+        delay = FILE_POLL_INITIAL_DELAY
+        while file_ref.state.name == "PROCESSING":
+            time.sleep(delay)
+            delay = min(delay * 2, FILE_POLL_MAX_DELAY)
+            file_ref = self.client.files.get(name=file_ref.name)
+
+        if file_ref.state.name == "FAILED":
+            raise FileProcessingError(f"Ошибка обработки файла {file_ref.name}")
+
+        # Анализируем
+        prompt = query if query else "Проанализируй этот документ и дай краткое описание содержимого"
+
+        response = self.transport.call_sync(GEMINI_TEXT_MODEL, lambda: self.client.models.generate_content(
+            model=GEMINI_TEXT_MODEL,
+            contents=[file_ref, prompt]
+        ))
+        return response.text
+
     def generate_audio(self, text: str) -> bytes:
         """Генерация аудио через Gemini TTS"""
         try:
-            # Ограничиваем длину текста для TTS (макс 500 символов)
-            if len(text) > 500:
-                text = text[:500] + "..."
-            
+            text = self._prepare_tts_text(text)
             logger.info(f"Генерация аудио для текста: {text[:50]}...")
-            
-            response = self.client.models.generate_content(
-                model="models/gemini-2.5-flash-preview-tts",
-                contents=f"Прочитай этот текст естественно на русском языке: {text}",
-                config=types.GenerateContentConfig(
-                    response_modalities=["AUDIO"],
-                    speech_config=types.SpeechConfig(
-                        voice_config=types.VoiceConfig(
-                            prebuilt_voice_config=types.PrebuiltVoiceConfig(
-                                voice_name="Fenrir"
-                            )
-                        )
-                    )
+
+            response = self.transport.call_sync(GEMINI_TTS_MODEL, lambda: self.client.models.generate_content(
+                model=GEMINI_TTS_MODEL,
+                contents=self._tts_prompt(text),
+                config=self._tts_config()
+            ))
+
+            return self._extract_wav(response)
+
+        except Exception as e:
+            logger.exception(f"Ошибка генерации аудио: {e}")
+            return None
+
+    # ---------- Асинхронный API ----------
+
+    async def generate_text_async(self, messages: list, system_prompt: str = None, prefix: str = None,
+                                  route: Route = None) -> str:
+        """Генерация текстового ответа (async)
+
+        route - маршрут из self.router.classify(); по умолчанию обычная модель.
+        """
+        async def call(model: str, attempts: int):
+            contents, config, cache_name = self._text_request(messages, system_prompt, prefix, model)
+            try:
+                return await self.transport.call(
+                    model,
+                    lambda: self.client.aio.models.generate_content(
+                        model=model,
+                        contents=contents,
+                        config=config
+                    ),
+                    modality="text",
+                    hedge=True,
+                    attempts=attempts
                 )
+            except GeminiRequestError as e:
+                if not cache_name:
+                    raise
+                # Кэш мог истечь на сервере - повторяем с инлайн-промптом
+                logger.warning(f"Ошибка запроса с кэшем префикса, повтор без кэша: {e}")
+                self.prompts.invalidate(prefix, model)
+                inline_contents = self.prompts.get(prefix).contents + contents
+                return await self.transport.call(
+                    model,
+                    lambda: self.client.aio.models.generate_content(
+                        model=model,
+                        contents=inline_contents
+                    ),
+                    modality="text",
+                    hedge=True,
+                    attempts=attempts
+                )
+
+        response = await self.router.run(route or self.router.route("default"), call)
+        return response.text
+
+    async def stream_text_async(self, messages: list, system_prompt: str = None, prefix: str = None,
+                                route: Route = None):
+        """Потоковая генерация текста: отдает фрагменты ответа по мере готовности"""
+        stream = self.router.stream(
+            route or self.router.route("default"),
+            lambda model, attempts: self._stream_text(model, messages, system_prompt, prefix, attempts)
+        )
+        async for chunk in stream:
+            if chunk.text:
+                yield chunk.text
+
+    async def _stream_text(self, model: str, messages: list, system_prompt: str, prefix: str, attempts: int):
+        """Поток ответа одной модели (фрагменты ответа SDK)
+
+        Используется синхронный generate_content_stream: aio-версия SDK читает
+        ответ в event loop, а транспорт читает синхронный поток в отдельном потоке.
+        """
+        contents, config, cache_name = self._text_request(messages, system_prompt, prefix, model)
+        stream = self.transport.stream(
+            model,
+            lambda: self.client.models.generate_content_stream(
+                model=model,
+                contents=contents,
+                config=config
+            ),
+            attempts=attempts
+        )
+        started = False
+        try:
+            async for chunk in stream:
+                started = True
+                yield chunk
+            return
+        except GeminiRequestError as e:
+            if not cache_name or started:
+                raise
+            # Кэш мог истечь на сервере - повторяем с инлайн-промптом
+            logger.warning(f"Ошибка запроса с кэшем префикса, повтор без кэша: {e}")
+            self.prompts.invalidate(prefix, model)
+
+        inline_contents = self.prompts.get(prefix).contents + contents
+        async for chunk in self.transport.stream(
+            model,
+            lambda: self.client.models.generate_content_stream(
+                model=model,
+                contents=inline_contents
+            ),
+            attempts=attempts
+        ):
+            yield chunk
+
+    async def analyze_image_async(self, image_bytes: bytes, caption: str, history: list,
+                                  mime_type: str = "image/jpeg", route: Route = None) -> str:
+        """Анализ изображения (async)"""
+        contents = self._image_contents(image_bytes, caption, history, mime_type)
+        response = await self.router.run(
+            route or self.router.route("default", "image"),
+            lambda model, attempts: self.transport.call(
+                model,
+                lambda: self.client.aio.models.generate_content(model=model, contents=contents),
+                modality="vision",
+                hedge=True,
+                attempts=attempts
             )
-            
-            # Извлекаем аудио из ответа
-            audio_data = None
-            if response.candidates and response.candidates[0].content.parts:
-                for part in response.candidates[0].content.parts:
-                    if part.inline_data:
-                        audio_data = part.inline_data.data
-                        break
-            
-            if audio_data:
-                # Декодируем байты
-                audio_bytes = base64.b64decode(audio_data) if isinstance(audio_data, str) else audio_data
-                
-                logger.info(f"Получено PCM данных: {len(audio_bytes)} bytes")
-                
-                # Создаем правильную структуру WAV файла
-                wav_buffer = io.BytesIO()
-                with wave.open(wav_buffer, 'wb') as wav_file:
-                    wav_file.setnchannels(1)      # 1 канал (моно)
-                    wav_file.setsampwidth(2)      # 2 байта (16 бит)
-                    wav_file.setframerate(24000)  # Частота 24kHz
-                    wav_file.writeframes(audio_bytes)
-                
-                wav_bytes = wav_buffer.getvalue()
-                logger.info(f"WAV файл создан: {len(wav_bytes)} bytes")
-                return wav_bytes
-            
-            logger.warning("Не найдено audio_data в ответе")
-            return None
-            
+        )
+        return response.text
+
+    async def process_audio_async(self, audio_bytes: bytes, history: list) -> str:
+        """Обработка голосового сообщения (async)"""
+        contents = self._audio_contents(audio_bytes, history)
+        response = await self.router.run(
+            self.router.route("default", "audio"),
+            lambda model, attempts: self.transport.call(
+                model,
+                lambda: self.client.aio.models.generate_content(model=model, contents=contents),
+                modality="audio",
+                attempts=attempts
+            )
+        )
+        return response.text
+
+    async def analyze_document_async(self, source, query: str = None, mime_type: str = None,
+                                     display_name: str = None) -> str:
+        """Анализ документа через File API (async)
+
+        source - путь к файлу или байты. Одинаковые файлы загружаются один раз
+        и переиспользуются, пока ссылка в File API не истекла.
+        """
+        file_part = await self.files.acquire(source, mime_type, display_name)
+
+        prompt = query if query else "Проанализируй этот документ и дай краткое описание содержимого"
+
+        response = await self.router.run(
+            self.router.classify(prompt, attachment="document"),
+            lambda model, attempts: self.transport.call(
+                model,
+                lambda: self.client.aio.models.generate_content(
+                    model=model,
+                    contents=[file_part, prompt]
+                ),
+                modality="document",
+                attempts=attempts
+            )
+        )
+        return response.text
+
+    async def generate_audio_async(self, text: str) -> bytes:
+        """Генерация аудио через Gemini TTS (async)"""
+        try:
+            text = self._prepare_tts_text(text)
+            logger.info(f"Генерация аудио для текста: {text[:50]}...")
+
+            response = await self.transport.call(
+                GEMINI_TTS_MODEL,
+                lambda: self.client.aio.models.generate_content(
+                    model=GEMINI_TTS_MODEL,
+                    contents=self._tts_prompt(text),
+                    config=self._tts_config()
+                ),
+                modality="tts"
+            )
+
+            return self._extract_wav(response)
+
         except Exception as e:
-            logger.error(f"Ошибка генерации аудио: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.error(f"Ошибка генерации аудио: {e}", exc_info=True)
             return None
 
-# Глобальный экземпляр
-gemini_client = GeminiClient()
+    async def synthesize_speech_async(self, text: str, voice: str = TTS_VOICE) -> bytes:
+        """Синтез речи без ограничения длины, возвращает сырой PCM (async)
+
+        Длинный текст нужно заранее разбить на фрагменты (см. services/voice_pipeline).
+        """
+        response = await self.transport.call(
+            GEMINI_TTS_MODEL,
+            lambda: self.client.aio.models.generate_content(
+                model=GEMINI_TTS_MODEL,
+                contents=self._tts_prompt(text),
+                config=self._tts_config(voice)
+            ),
+            modality="tts"
+        )
+        return self._extract_pcm(response)
+
+    async def transcribe_audio_async(self, audio_bytes: bytes, mime_type: str = "audio/ogg") -> str:
+        """Дословная расшифровка аудио (async)
+
+        В отличие от process_audio_async не отвечает на содержание. Ошибка
+        бросается, чтобы неудачная расшифровка не попала в кэш.
+        """
+        from google.genai import types
+
+        contents = [{
+            "role": "user",
+            "parts": [
+                {"text": TRANSCRIBE_PROMPT},
+                types.Part.from_bytes(data=audio_bytes, mime_type=mime_type),
+            ]
+        }]
+        response = await self.router.run(
+            self.router.route("default", "audio"),
+            lambda model, attempts: self.transport.call(
+                model,
+                lambda: self.client.aio.models.generate_content(model=model, contents=contents),
+                modality="audio",
+                hedge=True,
+                attempts=attempts
+            )
+        )
+        return (response.text or "").strip()
+
+# Глобальный экземпляр (создается при первом обращении)
+gemini_client = LazyProvider(GeminiClient, "gemini_client")
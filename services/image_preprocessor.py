@@ -0,0 +1,138 @@
+"""Предобработка изображений перед отправкой в vision-модель"""
+import asyncio
+import hashlib
+import io
+from typing import Optional
+from config import IMAGE_TARGET_SIDE, IMAGE_JPEG_QUALITY, IMAGE_ANALYSIS_CACHE_SIZE, IMAGE_ANALYSIS_TTL
+from services.answer_cache import normalize_question
+from utils.logger import logger
+from utils.shared_cache import SharedCache
+
+# Форматы, которые Gemini принимает без перекодирования
+SUPPORTED_FORMATS = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+class PreparedImage:
+    """Изображение, готовое к отправке"""
+    __slots__ = ('data', 'mime_type', 'key', 'width', 'height')
+
+    def __init__(self, data: bytes, mime_type: str, key: str, width: int = 0, height: int = 0):
+        self.data = data
+        self.mime_type = mime_type
+        self.key = key
+        self.width = width
+        self.height = height
+
+def preprocess_image(data: bytes, target_side: int = IMAGE_TARGET_SIDE,
+                     quality: int = IMAGE_JPEG_QUALITY) -> PreparedImage:
+    """Уменьшить изображение до target_side по длинной стороне и перекодировать в JPEG
+
+    Небольшие изображения в поддерживаемом формате отправляются как есть.
+    Ключ - sha256 исходных байтов: анализ переиспользуется только для
+    точно такого же файла.
+    """
+    from PIL import Image
+
+    key = hashlib.sha256(data).hexdigest()
+    with Image.open(io.BytesIO(data)) as image:
+        image.load()
+        width, height = image.size
+        mime_type = SUPPORTED_FORMATS.get(image.format)
+
+        if mime_type and max(width, height) <= target_side:
+            return PreparedImage(data, mime_type, key, width, height)
+
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.thumbnail((target_side, target_side), Image.LANCZOS)
+
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=quality, optimize=True)
+        return PreparedImage(buffer.getvalue(), "image/jpeg", key, *image.size)
+
+def _analysis_key(user_id: int, image_key: str, caption: str) -> str:
+    return f"{user_id}\n{image_key}\n{normalize_question(caption)}"
+
+class ImagePreprocessor:
+    """Выбор размера фото, сжатие и переиспользование прошлых анализов
+
+    Анализ запоминается в общем кэше процессов отдельно для каждого
+    пользователя по sha256 содержимого изображения и подписи, а
+    file_unique_id Telegram позволяет узнать повторное фото еще до
+    скачивания. Общий кэш - SQLite, обращения к нему идут в потоке.
+    """
+
+    def __init__(self, target_side: int = IMAGE_TARGET_SIDE,
+                 max_entries: int = IMAGE_ANALYSIS_CACHE_SIZE, ttl: float = IMAGE_ANALYSIS_TTL):
+        self.target_side = target_side
+
+        # file_unique_id -> sha256 содержимого
+        self._file_keys = SharedCache("image_keys", max_entries, ttl)
+        # пользователь + sha256 содержимого + нормализованная подпись -> анализ
+        self._analyses = SharedCache("image_analyses", max_entries, ttl)
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def pick_size(self, sizes: list):
+        """Самый маленький PhotoSize, длинная сторона которого не меньше цели"""
+        for size in sorted(sizes, key=lambda s: s.width * s.height):
+            if max(size.width, size.height) >= self.target_side:
+                return size
+        return max(sizes, key=lambda s: s.width * s.height)
+
+    async def prepare(self, data: bytes, file_unique_id: str = None) -> PreparedImage:
+        """Сжать изображение вне event loop"""
+        try:
+            image = await asyncio.to_thread(preprocess_image, data, self.target_side)
+        except Exception as e:
+            logger.warning(f"Не удалось обработать изображение, отправляется оригинал: {e}")
+            image = PreparedImage(data, "image/jpeg", hashlib.sha256(data).hexdigest())
+
+        self.bytes_in += len(data)
+        self.bytes_out += len(image.data)
+        logger.info(
+            f"Изображение {image.width}x{image.height}: "
+            f"{len(data) // 1024} КБ -> {len(image.data) // 1024} КБ ({image.mime_type})"
+        )
+
+        if file_unique_id:
+            await asyncio.to_thread(self._file_keys.set, file_unique_id, image.key)
+        return image
+
+    async def cached_analysis(self, user_id: int, caption: str, file_unique_id: str = None,
+                              image: PreparedImage = None) -> Optional[str]:
+        """Прошлый анализ того же изображения с той же подписью для этого пользователя"""
+        if image is not None:
+            key = image.key
+        else:
+            key = await asyncio.to_thread(self._file_keys.get, file_unique_id)
+        if key is None:
+            return None
+
+        analysis = await asyncio.to_thread(self._analyses.get, _analysis_key(user_id, key, caption))
+        if analysis is None:
+            if image is not None:
+                self.misses += 1
+            return None
+
+        self.hits += 1
+        logger.info(f"Анализ изображения взят из кэша ({self.hits} попаданий, {self.misses} промахов)")
+        return analysis
+
+    async def store(self, user_id: int, image: PreparedImage, caption: str, analysis: str):
+        """Запомнить анализ изображения"""
+        await asyncio.to_thread(self._analyses.set, _analysis_key(user_id, image.key, caption), analysis)
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._analyses),
+            'hits': self.hits,
+            'misses': self.misses,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+        }
+
+# Глобальный экземпляр
+image_preprocessor = ImagePreprocessor()
@@ -0,0 +1,274 @@
+"""Выбор модели Gemini под запрос: быстрая, обычная или сильная, с переключением при перегрузке"""
+import re
+import time
+from config import (
+    GEMINI_TEXT_MODEL, GEMINI_VISION_MODEL, GEMINI_AUDIO_MODEL, GEMINI_FAST_MODEL, GEMINI_STRONG_MODEL,
+    GEMINI_DEADLINES, MODEL_ROUTING, MODEL_PRICES, ROUTER_SHORT_TOKENS, ROUTER_LONG_TOKENS,
+    ROUTER_CODE_LINES, ROUTER_STRUCTURE_ITEMS, ROUTER_FAILOVER_ATTEMPTS, ROUTER_RATE_LIMIT_COOLDOWN, ROUTER_SLOW_FACTOR
+)
+from services.context_builder import estimate_tokens
+from services.transport import GeminiUnavailableError, GeminiRateLimitError, deadline
+from utils.logger import logger
+
+# Явная просьба о глубоком разборе. Общие слова вопроса ("почему", "сравни")
+# и темы ("asyncio", "алгоритм") сложность не определяют: короткий вопрос
+# с ними остается на обычном уровне
+STRONG_MARKERS = (
+    "подробно", "подробный", "подробнее", "детально", "в деталях", "пошагово", "по шагам",
+    "докажи", "ревью", "review", "спроектируй",
+)
+# Просьба объяснить: такой вопрос не отдается быстрой модели, но и
+# сильной не требует (обычный уровень)
+EXPLAIN_WORDS = ("почему", "зачем", "объясни", "сравни", "чем отличается", "в чем разница")
+_LIST_ITEM_RE = re.compile(r"^\s*(\d+[.)]|[-*•])\s+\S", re.MULTILINE)
+_CODE_LINE_RE = re.compile(
+    r"^\s*(def |class |import |from \S+ import |return\b|for .+:|while .+:|if .+:|elif |else:|try:|except|with .+:|@\w|\w+\s*=\s*\S)",
+    re.MULTILINE
+)
+_TRACEBACK_RE = re.compile(r"Traceback \(most recent call last\)|\w+Error: ")
+
+# Основная модель для вложений (для обычного уровня)
+_BASE_MODELS = {
+    "image": GEMINI_VISION_MODEL,
+    "audio": GEMINI_AUDIO_MODEL,
+}
+_MODALITIES = {
+    "image": "vision",
+    "audio": "audio",
+    "document": "document",
+}
+
+class Route:
+    """Решение маршрутизатора: уровень и модели по порядку (первая - основная)"""
+
+    __slots__ = ('tier', 'models', 'modality', 'reason')
+
+    def __init__(self, tier: str, models: list, modality: str, reason: str):
+        self.tier = tier
+        self.models = models
+        self.modality = modality
+        self.reason = reason
+
+    @property
+    def model(self) -> str:
+        return self.models[0]
+
+class ModelStats:
+    """Статистика модели: запросы, ошибки, токены, стоимость"""
+
+    __slots__ = ('requests', 'errors', 'rate_limited', 'prompt_tokens', 'output_tokens', 'cost', 'cooldown_until')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.cost = 0.0
+        self.cooldown_until = 0.0
+
+class ModelRouter:
+    """Маршрутизация запросов по моделям
+
+    - classify() по длине, структуре, режиму, коду и вложениям выбирает уровень:
+      fast (короткие вопросы, голосовой режим, служебные запросы),
+      default (обычные) или strong (код на ревью, длинные и составные вопросы,
+      явная просьба о подробном разборе, документы);
+    - run()/stream() вызывают модели маршрута по очереди: при 429/5xx или
+      разомкнутом circuit breaker запрос уходит на следующую модель;
+    - недавно ответившая 429 или заметно более медленная (по p95 из
+      транспорта) модель опускается в конец списка.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self._stats = {}
+        self.routes = {"fast": 0, "default": 0, "strong": 0}
+        self.failovers = 0
+        self.escalations = 0
+
+    # ---------- Выбор уровня ----------
+
+    def classify(self, text: str, mode: str = "text", attachment: str = None) -> Route:
+        """Маршрут для запроса
+
+        mode - режим пользователя (text, voice, rag) или служебный (summary);
+        attachment - вложение (image, audio, document).
+        """
+        if not MODEL_ROUTING:
+            return self.route("default", attachment, "маршрутизация выключена")
+
+        text = text or ""
+        lowered = text.lower()
+        tokens = estimate_tokens(text)
+        code_lines = len(_CODE_LINE_RE.findall(text)) + (ROUTER_CODE_LINES if "```" in text else 0)
+        marker = next((marker for marker in STRONG_MARKERS if marker in lowered), None)
+        # Несколько вопросов или пунктов в одном сообщении - составная задача
+        parts = max(text.count("?"), len(_LIST_ITEM_RE.findall(text)))
+        explain = any(word in lowered for word in EXPLAIN_WORDS)
+
+        if attachment == "document":
+            return self.route("strong", attachment, "анализ документа")
+        if mode == "summary":
+            return self.route("fast", attachment, "служебный запрос")
+        if code_lines >= ROUTER_CODE_LINES:
+            return self.route("strong", attachment, f"код ({code_lines} строк)")
+        if tokens >= ROUTER_LONG_TOKENS:
+            return self.route("strong", attachment, f"длинный запрос (~{tokens} токенов)")
+        if _TRACEBACK_RE.search(text) and tokens > ROUTER_SHORT_TOKENS:
+            return self.route("strong", attachment, "разбор ошибки")
+        if marker:
+            return self.route("strong", attachment, f"просьба о подробном разборе ({marker})")
+        if parts >= ROUTER_STRUCTURE_ITEMS:
+            return self.route("strong", attachment, f"составной вопрос ({parts} частей)")
+        if attachment is None and mode != "rag" and (
+            mode == "voice" or (tokens <= ROUTER_SHORT_TOKENS and not code_lines and not explain)
+        ):
+            # Голосовые ответы озвучиваются - важнее задержка
+            return self.route("fast", attachment, "голосовой режим" if mode == "voice" else "короткий вопрос")
+        return self.route("default", attachment, "обычный запрос")
+
+    def route(self, tier: str, attachment: str = None, reason: str = "") -> Route:
+        """Маршрут заданного уровня"""
+        base = _BASE_MODELS.get(attachment, GEMINI_TEXT_MODEL)
+        if tier == "fast":
+            models = [GEMINI_FAST_MODEL, base]
+        elif tier == "strong":
+            models = [GEMINI_STRONG_MODEL, base]
+        else:
+            models = [base, GEMINI_FAST_MODEL]
+        self.routes[tier] += 1
+        route = Route(tier, list(dict.fromkeys(models)), _MODALITIES.get(attachment, "text"), reason)
+        logger.debug(f"Маршрут: {tier} ({reason}) -> {route.models}")
+        return route
+
+    def candidates(self, route: Route) -> list:
+        """Модели маршрута в порядке попыток с учетом состояния моделей"""
+        now = time.monotonic()
+        healthy = []
+        degraded = []
+        for model in route.models:
+            stats = self.stats_for(model)
+            if stats.cooldown_until > now or self.transport.breaker(model).state == "open":
+                degraded.append(model)
+            else:
+                healthy.append(model)
+
+        # Основная модель сильно медленнее запасной - начинаем с запасной
+        if len(healthy) > 1:
+            primary = self.transport.latency(healthy[0]).percentile(0.95)
+            fallback = self.transport.latency(healthy[1]).percentile(0.95)
+            if primary and fallback and primary > fallback * ROUTER_SLOW_FACTOR:
+                healthy[0], healthy[1] = healthy[1], healthy[0]
+        return healthy + degraded
+
+    # ---------- Выполнение ----------
+
+    async def run(self, route: Route, call):
+        """Выполнить запрос по маршруту
+
+        call(model, attempts) - корутина с ответом модели. Пустой ответ
+        быстрой модели повторяется на обычном уровне.
+        """
+        with deadline(GEMINI_DEADLINES.get(route.modality, GEMINI_DEADLINES["text"])):
+            response = await self._run(route, call)
+            if route.tier == "fast" and not (getattr(response, "text", None) or "").strip():
+                self.escalations += 1
+                logger.info("Пустой ответ быстрой модели, запрос повторяется на обычном уровне")
+                response = await self._run(self.route("default", None, "эскалация"), call)
+        return response
+
+    async def stream(self, route: Route, open_stream):
+        """Потоковый запрос по маршруту
+
+        open_stream(model, attempts) - асинхронный итератор фрагментов.
+        На запасную модель переключаемся, только пока ничего не отдано.
+        """
+        models = self.candidates(route)
+        for i, model in enumerate(models):
+            last = i == len(models) - 1
+            stats = self.stats_for(model)
+            stats.requests += 1
+            usage = None
+            started = False
+            try:
+                async for chunk in open_stream(model, None if last else ROUTER_FAILOVER_ATTEMPTS):
+                    started = True
+                    usage = getattr(chunk, "usage_metadata", None) or usage
+                    yield chunk
+            except GeminiUnavailableError as e:
+                self._record_failure(model, e)
+                if started or last:
+                    raise
+                self._failover(model, models[i + 1], e)
+                continue
+            self._record_usage(model, usage)
+            return
+
+    async def _run(self, route: Route, call):
+        models = self.candidates(route)
+        for i, model in enumerate(models):
+            last = i == len(models) - 1
+            stats = self.stats_for(model)
+            stats.requests += 1
+            try:
+                response = await call(model, None if last else ROUTER_FAILOVER_ATTEMPTS)
+            except GeminiUnavailableError as e:
+                self._record_failure(model, e)
+                if last:
+                    raise
+                self._failover(model, models[i + 1], e)
+                continue
+            self._record_usage(model, getattr(response, "usage_metadata", None))
+            return response
+
+    # ---------- Статистика ----------
+
+    def stats_for(self, model: str) -> ModelStats:
+        stats = self._stats.get(model)
+        if stats is None:
+            stats = self._stats[model] = ModelStats()
+        return stats
+
+    def stats(self) -> dict:
+        models = {}
+        for model, stats in self._stats.items():
+            latency = self.transport.latency(model)
+            models[model] = {
+                'requests': stats.requests,
+                'errors': stats.errors,
+                'rate_limited': stats.rate_limited,
+                'prompt_tokens': stats.prompt_tokens,
+                'output_tokens': stats.output_tokens,
+                'cost_usd': round(stats.cost, 6),
+                'p50': latency.percentile(0.5, min_samples=1),
+                'p95': latency.percentile(0.95),
+            }
+        return {
+            'routes': dict(self.routes),
+            'failovers': self.failovers,
+            'escalations': self.escalations,
+            'models': models,
+        }
+
+    def _record_usage(self, model: str, usage):
+        if usage is None:
+            return
+        stats = self.stats_for(model)
+        prompt_tokens = usage.prompt_token_count or 0
+        output_tokens = usage.candidates_token_count or 0
+        stats.prompt_tokens += prompt_tokens
+        stats.output_tokens += output_tokens
+        input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+        stats.cost += (prompt_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+    def _record_failure(self, model: str, error: Exception):
+        stats = self.stats_for(model)
+        stats.errors += 1
+        if isinstance(error, GeminiRateLimitError):
+            stats.rate_limited += 1
+            stats.cooldown_until = time.monotonic() + ROUTER_RATE_LIMIT_COOLDOWN
+
+    def _failover(self, model: str, fallback: str, error: Exception):
+        self.failovers += 1
+        logger.warning(f"Модель {model} недоступна ({type(error).__name__}), запрос переключен на {fallback}")
@@ -0,0 +1,151 @@
+"""Кэш статических префиксов промптов (system prompt) через Gemini cached content"""
+import asyncio
+import time
+from config import (
+    PROMPT_CACHE_ENABLED, PROMPT_CACHE_TTL, PROMPT_CACHE_REFRESH_MARGIN, PROMPT_CACHE_RETRY_INTERVAL,
+    PROMPT_CACHE_MIN_TOKENS
+)
+from services.context_builder import estimate_tokens
+from utils.logger import logger
+
+SYSTEM_PROMPT_ACK = "Понял, буду следовать инструкциям."
+
+def system_prompt_contents(system_prompt: str) -> list:
+    """Префикс contents для system prompt"""
+    return [
+        {"role": "user", "parts": [{"text": system_prompt}]},
+        {"role": "model", "parts": [{"text": SYSTEM_PROMPT_ACK}]},
+    ]
+
+class PromptPrefix:
+    """Зарегистрированный статический префикс"""
+    __slots__ = ('name', 'system_prompt', 'contents', 'tokens', 'cacheable', 'caches')
+
+    def __init__(self, name: str, system_prompt: str):
+        self.name = name
+        self.system_prompt = system_prompt
+        # Собирается один раз и переиспользуется во всех запросах
+        self.contents = system_prompt_contents(system_prompt)
+        self.tokens = estimate_tokens(system_prompt) + estimate_tokens(SYSTEM_PROMPT_ACK)
+        # Короче минимума cached content сервер кэш не создаст
+        self.cacheable = self.tokens >= PROMPT_CACHE_MIN_TOKENS
+        # Кэш привязан к модели: model -> CachedPrefix
+        self.caches = {}
+
+class CachedPrefix:
+    """Cached content префикса для одной модели"""
+    __slots__ = ('model', 'cache_name', 'expires_at', 'retry_at')
+
+    def __init__(self, model: str):
+        self.model = model
+        self.cache_name = None
+        self.expires_at = 0.0
+        self.retry_at = 0.0
+
+class PromptCache:
+    """Реестр префиксов с серверным кэшированием
+
+    Префикс загружается в Gemini как cached content отдельно для каждой
+    модели, которой он нужен, и дальше передается по имени. Кэш
+    продлевается в фоне до истечения TTL. Если кэш недоступен (выключен,
+    модель не поддерживает, префикс короче PROMPT_CACHE_MIN_TOKENS),
+    используется обычный инлайн-промпт.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._prefixes = {}
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def register(self, name: str, system_prompt: str) -> PromptPrefix:
+        """Зарегистрировать статический префикс"""
+        prefix = PromptPrefix(name, system_prompt)
+        self._prefixes[name] = prefix
+        if PROMPT_CACHE_ENABLED and not prefix.cacheable:
+            logger.info(
+                f"Префикс '{name}' (~{prefix.tokens} токенов) короче минимума cached content "
+                f"({PROMPT_CACHE_MIN_TOKENS}), серверный кэш для него выключен"
+            )
+        return prefix
+
+    def get(self, name: str) -> PromptPrefix:
+        return self._prefixes[name]
+
+    def resolve(self, name: str, model: str):
+        """Вернуть (prefix, имя cached content для модели или None)
+
+        Никогда не ждет сети: создание и продление кэша идут в фоне.
+        """
+        prefix = self._prefixes[name]
+        if not PROMPT_CACHE_ENABLED or not prefix.cacheable:
+            return prefix, None
+
+        cached = prefix.caches.get(model)
+        if cached is None:
+            cached = prefix.caches[model] = CachedPrefix(model)
+
+        now = time.time()
+        if cached.cache_name and now < cached.expires_at:
+            if cached.expires_at - now < PROMPT_CACHE_REFRESH_MARGIN:
+                self._spawn(prefix, cached, self._refresh)
+            self.hits += 1
+            return prefix, cached.cache_name
+
+        if now >= cached.retry_at:
+            self._spawn(prefix, cached, self._create)
+        self.misses += 1
+        return prefix, None
+
+    def invalidate(self, name: str, model: str):
+        """Сбросить кэш префикса для модели (например, если сервер его не нашел)"""
+        prefix = self._prefixes.get(name)
+        cached = prefix.caches.get(model) if prefix else None
+        if cached:
+            cached.cache_name = None
+            cached.expires_at = 0.0
+
+    def _spawn(self, prefix: PromptPrefix, cached: CachedPrefix, action):
+        key = (prefix.name, cached.model)
+        if key in self._pending:
+            return
+        task = asyncio.create_task(action(prefix, cached))
+        self._pending[key] = task
+        task.add_done_callback(lambda _: self._pending.pop(key, None))
+
+    async def _create(self, prefix: PromptPrefix, cached: CachedPrefix):
+        from google.genai import types
+
+        try:
+            cache = await self.client.aio.caches.create(
+                model=cached.model,
+                config=types.CreateCachedContentConfig(
+                    contents=prefix.contents,
+                    display_name=f"prefix-{prefix.name}",
+                    ttl=f"{PROMPT_CACHE_TTL}s",
+                )
+            )
+            cached.cache_name = cache.name
+            cached.expires_at = time.time() + PROMPT_CACHE_TTL
+            logger.info(f"Префикс '{prefix.name}' закэширован для {cached.model}: {cache.name}")
+        except Exception as e:
+            # Не пробуем снова на каждом запросе
+            cached.retry_at = time.time() + PROMPT_CACHE_RETRY_INTERVAL
+            logger.warning(
+                f"Не удалось закэшировать префикс '{prefix.name}' для {cached.model}, используется инлайн: {e}"
+            )
+
+    async def _refresh(self, prefix: PromptPrefix, cached: CachedPrefix):
+        from google.genai import types
+
+        try:
+            await self.client.aio.caches.update(
+                name=cached.cache_name,
+                config=types.UpdateCachedContentConfig(ttl=f"{PROMPT_CACHE_TTL}s")
+            )
+            cached.expires_at = time.time() + PROMPT_CACHE_TTL
+            logger.debug(f"Кэш префикса '{prefix.name}' для {cached.model} продлен")
+        except Exception as e:
+            logger.warning(f"Не удалось продлить кэш префикса '{prefix.name}' для {cached.model}: {e}")
+            self.invalidate(prefix.name, cached.model)
@@ -0,0 +1,119 @@
+"""Планировщик запросов: порядок сообщений пользователя и лимиты на Gemini"""
+import asyncio
+import functools
+import time
+from contextlib import asynccontextmanager
+from telegram import Update
+from telegram.ext import ContextTypes
+from config import GEMINI_MAX_CONCURRENCY, GEMINI_MODALITY_LIMITS, SCHEDULER_MAX_PENDING
+from utils.logger import logger, log_context
+from utils.startup import startup
+
+OVERLOAD_MESSAGE = "⏳ Сейчас слишком много запросов. Попробуй еще раз через минуту."
+
+class RequestScheduler:
+    """Планировщик между Telegram и обработчиками
+
+    - апдейты одного пользователя обрабатываются строго по очереди (FIFO),
+      апдейты разных пользователей - параллельно;
+    - общее число запросов к Gemini ограничено глобальным семафором,
+      а дорогие модальности (vision, TTS, ...) - дополнительно своими;
+    - если в очереди больше max_pending запросов, новые тяжелые запросы
+      отклоняются с сообщением о перегрузке.
+    """
+
+    def __init__(self, max_pending: int = SCHEDULER_MAX_PENDING,
+                 gemini_limit: int = GEMINI_MAX_CONCURRENCY,
+                 modality_limits: dict = None):
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+
+        self._user_locks = {}
+        self._user_waiters = {}
+
+        self._gemini = asyncio.Semaphore(gemini_limit)
+        self._modalities = {
+            name: asyncio.Semaphore(limit)
+            for name, limit in (modality_limits or GEMINI_MODALITY_LIMITS).items()
+        }
+
+    def wrap(self, handler, modality: str = None):
+        """Обернуть обработчик
+
+        modality - тип тяжелого запроса; для таких обработчиков действует
+        ограничение очереди. Команды (modality=None) только упорядочиваются.
+        """
+        @functools.wraps(handler)
+        async def wrapped(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            user = update.effective_user
+            if user is None:
+                return await handler(update, context)
+
+            if modality and self.pending >= self.max_pending:
+                self.rejected += 1
+                logger.warning(
+                    f"Перегрузка: {self.pending} запросов в очереди, "
+                    f"запрос {modality} от {user.id} отклонен"
+                )
+                if update.effective_message:
+                    await update.effective_message.reply_text(OVERLOAD_MESSAGE)
+                return
+
+            started = time.perf_counter()
+            # user_id и update_id попадают во все записи лога этого апдейта
+            with log_context(user_id=user.id, update_id=update.update_id):
+                if modality:
+                    self.pending += 1
+                try:
+                    async with self._user_lock(user.id):
+                        return await handler(update, context)
+                finally:
+                    if modality:
+                        self.pending -= 1
+                    startup.mark("first_update")
+                    # Одна итоговая запись на апдейт: время с учетом ожидания в очереди пользователя
+                    logger.info(
+                        f"Обработан {handler.__name__}",
+                        extra={'latency_ms': round((time.perf_counter() - started) * 1000, 1)}
+                    )
+
+        return wrapped
+
+    @asynccontextmanager
+    async def _user_lock(self, user_id: int):
+        """Lock пользователя; удаляется, когда его никто не ждет"""
+        lock = self._user_locks.get(user_id)
+        if lock is None:
+            lock = self._user_locks[user_id] = asyncio.Lock()
+        self._user_waiters[user_id] = self._user_waiters.get(user_id, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._user_waiters[user_id] -= 1
+            if self._user_waiters[user_id] == 0:
+                del self._user_waiters[user_id]
+                del self._user_locks[user_id]
+
+    @asynccontextmanager
+    async def gemini_slot(self, modality: str = "text"):
+        """Слот на запрос к Gemini: сначала лимит модальности, затем глобальный"""
+        modality_semaphore = self._modalities.get(modality)
+        if modality_semaphore is not None:
+            async with modality_semaphore:
+                async with self._gemini:
+                    yield
+        else:
+            async with self._gemini:
+                yield
+
+    def stats(self) -> dict:
+        return {
+            'pending': self.pending,
+            'rejected': self.rejected,
+            'users_active': len(self._user_locks),
+        }
+
+# Глобальный экземпляр
+scheduler = RequestScheduler()
@@ -0,0 +1,102 @@
+"""Расшифровка голосовых сообщений с кэшем по file_unique_id"""
+import asyncio
+import io
+import time
+from typing import Awaitable, Callable, Optional
+from config import VOICE_CHUNK_SECONDS, TRANSCRIPT_CACHE_SIZE, TRANSCRIPT_CACHE_TTL
+from services.gemini_client import gemini_client
+from utils.logger import logger
+from utils.shared_cache import SharedCache
+
+def split_audio(data: bytes, chunk_seconds: int = VOICE_CHUNK_SECONDS) -> list:
+    """Разрезать OGG/Opus на куски по chunk_seconds (нужен ffmpeg)"""
+    from pydub import AudioSegment
+
+    audio = AudioSegment.from_file(io.BytesIO(data), format="ogg")
+    step = chunk_seconds * 1000
+    chunks = []
+    for start in range(0, len(audio), step):
+        buffer = io.BytesIO()
+        audio[start:start + step].export(buffer, format="ogg", codec="libopus")
+        chunks.append(buffer.getvalue())
+    return chunks
+
+class Transcriber:
+    """Расшифровка голосовых сообщений
+
+    Расшифровка запоминается по file_unique_id в общем кэше процессов,
+    поэтому повторные и пересланные сообщения не отправляются в Gemini. Длинные сообщения
+    режутся по длительности, куски расшифровываются параллельно и
+    склеиваются по порядку.
+    """
+
+    def __init__(self, chunk_seconds: int = VOICE_CHUNK_SECONDS,
+                 max_entries: int = TRANSCRIPT_CACHE_SIZE, ttl: float = TRANSCRIPT_CACHE_TTL):
+        self.chunk_seconds = chunk_seconds
+
+        # file_unique_id -> расшифровка
+        self._transcripts = SharedCache("transcripts", max_entries, ttl)
+        # Расшифровки в процессе: одно сообщение не расшифровывается дважды параллельно
+        self._pending = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, file_unique_id: str) -> Optional[str]:
+        """Расшифровка из кэша"""
+        return self._transcripts.get(file_unique_id)
+
+    async def transcribe(self, file_unique_id: str, download: Callable[[], Awaitable[bytes]],
+                         duration: int = 0) -> str:
+        """Расшифровать сообщение; download вызывается только при промахе кэша"""
+        transcript = self.get(file_unique_id)
+        if transcript is not None:
+            self.hits += 1
+            logger.info(f"Расшифровка взята из кэша ({self.hits} попаданий, {self.misses} промахов)")
+            return transcript
+
+        task = self._pending.get(file_unique_id)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._transcribe(download, duration))
+            self._pending[file_unique_id] = task
+            task.add_done_callback(lambda _: self._pending.pop(file_unique_id, None))
+
+        transcript = await asyncio.shield(task)
+        self._store(file_unique_id, transcript)
+        return transcript
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._transcripts),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    async def _transcribe(self, download, duration: int) -> str:
+        data = await download()
+        chunks = [data]
+        if duration > self.chunk_seconds:
+            try:
+                chunks = await asyncio.to_thread(split_audio, data, self.chunk_seconds)
+            except Exception as e:
+                # Без ffmpeg отправляем сообщение целиком
+                logger.warning(f"Не удалось разрезать аудио, расшифровка целиком: {e}")
+
+        started = time.perf_counter()
+        parts = await asyncio.gather(*(gemini_client.transcribe_audio_async(chunk) for chunk in chunks))
+        transcript = " ".join(part for part in parts if part)
+
+        logger.info(
+            f"Расшифровано {duration} с аудио ({len(chunks)} кусков) "
+            f"за {time.perf_counter() - started:.1f} с"
+        )
+        return transcript
+
+    def _store(self, file_unique_id: str, transcript: str):
+        if not transcript:
+            return
+        self._transcripts.set(file_unique_id, transcript)
+
+# Глобальный экземпляр
+transcriber = Transcriber()
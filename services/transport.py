@@ -0,0 +1,532 @@
+"""Транспорт запросов к Gemini: пул соединений, повторы, дедлайны, хеджирование, circuit breaker"""
+import asyncio
+import contextvars
+import json
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Optional
+import requests
+from requests.adapters import HTTPAdapter
+from config import (
+    GEMINI_HTTP_POOL_SIZE, GEMINI_REQUEST_TIMEOUT, GEMINI_DEADLINES,
+    GEMINI_RETRY_ATTEMPTS, GEMINI_RETRY_BASE_DELAY, GEMINI_RETRY_MAX_DELAY,
+    GEMINI_HEDGING, GEMINI_HEDGE_MIN_DELAY, GEMINI_BREAKER_FAILURES, GEMINI_BREAKER_RESET
+)
+from services.scheduler import scheduler
+from utils.logger import logger
+
+# Коды, при которых запрос имеет смысл повторить
+RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+
+class GeminiError(Exception):
+    """Ошибка запроса к Gemini"""
+
+    user_message = "❌ Не удалось получить ответ от модели. Попробуй еще раз."
+
+    def __init__(self, message: str, model: str = None):
+        super().__init__(message)
+        self.model = model
+
+class GeminiRequestError(GeminiError):
+    """Запрос отклонен (4xx, кроме 429): повтор не поможет"""
+
+class GeminiUnavailableError(GeminiError):
+    """Модель перегружена или недоступна (429, 5xx, сеть)"""
+
+    user_message = "⏳ Модель сейчас перегружена. Попробуй еще раз через минуту."
+
+class GeminiRateLimitError(GeminiUnavailableError):
+    """Превышена квота модели (429)"""
+
+class GeminiTimeoutError(GeminiUnavailableError):
+    """Истек дедлайн запроса"""
+
+    user_message = "⏳ Модель не успела ответить. Попробуй еще раз."
+
+class CircuitOpenError(GeminiUnavailableError):
+    """Модель временно отключена: слишком много ошибок подряд"""
+
+def classify(error: Exception, model: str = None) -> Optional[GeminiError]:
+    """Привести исключение SDK, сети или таймаута к GeminiError
+
+    Прочие исключения (TypeError, KeyError и т.п.) - ошибки в коде, а не
+    ответ API: возвращается None, и вызывающий пробрасывает их как есть,
+    без повторов и без учета в circuit breaker.
+    """
+    from google.genai import errors as genai_errors
+
+    if isinstance(error, GeminiError):
+        return error
+    if isinstance(error, genai_errors.APIError):
+        if error.code == 429:
+            return GeminiRateLimitError(str(error), model)
+        if error.code in RETRYABLE_CODES:
+            return GeminiUnavailableError(str(error), model)
+        return GeminiRequestError(str(error), model)
+    if isinstance(error, (asyncio.TimeoutError, requests.Timeout)):
+        return GeminiTimeoutError(f"Таймаут запроса: {error or 'нет ответа'}", model)
+    if isinstance(error, (requests.ConnectionError, ConnectionError)):
+        return GeminiUnavailableError(f"Сетевая ошибка: {error}", model)
+    return None
+
+def _reraise(error: GeminiError, cause: Exception):
+    if error is cause:
+        raise error
+    raise error from cause
+
+# Дедлайн текущего запроса пользователя (time.monotonic())
+_deadline = contextvars.ContextVar("gemini_deadline", default=None)
+
+@contextmanager
+def deadline(seconds: float):
+    """Общий дедлайн для всех запросов к Gemini внутри блока
+
+    Вложенные запросы (поиск, генерация, синтез) не переживут дедлайн
+    внешнего обработчика; вложенный блок может только сократить его.
+    """
+    until = time.monotonic() + seconds
+    outer = _deadline.get()
+    token = _deadline.set(min(until, outer) if outer else until)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+def backoff_delay(attempt: int) -> float:
+    """Экспоненциальная пауза с полным джиттером: повторы разных запросов не совпадают"""
+    return random.uniform(0, min(GEMINI_RETRY_MAX_DELAY, GEMINI_RETRY_BASE_DELAY * 2 ** attempt))
+
+# Версия google-genai, под которую написан install_connection_pool
+# (совпадает с закрепленной в requirements.txt)
+POOLED_SDK_VERSION = "1.1.0"
+
+def install_connection_pool(client, pool_size: int = GEMINI_HTTP_POOL_SIZE):
+    """Общий пул HTTP-соединений для всех запросов клиента
+
+    google-genai 1.1 открывает новую requests.Session (и TLS-соединение) на
+    каждый запрос, а http_options не позволяют передать свою сессию; здесь
+    заменяется приватный ApiClient._request_unauthorized, поэтому замена
+    делается только для POOLED_SDK_VERSION с ожидаемой сигнатурой метода.
+    Возвращает сессию или None (в другой версии SDK - с предупреждением).
+    """
+    import inspect
+    from google.genai import __version__ as sdk_version
+    from google.genai import errors as genai_errors
+    from google.genai._api_client import ApiClient, HttpResponse
+
+    api_client = getattr(client, "_api_client", None)
+    method = getattr(ApiClient, "_request_unauthorized", None)
+    if (sdk_version != POOLED_SDK_VERSION or not isinstance(api_client, ApiClient) or method is None
+            or list(inspect.signature(method).parameters) != ["self", "http_request", "stream"]):
+        logger.warning(
+            f"Пул соединений Gemini не установлен: написан для google-genai {POOLED_SDK_VERSION}, "
+            f"установлена {sdk_version}; запросы идут через соединения SDK"
+        )
+        return None
+
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=pool_size))
+
+    def request_unauthorized(http_request, stream: bool = False):
+        data = http_request.data
+        if data and not isinstance(data, bytes):
+            data = json.dumps(data)
+        response = session.request(
+            method=http_request.method,
+            url=http_request.url,
+            headers=http_request.headers,
+            data=data or None,
+            timeout=http_request.timeout,
+            stream=stream,
+        )
+        genai_errors.APIError.raise_for_response(response)
+        return HttpResponse(response.headers, response if stream else [response.text])
+
+    api_client._request_unauthorized = request_unauthorized
+    logger.info(f"Пул соединений Gemini: до {pool_size} соединений")
+    return session
+
+class CircuitBreaker:
+    """Размыкатель для одной модели
+
+    После failure_threshold ошибок подряд запросы к модели сразу получают
+    CircuitOpenError. Через reset_timeout пропускается один пробный запрос:
+    успех замыкает цепь, ошибка снова размыкает ее.
+    """
+
+    __slots__ = ('model', 'failure_threshold', 'reset_timeout', 'failures', 'opened_at', 'probe_at', 'trips')
+
+    def __init__(self, model: str, failure_threshold: int = GEMINI_BREAKER_FAILURES,
+                 reset_timeout: float = GEMINI_BREAKER_RESET):
+        self.model = model
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probe_at = None
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос"""
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "open":
+            return False
+        # Полуоткрыто: один пробный запрос (зависший пробный заменяется новым)
+        now = time.monotonic()
+        if self.probe_at is not None and now - self.probe_at < self.reset_timeout:
+            return False
+        self.probe_at = now
+        return True
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info(f"Модель {self.model} снова доступна")
+        self.failures = 0
+        self.opened_at = None
+        self.probe_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        self.probe_at = None
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                self.trips += 1
+                logger.warning(
+                    f"Модель {self.model} отключена на {self.reset_timeout:.0f} с "
+                    f"после {self.failures} ошибок подряд"
+                )
+            self.opened_at = time.monotonic()
+
+class LatencyTracker:
+    """Задержки последних успешных запросов к модели"""
+
+    __slots__ = ('samples',)
+
+    def __init__(self, size: int = 200):
+        self.samples = deque(maxlen=size)
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, q: float, min_samples: int = 20) -> float:
+        """q-квантиль задержки или None, пока замеров мало"""
+        if len(self.samples) < min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class ThreadedStream:
+    """Синхронный поток ответа SDK, прочитанный в отдельном потоке
+
+    В google-genai 1.1 client.aio.models.generate_content_stream читает
+    ответ (iter_lines) прямо в event loop, и пока идет стриминг, остальные
+    апдейты стоят. Здесь синхронный поток (client.models.generate_content_stream)
+    читается в фоновом потоке, а фрагменты передаются в asyncio.Queue
+    через call_soon_threadsafe.
+    """
+
+    __slots__ = ('_loop', '_queue', '_closed')
+
+    _END = object()
+
+    def __init__(self, open_stream):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._closed = threading.Event()
+        threading.Thread(target=self._read, args=(open_stream,), name="gemini-stream", daemon=True).start()
+
+    def _read(self, open_stream):
+        try:
+            iterator = iter(open_stream())
+            try:
+                for chunk in iterator:
+                    if self._closed.is_set():
+                        break
+                    self._put(chunk)
+            finally:
+                # Закрытие генератора SDK освобождает HTTP-ответ
+                close = getattr(iterator, "close", None)
+                if close:
+                    close()
+        except Exception as e:
+            self._put(e)
+            return
+        self._put(self._END)
+
+    def _put(self, item):
+        try:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+        except RuntimeError:
+            # Event loop уже закрыт - читать дальше некому
+            self._closed.set()
+
+    async def get(self):
+        """Следующий фрагмент или None, если поток закончился"""
+        item = await self._queue.get()
+        if item is self._END:
+            self._queue.put_nowait(item)
+            return None
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def close(self):
+        """Прекратить чтение (поток завершится на следующем фрагменте)"""
+        self._closed.set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await self.get()
+        if chunk is None:
+            raise StopAsyncIteration
+        return chunk
+
+class GeminiTransport:
+    """Выполнение запросов к Gemini
+
+    Запрос передается как фабрика корутины (request() -> ответ), чтобы его
+    можно было повторить или продублировать. Каждая попытка занимает слот
+    планировщика, паузы между попытками - нет. Ошибки API, сети и таймауты
+    приводятся к GeminiError, ошибки в коде пробрасываются как есть.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.session = install_connection_pool(client)
+        self._breakers = {}
+        self._latency = {}
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        breaker = self._breakers.get(model)
+        if breaker is None:
+            breaker = self._breakers[model] = CircuitBreaker(model)
+        return breaker
+
+    def latency(self, model: str) -> LatencyTracker:
+        tracker = self._latency.get(model)
+        if tracker is None:
+            tracker = self._latency[model] = LatencyTracker()
+        return tracker
+
+    async def call(self, model: str, request, modality: str = "text",
+                   timeout: float = None, hedge: bool = False, attempts: int = None):
+        """Выполнить запрос с повторами
+
+        timeout - дедлайн всего запроса (по умолчанию GEMINI_DEADLINES для
+        модальности, но не дольше внешнего deadline()). hedge - разрешить
+        дублирующий запрос при медленном ответе (если включено GEMINI_HEDGING).
+        attempts - число попыток (меньше, если есть запасная модель).
+        """
+        attempts = attempts or GEMINI_RETRY_ATTEMPTS
+        until = self._deadline(modality, timeout)
+        breaker = self.breaker(model)
+        last_error = None
+
+        for attempt in range(attempts):
+            if not breaker.allow():
+                raise CircuitOpenError(f"Модель {model} временно недоступна", model)
+            remaining = until - time.monotonic()
+            if remaining <= 0:
+                break
+
+            try:
+                if hedge and GEMINI_HEDGING:
+                    result = await self._hedged(model, request, modality, remaining)
+                else:
+                    result = await self._attempt(model, request, modality, remaining)
+            except Exception as e:
+                error = classify(e, model)
+                if error is None:
+                    raise
+                if not isinstance(error, GeminiUnavailableError):
+                    # Модель ответила, запрос просто некорректен
+                    breaker.record_success()
+                    _reraise(error, e)
+                breaker.record_failure()
+                last_error = error
+
+                delay = backoff_delay(attempt)
+                if attempt + 1 == attempts or time.monotonic() + delay >= until:
+                    break
+                self.retries += 1
+                logger.warning(
+                    f"Gemini {model}: {error}, попытка {attempt + 2}/{attempts} через {delay:.1f} с"
+                )
+                await asyncio.sleep(delay)
+                continue
+
+            breaker.record_success()
+            return result
+
+        if last_error is None:
+            raise GeminiTimeoutError(f"Дедлайн запроса к {model} истек", model)
+        raise last_error
+
+    async def stream(self, model: str, request, modality: str = "text",
+                     timeout: float = None, attempts: int = None):
+        """Потоковый запрос: повторяется, только пока не получен первый фрагмент
+
+        request() - синхронный итератор фрагментов SDK, он читается в
+        отдельном потоке (ThreadedStream). Дедлайн попытки ограничивает
+        ожидание первого фрагмента, дальше - таймаут HTTP.
+        """
+        attempts = attempts or GEMINI_RETRY_ATTEMPTS
+        until = self._deadline(modality, timeout)
+        breaker = self.breaker(model)
+
+        for attempt in range(attempts):
+            if not breaker.allow():
+                raise CircuitOpenError(f"Модель {model} временно недоступна", model)
+            remaining = until - time.monotonic()
+            if remaining <= 0:
+                raise GeminiTimeoutError(f"Дедлайн запроса к {model} истек", model)
+
+            started_yielding = False
+            try:
+                async with scheduler.gemini_slot(modality):
+                    started = time.monotonic()
+                    stream = ThreadedStream(request)
+                    try:
+                        chunk = await asyncio.wait_for(stream.get(), min(remaining, GEMINI_REQUEST_TIMEOUT))
+                        if chunk is not None:
+                            started_yielding = True
+                            self.latency(model).add(time.monotonic() - started)
+                            yield chunk
+                            async for chunk in stream:
+                                yield chunk
+                    finally:
+                        stream.close()
+            except Exception as e:
+                error = classify(e, model)
+                if error is None:
+                    raise
+                if not isinstance(error, GeminiUnavailableError):
+                    breaker.record_success()
+                    _reraise(error, e)
+                breaker.record_failure()
+
+                delay = backoff_delay(attempt)
+                # Часть ответа уже у пользователя - повтор продублировал бы ее
+                if (started_yielding or attempt + 1 == attempts
+                        or time.monotonic() + delay >= until):
+                    _reraise(error, e)
+                self.retries += 1
+                logger.warning(
+                    f"Gemini {model}: {error}, попытка {attempt + 2}/{attempts} через {delay:.1f} с"
+                )
+                await asyncio.sleep(delay)
+                continue
+
+            breaker.record_success()
+            return
+
+    def call_sync(self, model: str, request):
+        """Синхронный запрос с повторами (без слотов планировщика и хеджирования)"""
+        breaker = self.breaker(model)
+        last_error = None
+
+        for attempt in range(GEMINI_RETRY_ATTEMPTS):
+            if not breaker.allow():
+                raise CircuitOpenError(f"Модель {model} временно недоступна", model)
+            try:
+                result = request()
+            except Exception as e:
+                error = classify(e, model)
+                if error is None:
+                    raise
+                if not isinstance(error, GeminiUnavailableError):
+                    breaker.record_success()
+                    _reraise(error, e)
+                breaker.record_failure()
+                last_error = error
+                if attempt + 1 < GEMINI_RETRY_ATTEMPTS:
+                    self.retries += 1
+                    time.sleep(backoff_delay(attempt))
+                continue
+
+            breaker.record_success()
+            return result
+
+        raise last_error
+
+    def stats(self) -> dict:
+        return {
+            'retries': self.retries,
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'breakers': {model: breaker.state for model, breaker in self._breakers.items()},
+            'p95': {model: tracker.percentile(0.95) for model, tracker in self._latency.items()},
+        }
+
+    @staticmethod
+    def _deadline(modality: str, timeout: float = None) -> float:
+        until = time.monotonic() + (timeout or GEMINI_DEADLINES.get(modality, GEMINI_REQUEST_TIMEOUT))
+        outer = _deadline.get()
+        return min(until, outer) if outer else until
+
+    async def _attempt(self, model: str, request, modality: str, remaining: float):
+        """Одна попытка: слот планировщика и таймаут попытки входят в дедлайн"""
+        async def run():
+            async with scheduler.gemini_slot(modality):
+                started = time.monotonic()
+                result = await request()
+                self.latency(model).add(time.monotonic() - started)
+                return result
+
+        return await asyncio.wait_for(run(), min(remaining, GEMINI_REQUEST_TIMEOUT))
+
+    async def _hedged(self, model: str, request, modality: str, remaining: float):
+        """Попытка с дублем: если ответа нет дольше p95 задержки модели,
+        отправляется второй такой же запрос и берется первый успешный ответ
+        """
+        hedge_after = self.latency(model).percentile(0.95)
+        if hedge_after is None:
+            return await self._attempt(model, request, modality, remaining)
+        hedge_after = max(hedge_after, GEMINI_HEDGE_MIN_DELAY)
+        if hedge_after >= remaining:
+            return await self._attempt(model, request, modality, remaining)
+
+        primary = asyncio.ensure_future(self._attempt(model, request, modality, remaining))
+        pending = {primary}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=hedge_after)
+            if done:
+                return primary.result()
+
+            self.hedges += 1
+            logger.debug(f"Gemini {model}: нет ответа за {hedge_after:.1f} с, отправлен дубль запроса")
+            hedge = asyncio.ensure_future(self._attempt(model, request, modality, remaining - hedge_after))
+            pending.add(hedge)
+
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # Проигравший запрос отменяется (его поток SDK завершится по таймауту HTTP)
+            for task in pending:
+                task.cancel()
@@ -0,0 +1,154 @@
+"""Озвучивание ответов: фрагменты по предложениям, параллельный синтез, OGG/Opus, кэш"""
+import asyncio
+import hashlib
+import io
+import re
+import wave
+from pathlib import Path
+from telegram import Update
+from config import TTS_VOICE, TTS_SEGMENT_CHARS, TTS_MAX_SEGMENTS, TTS_CACHE_DIR, TTS_CACHE_MAX_FILES
+from services.gemini_client import gemini_client
+from utils.logger import logger
+
+_SENTENCE_RE = re.compile(r"(?<=[.!?…])\s+|\n+")
+_CODE_BLOCK_RE = re.compile(r"```.*?```", re.DOTALL)
+
+PCM_RATE = 24000
+PCM_WIDTH = 2
+
+def split_sentences(text: str, max_chars: int = TTS_SEGMENT_CHARS) -> list:
+    """Разбить текст на фрагменты по границам предложений, не длиннее max_chars"""
+    # Блоки кода вслух не читаем
+    text = _CODE_BLOCK_RE.sub(" ", text)
+
+    segments = []
+    current = ""
+    for sentence in _SENTENCE_RE.split(text):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        # Очень длинное предложение режем по словам
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(" ", 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            if current:
+                segments.append(current)
+                current = ""
+            segments.append(sentence[:cut].strip())
+            sentence = sentence[cut:].strip()
+
+        if current and len(current) + len(sentence) + 1 > max_chars:
+            segments.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}".strip()
+
+    if current:
+        segments.append(current)
+    return segments
+
+def encode_opus(pcm: bytes) -> bytes:
+    """PCM -> OGG/Opus (нужен ffmpeg)"""
+    from pydub import AudioSegment
+
+    segment = AudioSegment(data=pcm, sample_width=PCM_WIDTH, frame_rate=PCM_RATE, channels=1)
+    buffer = io.BytesIO()
+    segment.export(buffer, format="ogg", codec="libopus", bitrate="32k")
+    return buffer.getvalue()
+
+def encode_wav(pcm: bytes) -> bytes:
+    """PCM -> WAV (запасной вариант, если нет ffmpeg)"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(PCM_WIDTH)
+        wav_file.setframerate(PCM_RATE)
+        wav_file.writeframes(pcm)
+    return buffer.getvalue()
+
+class VoicePipeline:
+    """Озвучивание ответа целиком
+
+    Ответ режется на фрагменты по предложениям, все фрагменты синтезируются
+    параллельно (с лимитом TTS в планировщике), а отправляются по порядку:
+    первый уходит пользователю, как только готов. Готовые фрагменты
+    кэшируются на диске по (голос, текст).
+    """
+
+    def __init__(self, cache_dir: Path = TTS_CACHE_DIR, voice: str = TTS_VOICE):
+        self.cache_dir = Path(cache_dir)
+        self.voice = voice
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._writes = 0
+
+    async def speak(self, update: Update, text: str) -> int:
+        """Озвучить текст и отправить голосовыми сообщениями, вернуть число отправленных"""
+        segments = split_sentences(text)
+        if len(segments) > TTS_MAX_SEGMENTS:
+            logger.info(f"Озвучиваются первые {TTS_MAX_SEGMENTS} из {len(segments)} фрагментов")
+            segments = segments[:TTS_MAX_SEGMENTS]
+
+        tasks = [asyncio.create_task(self.synthesize(segment)) for segment in segments]
+        sent = 0
+        try:
+            for task in tasks:
+                audio = await task
+                if not audio:
+                    continue
+                await update.message.reply_voice(voice=audio)
+                sent += 1
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        logger.info(
+            f"Озвучено фрагментов: {sent}/{len(segments)} "
+            f"(кэш: {self.cache_hits} попаданий, {self.cache_misses} промахов)"
+        )
+        return sent
+
+    async def synthesize(self, text: str) -> bytes:
+        """Озвучить один фрагмент (с кэшем)"""
+        path = self._cache_path(text)
+        if path.exists():
+            self.cache_hits += 1
+            return await asyncio.to_thread(path.read_bytes)
+
+        self.cache_misses += 1
+        try:
+            pcm = await gemini_client.synthesize_speech_async(text, self.voice)
+        except Exception as e:
+            logger.error(f"Ошибка синтеза речи: {e}")
+            return None
+        if not pcm:
+            return None
+
+        try:
+            audio = await asyncio.to_thread(encode_opus, pcm)
+        except Exception as e:
+            # Без ffmpeg отправляем WAV и не кэшируем
+            logger.warning(f"Не удалось закодировать в Opus, отправляется WAV: {e}")
+            return encode_wav(pcm)
+
+        await asyncio.to_thread(self._store, path, audio)
+        return audio
+
+    def _cache_path(self, text: str) -> Path:
+        digest = hashlib.sha256(f"{self.voice}\x00{' '.join(text.split())}".encode("utf-8")).hexdigest()
+        return self.cache_dir / f"{digest}.ogg"
+
+    def _store(self, path: Path, audio: bytes):
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_bytes(audio)
+        tmp_path.replace(path)
+
+        # Периодически удаляем самые старые файлы
+        self._writes += 1
+        if self._writes % 100 == 0:
+            files = sorted(self.cache_dir.glob("*.ogg"), key=lambda p: p.stat().st_mtime)
+            for old in files[:max(0, len(files) - TTS_CACHE_MAX_FILES)]:
+                old.unlink(missing_ok=True)
+
+# Глобальный экземпляр
+voice_pipeline = VoicePipeline()
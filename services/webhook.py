@@ -0,0 +1,224 @@
+"""Режим webhook: HTTP-приемник апдейтов и процессы-обработчики, разделенные по user_id"""
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+from contextlib import contextmanager
+from aiohttp import web
+from telegram import Bot, Update
+from config import (
+    TELEGRAM_BOT_TOKEN, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT,
+    WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE, WEBHOOK_MAX_CONNECTIONS, KB_SHARDS
+)
+from rag.namespaces import user_shard
+from services.worker import run_worker
+from utils.logger import logger
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# Как часто проверять, живы ли обработчики (секунды)
+WATCH_INTERVAL = 5
+# При перегрузке в лог попадает каждый N-й отказ
+REJECT_LOG_EVERY = 100
+
+def update_shard_key(update: dict) -> int:
+    """Ключ шардирования апдейта: id пользователя, иначе id чата, иначе update_id"""
+    for field, payload in update.items():
+        if field == "update_id" or not isinstance(payload, dict):
+            continue
+        user = payload.get("from") or payload.get("user")
+        if isinstance(user, dict) and "id" in user:
+            return user["id"]
+        chat = payload.get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return chat["id"]
+    return update.get("update_id", 0)
+
+@contextmanager
+def worker_environment(shard: int, workers: int):
+    """Номер шарда в окружении на время запуска процесса-обработчика
+
+    spawn заново импортирует главный модуль (bot.py), а с ним config, еще до
+    вызова run_worker; пути, зависящие от WORKER_ID (лог, реестр файлов),
+    вычисляются при этом импорте. Поэтому переменные должны быть в
+    окружении к моменту старта процесса, а не выставляться внутри него.
+    """
+    saved = {name: os.environ.get(name) for name in ("WORKER_ID", "WORKER_COUNT")}
+    os.environ["WORKER_ID"] = str(shard)
+    os.environ["WORKER_COUNT"] = str(workers)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+class WebhookIngress:
+    """Прием апдейтов по HTTP и раздача их процессам-обработчикам
+
+    Апдейт попадает в очередь обработчика (user_id % KB_SHARDS) % workers:
+    апдейты одного пользователя обрабатывает один процесс по порядку
+    (дальше их упорядочивает планировщик внутри процесса), каждую часть
+    базы знаний с личными документами пишет только один процесс, а разные
+    пользователи распределяются по ядрам. Приемник только разбирает
+    JSON и кладет сырое тело в очередь; при переполненной очереди
+    отвечает 503, и Telegram повторяет доставку позже. Упавший
+    обработчик перезапускается.
+    """
+
+    def __init__(self, workers: int = WEBHOOK_WORKERS, queue_size: int = WEBHOOK_QUEUE_SIZE,
+                 target=run_worker, secret: str = WEBHOOK_SECRET):
+        if workers > KB_SHARDS:
+            # Лишним процессам не досталось бы ни одной части базы знаний
+            logger.warning(f"Обработчиков {workers} больше, чем частей базы знаний (KB_SHARDS={KB_SHARDS}): запускается {KB_SHARDS}")
+            workers = KB_SHARDS
+        self.workers = max(1, workers)
+        self.target = target
+        self.secret = secret
+
+        # spawn: обработчики не наследуют состояние приемника (потоки, соединения)
+        self._context = multiprocessing.get_context("spawn")
+        self._queues = [self._context.Queue(queue_size) for _ in range(self.workers)]
+        self._processes = [None] * self.workers
+        self._watcher = None
+
+        self.received = 0
+        self.rejected = 0
+        self.restarts = 0
+        self.dispatched = [0] * self.workers
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle_update)
+        app.router.add_get("/health", self.health)
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+    # ---------- HTTP ----------
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if self.secret and request.headers.get(SECRET_HEADER) != self.secret:
+            return web.Response(status=403)
+
+        body = await request.read()
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+
+        shard = user_shard(update_shard_key(update)) % self.workers
+        try:
+            self._queues[shard].put_nowait(body)
+        except queue.Full:
+            self.rejected += 1
+            if self.rejected % REJECT_LOG_EVERY == 1:
+                logger.warning(f"Очередь обработчика {shard} переполнена, отклонено апдейтов: {self.rejected}")
+            return web.Response(status=503)
+
+        self.received += 1
+        self.dispatched[shard] += 1
+        return web.Response()
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+
+    def stats(self) -> dict:
+        workers = []
+        for shard, process in enumerate(self._processes):
+            try:
+                queued = self._queues[shard].qsize()
+            except NotImplementedError:
+                # macOS не поддерживает qsize()
+                queued = None
+            workers.append({
+                'shard': shard,
+                'pid': process.pid if process else None,
+                'alive': bool(process and process.is_alive()),
+                'dispatched': self.dispatched[shard],
+                'queued': queued,
+            })
+        return {
+            'received': self.received,
+            'rejected': self.rejected,
+            'restarts': self.restarts,
+            'workers': workers,
+        }
+
+    # ---------- Процессы ----------
+
+    def start_workers(self):
+        for shard in range(self.workers):
+            self._spawn(shard)
+        logger.info(f"Запущено обработчиков: {self.workers}")
+
+    def stop_workers(self, timeout: float = 30):
+        """Остановить обработчики: они дорабатывают очередь и выходят"""
+        for updates in self._queues:
+            try:
+                updates.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+        for shard, process in enumerate(self._processes):
+            if process is None:
+                continue
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"Обработчик {shard} не остановился за {timeout} с, завершается принудительно")
+                process.terminate()
+                process.join()
+
+    def _spawn(self, shard: int):
+        process = self._context.Process(
+            target=self.target,
+            args=(shard, self.workers, self._queues[shard]),
+            name=f"bot-worker-{shard}",
+        )
+        with worker_environment(shard, self.workers):
+            process.start()
+        self._processes[shard] = process
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(WATCH_INTERVAL)
+            for shard, process in enumerate(self._processes):
+                if process is not None and not process.is_alive():
+                    logger.error(f"Обработчик {shard} завершился (код {process.exitcode}), перезапуск")
+                    self.restarts += 1
+                    self._spawn(shard)
+
+    async def _on_startup(self, app: web.Application):
+        self.start_workers()
+        self._watcher = asyncio.create_task(self._watch())
+
+    async def _on_cleanup(self, app: web.Application):
+        if self._watcher is not None:
+            self._watcher.cancel()
+        await asyncio.to_thread(self.stop_workers)
+
+async def register_webhook(app: web.Application):
+    """Зарегистрировать адрес приемника в Telegram"""
+    if not WEBHOOK_URL:
+        logger.warning("WEBHOOK_URL не задан: webhook не регистрируется, ожидаются апдейты от прокси")
+        return
+
+    url = WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH
+    async with Bot(TELEGRAM_BOT_TOKEN) as bot:
+        await bot.set_webhook(
+            url=url,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            drop_pending_updates=True,
+        )
+    logger.info(f"Webhook зарегистрирован: {url}")
+
+def run_webhook():
+    """Запуск приемника и обработчиков (блокирует до остановки)"""
+    ingress = WebhookIngress()
+    app = ingress.make_app()
+    app.on_startup.append(register_webhook)
+    logger.info(f"Запуск webhook на {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}, обработчиков: {ingress.workers}")
+    web.run_app(app, host=WEBHOOK_HOST, port=WEBHOOK_PORT, print=None)
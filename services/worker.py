@@ -0,0 +1,51 @@
+"""Процесс-обработчик апдейтов режима webhook"""
+import asyncio
+import json
+import os
+import signal
+
+def run_worker(shard: int, workers: int, updates):
+    """Точка входа процесса-обработчика
+
+    WORKER_ID и WORKER_COUNT приемник выставляет в окружении до старта
+    процесса (webhook.worker_environment): config импортируется раньше,
+    чем вызывается эта функция. updates - очередь сырых апдейтов от
+    приемника, None в ней означает остановку.
+    """
+    import config
+    if (config.WORKER_ID, config.WORKER_COUNT) != (shard, workers):
+        raise RuntimeError(
+            f"Обработчик {shard}/{workers} запущен с WORKER_ID={config.WORKER_ID}, "
+            f"WORKER_COUNT={config.WORKER_COUNT}"
+        )
+    # Остановкой управляет приемник, Ctrl+C в терминале обработчики не прерывает
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_serve(shard, updates))
+
+async def _serve(shard: int, updates):
+    from telegram import Update
+    from bot import create_bot
+    from utils.logger import logger
+
+    # Без Updater: апдейты приходят из очереди приемника
+    app = create_bot(updater=False)
+    async with app:
+        # post_init вызывает только run_polling/run_webhook, здесь - вручную
+        if app.post_init:
+            await app.post_init(app)
+        await app.start()
+        logger.info(f"Обработчик {shard} запущен (pid {os.getpid()})")
+
+        while True:
+            body = await asyncio.to_thread(updates.get)
+            if body is None:
+                break
+            try:
+                update = Update.de_json(json.loads(body), app.bot)
+            except Exception as e:
+                logger.error(f"Обработчик {shard}: не удалось разобрать апдейт: {e}")
+                continue
+            await app.update_queue.put(update)
+
+        await app.stop()
+    logger.info(f"Обработчик {shard} остановлен")
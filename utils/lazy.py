@@ -0,0 +1,82 @@
+"""Отложенное создание тяжелых глобальных объектов"""
+import threading
+import time
+from typing import Callable
+from utils.logger import logger
+
+class LazyProvider:
+    """Глобальный объект, который создается при первом обращении
+
+    Ведет себя как сам объект: атрибуты проксируются, поэтому вызывающий
+    код не меняется (`from rag.index import vector_index`). Конструктор с
+    тяжелыми импортами и подключениями вызывается один раз, даже если к
+    объекту одновременно обращаются event loop и фоновый прогрев.
+    Если конструктор упал, следующее обращение попробует снова.
+    """
+
+    __slots__ = ('_factory', '_name', '_instance', '_lock', '_callbacks', 'init_seconds')
+
+    def __init__(self, factory: Callable, name: str):
+        self._factory = factory
+        self._name = name
+        self._instance = None
+        self._lock = threading.Lock()
+        # Настройка, отложенная до создания объекта (on_create)
+        self._callbacks = []
+        self.init_seconds = None
+
+    @property
+    def ready(self) -> bool:
+        return self._instance is not None
+
+    def get(self):
+        """Объект (создается при первом вызове)"""
+        instance = self._instance
+        if instance is not None:
+            return instance
+
+        with self._lock:
+            if self._instance is None:
+                started = time.perf_counter()
+                instance = self._factory()
+                for callback in self._callbacks:
+                    callback(instance)
+                self._callbacks.clear()
+                self.init_seconds = time.perf_counter() - started
+                self._instance = instance
+                logger.info(f"{self._name} создан за {self.init_seconds:.2f} с")
+            return self._instance
+
+    def on_create(self, callback: Callable):
+        """Вызвать callback(объект) при создании (или сразу, если он уже создан)"""
+        with self._lock:
+            if self._instance is None:
+                self._callbacks.append(callback)
+                return
+        callback(self._instance)
+
+    def __getattr__(self, name):
+        # Служебные поля еще не заданы (например, при копировании) - не создаем объект
+        if name in LazyProvider.__slots__:
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+    def __repr__(self) -> str:
+        state = "создан" if self.ready else "не создан"
+        return f"<LazyProvider {self._name}: {state}>"
+
+def warm_up(*providers: LazyProvider) -> threading.Thread:
+    """Создать объекты в фоновом потоке, не задерживая прием апдейтов"""
+    def run():
+        started = time.perf_counter()
+        for provider in providers:
+            try:
+                provider.get()
+            except Exception as e:
+                # Ошибка повторится и будет обработана при первом настоящем обращении
+                logger.error(f"Прогрев {provider._name} не удался: {e}")
+        logger.info(f"Прогрев завершен за {time.perf_counter() - started:.2f} с")
+
+    thread = threading.Thread(target=run, name="warm-up", daemon=True)
+    thread.start()
+    return thread
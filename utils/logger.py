@@ -1,10 +1,42 @@
+import atexit
+import contextvars
+import copy
+import json
 import logging
 import sys
-from pathlib import Path
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import SimpleQueue
+from config import (
+    LOG_LEVEL, LOG_FILE_LEVEL, LOG_JSON, LOG_FILE, LOG_MAX_BYTES, LOG_BACKUP_COUNT,
+    LOG_DEBUG_RATE, LOG_DEBUG_BURST
+)
+
+# Поля контекста, которые попадают в структурированные записи
+CONTEXT_FIELDS = ('user_id', 'update_id', 'mode', 'latency_ms', 'ttft_ms')
+
+# Контекст текущего апдейта (user_id, mode, ...): задается планировщиком и хендлерами
+_log_context = contextvars.ContextVar("log_context", default={})
+
+@contextmanager
+def log_context(**fields):
+    """Добавить поля ко всем записям внутри блока (в пределах текущей задачи asyncio)"""
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+def bind_log_context(**fields):
+    """Добавить поля до конца текущего log_context"""
+    _log_context.set({**_log_context.get(), **fields})
 
 class ColoredFormatter(logging.Formatter):
     """Цветной форматтер для консоли"""
-    
+
     COLORS = {
         'DEBUG': '\033[36m',    # Cyan
         'INFO': '\033[32m',     # Green
@@ -13,17 +45,113 @@ class ColoredFormatter(logging.Formatter):
         'CRITICAL': '\033[35m', # Magenta
     }
     RESET = '\033[0m'
-    
+
     def format(self, record):
+        # Запись общая для всех handler'ов: цвет добавляется к копии
+        record = copy.copy(record)
         log_color = self.COLORS.get(record.levelname, self.RESET)
         record.levelname = f"{log_color}{record.levelname}{self.RESET}"
         return super().format(record)
 
-def setup_logger(name='bot', level=logging.INFO):
-    """Настройка логгера с цветным выводом"""
+class JsonFormatter(logging.Formatter):
+    """Запись как одна JSON-строка: время, уровень, сообщение и поля контекста"""
+
+    def format(self, record):
+        data = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'module': record.module,
+            'line': record.lineno,
+            'pid': record.process,
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        sampled = getattr(record, 'sampled', None)
+        if sampled:
+            data['sampled'] = sampled
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+class ContextFilter(logging.Filter):
+    """Переносит поля log_context в запись (явные extra важнее)"""
+
+    def filter(self, record):
+        for field, value in _log_context.get().items():
+            if getattr(record, field, None) is None:
+                setattr(record, field, value)
+        return True
+
+class DebugSampler(logging.Filter):
+    """Ограничение частоты DEBUG-записей
+
+    С одного места вызова пропускается не больше rate записей в секунду
+    (token bucket с запасом burst). Число отброшенных записей
+    сохраняется в поле sampled следующей пропущенной.
+    """
+
+    def __init__(self, rate: float = LOG_DEBUG_RATE, burst: float = LOG_DEBUG_BURST):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.dropped = 0
+        # (файл, строка) -> [токены, время, отброшено с прошлой записи]
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now, 0]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                bucket[2] += 1
+                self.dropped += 1
+                return False
+            bucket[0] = tokens - 1
+            if bucket[2]:
+                record.sampled = bucket[2]
+                bucket[2] = 0
+        return True
+
+class _QueueHandler(QueueHandler):
+    """Передает запись в поток записи без форматирования
+
+    Сообщение и трейсбек вычисляются здесь (аргументы могут измениться
+    после возврата из вызова), а форматирование остается handler'ам
+    в потоке QueueListener.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def setup_logger(name='bot', level=LOG_LEVEL):
+    """Настройка логгера
+
+    В event loop остается только постановка записи в очередь; консоль
+    (с цветами) и файл (JSON-строки, ротация по размеру) пишет фоновый
+    поток QueueListener. DEBUG-записи прореживаются DebugSampler.
+    """
     logger = logging.getLogger(name)
-    logger.setLevel(level)
-    
+
     # Консольный handler с цветами
     console_handler = logging.StreamHandler(sys.stdout)
     console_handler.setLevel(level)
@@ -32,19 +160,33 @@ def setup_logger(name='bot', level=logging.INFO):
         datefmt='%H:%M:%S'
     )
     console_handler.setFormatter(console_formatter)
-    
+
     # Файловый handler
-    log_file = Path(__file__).parent.parent / 'data' / 'bot.log'
-    file_handler = logging.FileHandler(log_file, encoding='utf-8')
-    file_handler.setLevel(logging.DEBUG)
-    file_formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    LOG_FILE.parent.mkdir(exist_ok=True)
+    file_handler = RotatingFileHandler(
+        LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
     )
+    file_handler.setLevel(LOG_FILE_LEVEL)
+    if LOG_JSON:
+        file_formatter = JsonFormatter()
+    else:
+        file_formatter = logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+        )
     file_handler.setFormatter(file_formatter)
-    
-    logger.addHandler(console_handler)
-    logger.addHandler(file_handler)
-    
+
+    # Запись на диск и в консоль - в отдельном потоке
+    queue = SimpleQueue()
+    queue_handler = _QueueHandler(queue)
+    queue_handler.addFilter(DebugSampler())
+    queue_handler.addFilter(ContextFilter())
+    listener = QueueListener(queue, console_handler, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    logger.setLevel(min(console_handler.level, file_handler.level))
+    logger.addHandler(queue_handler)
+
     return logger
 
 # Глобальный логгер
@@ -1,56 +1,257 @@
-from collections import defaultdict
-from typing import Dict, List, Any
-from config import MAX_HISTORY_LENGTH
+import atexit
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional
+from config import (
+    MAX_HISTORY_LENGTH, SESSION_DB_PATH, SESSION_HOT_SIZE,
+    SESSION_FLUSH_INTERVAL, SESSION_IDLE_SECONDS
+)
+from utils.logger import logger
+
+STAT_FIELDS = ('messages', 'voice', 'images', 'documents')
+
+class UserRecord:
+    """Компактная запись пользователя"""
+    __slots__ = ('history', 'mode', 'stats', 'total', 'summary', 'summary_upto', 'dirty', 'last_access')
+
+    def __init__(self, history=(), mode: str = "text", stats=None,
+                 total: int = None, summary: str = "", summary_upto: int = 0):
+        # История - кольцевой буфер: старые сообщения вытесняются сами
+        self.history = deque(history, maxlen=MAX_HISTORY_LENGTH)
+        self.mode = mode
+        self.stats = list(stats) if stats else [0] * len(STAT_FIELDS)
+        # Сколько сообщений добавлено за все время (номер следующего сообщения)
+        self.total = len(self.history) if total is None else total
+        # Краткое содержание сообщений с номерами < summary_upto
+        self.summary = summary
+        self.summary_upto = summary_upto
+        self.dirty = False
+        self.last_access = time.monotonic()
+
+class SessionStore:
+    """Холодное хранилище сессий в SQLite"""
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " user_id INTEGER PRIMARY KEY,"
+                " mode TEXT NOT NULL,"
+                " history TEXT NOT NULL,"
+                " stats TEXT NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            # Колонки для сжатия истории (добавлены позже)
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(sessions)")}
+            for column, definition in (
+                ("total", "INTEGER"),
+                ("summary", "TEXT NOT NULL DEFAULT ''"),
+                ("summary_upto", "INTEGER NOT NULL DEFAULT 0"),
+            ):
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE sessions ADD COLUMN {column} {definition}")
+            self._conn.commit()
+
+    def load(self, user_id: int) -> Optional[UserRecord]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT mode, history, stats, total, summary, summary_upto"
+                " FROM sessions WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        mode, history, stats, total, summary, summary_upto = row
+        return UserRecord(json.loads(history), mode, json.loads(stats), total, summary, summary_upto)
+
+    def save_many(self, rows: List[tuple]):
+        """rows: (user_id, mode, history, stats, total, summary, summary_upto) - уже сериализованные"""
+        if not rows:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO sessions"
+                " (user_id, mode, history, stats, total, summary, summary_upto, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(*row, now) for row in rows]
+            )
+            self._conn.commit()
 
 class UserSession:
-    """Управление сессиями пользователей"""
-    
-    def __init__(self):
-        self.history: Dict[int, List[Dict[str, str]]] = defaultdict(list)
-        self.mode: Dict[int, str] = defaultdict(lambda: "text")  # text, rag, voice
-        self.stats: Dict[int, Dict[str, int]] = defaultdict(lambda: {
-            'messages': 0,
-            'voice': 0,
-            'images': 0,
-            'documents': 0
-        })
-    
+    """Управление сессиями пользователей
+
+    Активные пользователи хранятся в памяти (LRU до SESSION_HOT_SIZE записей),
+    остальные - в SQLite. Изменения пишутся на диск фоновым потоком
+    (write-behind), при вытеснении из памяти и при завершении процесса.
+
+    В режиме webhook файл SQLite общий для процессов-обработчиков, а
+    пользователь всегда попадает в один процесс, поэтому его запись в
+    памяти этого процесса остается единственной актуальной копией.
+    """
+
+    def __init__(self, store: SessionStore = None):
+        self.store = store or SessionStore(SESSION_DB_PATH)
+        self._hot: "OrderedDict[int, UserRecord]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+
+        self._flusher = threading.Thread(target=self._flush_loop, name="session-flush", daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+
+    # ---------- Горячий слой ----------
+
+    def _record(self, user_id: int) -> UserRecord:
+        """Получить запись пользователя, подняв ее из SQLite при необходимости"""
+        with self._lock:
+            record = self._hot.get(user_id)
+            if record is not None:
+                self._hot.move_to_end(user_id)
+                record.last_access = time.monotonic()
+                return record
+
+        record = self.store.load(user_id) or UserRecord()
+
+        with self._lock:
+            # Запись могла появиться, пока читали с диска
+            existing = self._hot.get(user_id)
+            if existing is not None:
+                return existing
+            self._hot[user_id] = record
+            evicted = self._evict_overflow()
+
+        self._persist(evicted)
+        return record
+
+    def _evict_overflow(self) -> List[tuple]:
+        """Вытеснить лишние записи из памяти (вызывается под блокировкой)"""
+        evicted = []
+        while len(self._hot) > SESSION_HOT_SIZE:
+            user_id, record = self._hot.popitem(last=False)
+            if record.dirty:
+                evicted.append(self._serialize(user_id, record))
+        return evicted
+
+    @staticmethod
+    def _serialize(user_id: int, record: UserRecord) -> tuple:
+        record.dirty = False
+        return (
+            user_id,
+            record.mode,
+            json.dumps(list(record.history), ensure_ascii=False),
+            json.dumps(record.stats),
+            record.total,
+            record.summary,
+            record.summary_upto
+        )
+
+    def _persist(self, rows: List[tuple]):
+        try:
+            self.store.save_many(rows)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения сессий: {e}")
+
+    # ---------- Фоновая запись ----------
+
+    def flush(self, evict_idle: bool = False):
+        """Записать измененные сессии на диск"""
+        rows = []
+        now = time.monotonic()
+        with self._lock:
+            for user_id, record in list(self._hot.items()):
+                if record.dirty:
+                    rows.append(self._serialize(user_id, record))
+                if evict_idle and now - record.last_access > SESSION_IDLE_SECONDS:
+                    del self._hot[user_id]
+        self._persist(rows)
+
+    def _flush_loop(self):
+        while not self._stop.wait(SESSION_FLUSH_INTERVAL):
+            self.flush(evict_idle=True)
+
+    def close(self):
+        """Остановить фоновую запись и сбросить все на диск"""
+        self._stop.set()
+        self.flush()
+
+    # ---------- Публичный API ----------
+
     def get_history(self, user_id: int) -> List[Dict[str, str]]:
         """Получить историю пользователя"""
-        return self.history[user_id]
-    
+        return list(self._record(user_id).history)
+
     def add_message(self, user_id: int, role: str, content: str):
         """Добавить сообщение в историю"""
-        self.history[user_id].append({"role": role, "content": content})
-        
-        # Обрезаем историю если слишком длинная
-        if len(self.history[user_id]) > MAX_HISTORY_LENGTH:
-            self.history[user_id] = self.history[user_id][-MAX_HISTORY_LENGTH:]
-        
-        # Обновляем статистику
-        if role == "user":
-            self.stats[user_id]['messages'] += 1
-    
+        record = self._record(user_id)
+        with self._lock:
+            # deque с maxlen сам отбрасывает самые старые сообщения
+            record.history.append({"role": role, "content": content})
+            record.total += 1
+
+            # Обновляем статистику
+            if role == "user":
+                record.stats[0] += 1
+            record.dirty = True
+
     def clear_history(self, user_id: int):
         """Очистить историю пользователя"""
-        self.history[user_id].clear()
-    
+        record = self._record(user_id)
+        with self._lock:
+            record.history.clear()
+            record.summary = ""
+            record.summary_upto = record.total
+            record.dirty = True
+
+    def get_history_window(self, user_id: int):
+        """История и номер ее первого сообщения"""
+        record = self._record(user_id)
+        with self._lock:
+            return list(record.history), record.total - len(record.history)
+
+    def get_summary(self, user_id: int):
+        """Краткое содержание старой части диалога и номер, до которого оно составлено"""
+        record = self._record(user_id)
+        return record.summary, record.summary_upto
+
+    def set_summary(self, user_id: int, summary: str, upto: int):
+        """Сохранить краткое содержание диалога"""
+        record = self._record(user_id)
+        with self._lock:
+            # Историю могли очистить, пока генерировалось содержание
+            if upto <= record.summary_upto:
+                return
+            record.summary = summary
+            record.summary_upto = upto
+            record.dirty = True
+
     def get_mode(self, user_id: int) -> str:
         """Получить текущий режим"""
-        return self.mode[user_id]
-    
+        return self._record(user_id).mode
+
     def set_mode(self, user_id: int, mode: str):
         """Установить режим работы"""
-        self.mode[user_id] = mode
-    
+        record = self._record(user_id)
+        with self._lock:
+            record.mode = mode
+            record.dirty = True
+
     def update_stats(self, user_id: int, stat_type: str):
         """Обновить статистику"""
-        if stat_type in self.stats[user_id]:
-            self.stats[user_id][stat_type] += 1
-    
+        if stat_type in STAT_FIELDS:
+            record = self._record(user_id)
+            with self._lock:
+                record.stats[STAT_FIELDS.index(stat_type)] += 1
+                record.dirty = True
+
     def get_stats(self, user_id: int) -> Dict[str, int]:
         """Получить статистику пользователя"""
-        return self.stats[user_id]
+        return dict(zip(STAT_FIELDS, self._record(user_id).stats))
 
 # Глобальный экземпляр
 user_sessions = UserSession()
@@ -0,0 +1,85 @@
+"""Кэш ключ-значение в SQLite, общий для всех процессов бота"""
+import sqlite3
+import threading
+import time
+from typing import Optional
+from config import SHARED_CACHE_PATH
+from utils.logger import logger
+
+# Раз в сколько записей удалять устаревшие и лишние записи
+PRUNE_EVERY = 100
+
+class SharedCache:
+    """Кэш строк по строковому ключу
+
+    Записи лежат в одном файле SQLite (WAL), поэтому их видят все
+    процессы-обработчики режима webhook и они переживают перезапуск.
+    Кэши разделены по namespace; старые записи вытесняются по TTL и
+    по времени записи (FIFO) сверх max_entries.
+    """
+
+    def __init__(self, namespace: str, max_entries: int, ttl: float, path=SHARED_CACHE_PATH):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._writes = 0
+
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                " namespace TEXT NOT NULL,"
+                " key TEXT NOT NULL,"
+                " value TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS cache_created ON cache (namespace, created_at)")
+            self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        """Значение или None, если его нет или оно устарело"""
+        try:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT value FROM cache WHERE namespace = ? AND key = ? AND created_at > ?",
+                    (self.namespace, key, time.time() - self.ttl)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Общий кэш {self.namespace}: ошибка чтения: {e}")
+            return None
+        return row[0] if row else None
+
+    def set(self, key: str, value: str):
+        """Сохранить значение (перезаписывает старое)"""
+        try:
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO cache (namespace, key, value, created_at) VALUES (?, ?, ?, ?)",
+                    (self.namespace, key, value, time.time())
+                )
+                self._writes += 1
+                if self._writes % PRUNE_EVERY == 0:
+                    self._prune()
+                self._conn.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Общий кэш {self.namespace}: ошибка записи: {e}")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM cache WHERE namespace = ?", (self.namespace,)
+            ).fetchone()[0]
+
+    def _prune(self):
+        self._conn.execute(
+            "DELETE FROM cache WHERE namespace = ? AND created_at <= ?",
+            (self.namespace, time.time() - self.ttl)
+        )
+        self._conn.execute(
+            "DELETE FROM cache WHERE namespace = ? AND key IN ("
+            " SELECT key FROM cache WHERE namespace = ? ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.namespace, self.namespace, self.max_entries)
+        )
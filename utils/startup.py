@@ -0,0 +1,40 @@
+"""Метрики запуска: время от старта процесса до готовности и первого обработанного апдейта"""
+import os
+import time
+from utils.logger import logger
+
+def _process_age() -> float:
+    """Сколько секунд назад запущен процесс (по /proc на Linux, иначе 0)"""
+    try:
+        with open("/proc/self/stat") as f:
+            # Поле 22 - время старта в тиках после загрузки системы (имя процесса в скобках пропускаем)
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+class StartupMetrics:
+    """Отметки этапов запуска в секундах от старта процесса
+
+    Каждый этап отмечается один раз: handlers_ready, bot_initialized,
+    first_update (первый обработанный апдейт) и прогрев объектов.
+    """
+
+    def __init__(self):
+        self.started_at = time.monotonic() - _process_age()
+        self.marks = {}
+
+    def mark(self, name: str) -> float:
+        seconds = self.marks.get(name)
+        if seconds is None:
+            seconds = self.marks[name] = time.monotonic() - self.started_at
+            logger.info(f"Запуск: {name} через {seconds:.2f} с после старта процесса")
+        return seconds
+
+    def stats(self) -> dict:
+        return {name: round(seconds, 3) for name, seconds in self.marks.items()}
+
+# Глобальный экземпляр
+startup = StartupMetrics()